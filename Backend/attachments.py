@@ -0,0 +1,234 @@
+# attachments.py
+"""
+Content-addressed attachment store.
+
+Files are stored once per content, under their sha256 in sharded directories:
+
+    uploads/ab/cd/abcd1234...<ext>      (served at /uploads/ab/cd/...)
+
+and described in the `attachments` collection:
+
+    {
+        "_id": sha256 hex,
+        "path": "ab/cd/abcd...ext",     # relative to UPLOAD_DIR
+        "size": int, "content_type": str, "created_at": datetime,
+        "conversation_ids": [ObjectId], # conversations the file was sent to
+        "ref_count": int,               # len(conversation_ids)
+        "image": {"width", "height", "variants": {name: {"path", "width", "height", "size"}}}
+                                        # images only, once previews.py rendered them
+    }
+
+Uploading the same content again (or to another conversation) only adds a
+reference; `lookup` lets clients skip the upload entirely when the server
+already has the hash. When a conversation is deleted its references are
+released and files nobody references any more are removed.
+
+Adding a reference and collecting a file are serialized per hash with an
+in-process lock (single server process, like the WS registry).
+"""
+import asyncio
+import os
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from db import async_db
+from uploads import UPLOAD_DIR
+import previews
+from metrics import timed_methods
+
+# Where clients fetch /uploads from: this server, or a reverse proxy / CDN in front of it
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000").rstrip("/")
+
+# How long upload / send_message wait for previews still rendering (they finish in the background anyway)
+PREVIEW_WAIT = int(os.getenv("PREVIEW_WAIT_MS", "2000")) / 1000
+
+attachments_collection = async_db['attachments']
+
+_locks = {}  # sha256 -> [lock, holders + waiters]
+_preview_tasks = {}  # sha256 -> task rendering its previews
+_EXT_RE = re.compile(r"^\.[A-Za-z0-9]{1,10}$")
+_URL_RE = re.compile(r"/uploads/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})")
+
+
+def attachment_path(sha256, file_name=None):
+    """Relative storage path of a content hash, keeping a (sanitized) extension for content types"""
+    ext = os.path.splitext(file_name or "")[1].lower()
+    if not _EXT_RE.match(ext):
+        ext = ""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+
+def attachment_url(doc):
+    return f"{PUBLIC_BASE_URL}/uploads/{doc['path']}"
+
+
+def image_payload(image):
+    """Client form of stored preview metadata (variant paths -> URLs)"""
+    if not image:
+        return None
+    return {
+        "width": image["width"],
+        "height": image["height"],
+        "variants": {
+            name: {"url": f"{PUBLIC_BASE_URL}/uploads/{v['path']}", "width": v["width"], "height": v["height"]}
+            for name, v in image.get("variants", {}).items()
+        }
+    }
+
+
+@timed_methods
+class AttachmentStore:
+    @staticmethod
+    async def put(upload, conversation_oid):
+        """
+        Store a received upload (see uploads.receive_upload) for a conversation.
+        The `.part` file is moved into place if the content is new, removed otherwise.
+        Returns the attachment document.
+        """
+        sha256 = upload["sha256"]
+        async with _hash_lock(sha256):
+            doc = await AttachmentStore._add_ref(sha256, conversation_oid, {
+                "path": attachment_path(sha256, upload["file_name"]),
+                "size": upload["size"],
+                "content_type": upload["content_type"],
+                "created_at": datetime.now()
+            })
+            target = UPLOAD_DIR / doc["path"]
+            if await asyncio.to_thread(target.exists):
+                await asyncio.to_thread(upload["part_path"].unlink, True)
+            else:
+                await asyncio.to_thread(_move_into_place, upload["part_path"], target)
+        return doc
+
+    @staticmethod
+    async def lookup(sha256, conversation_oid):
+        """
+        Reference an already stored file by hash without uploading it again.
+        Returns the attachment document, or None if the content is unknown.
+        """
+        async with _hash_lock(sha256):
+            doc = await attachments_collection.find_one({"_id": sha256}, {"path": 1})
+            if not doc or not await asyncio.to_thread((UPLOAD_DIR / doc["path"]).exists):
+                return None
+            return await AttachmentStore._add_ref(sha256, conversation_oid)
+
+    @staticmethod
+    async def find_by_url(file_url):
+        """Attachment behind a file_url (None for legacy / foreign URLs)"""
+        match = _URL_RE.search(file_url or "")
+        if not match:
+            return None
+        return await attachments_collection.find_one({"_id": match.group(1)})
+
+    @staticmethod
+    def schedule_previews(doc):
+        """Start rendering the previews of an image attachment in the background (once per hash). Returns the task or None."""
+        sha256 = doc["_id"]
+        if "image" in doc or not previews.available() or not previews.is_image(doc.get("content_type"), doc["path"]):
+            return None
+        task = _preview_tasks.get(sha256)
+        if task is None:
+            task = asyncio.create_task(AttachmentStore._render_previews(doc))
+            _preview_tasks[sha256] = task
+            task.add_done_callback(lambda _: _preview_tasks.pop(sha256, None))
+        return task
+
+    @staticmethod
+    async def _render_previews(doc):
+        directory, file_name = doc["path"].rsplit("/", 1)
+        image = await previews.generate(UPLOAD_DIR / doc["path"], UPLOAD_DIR / directory / doc["_id"])
+        if image is None:
+            return None  # failed this time: nothing saved, the next request retries
+        # {} (not a decodable image) is saved too: don't try again
+        for variant in image.get("variants", {}).values():
+            variant["path"] = f"{directory}/{os.path.basename(variant['path'])}"
+        await attachments_collection.update_one({"_id": doc["_id"]}, {"$set": {"image": image}})
+        return image
+
+    @staticmethod
+    async def image_info(doc, wait=None):
+        """
+        Preview metadata (client form) of an attachment, or None if it is not an image.
+        Waits up to PREVIEW_WAIT for previews being rendered; None if they are not ready by then.
+        """
+        image = doc.get("image")
+        if image is None:
+            task = AttachmentStore.schedule_previews(doc)
+            if task is None:
+                return None
+            try:
+                image = await asyncio.wait_for(asyncio.shield(task), PREVIEW_WAIT if wait is None else wait)
+            except asyncio.TimeoutError:
+                return None
+        return image_payload(image)
+
+    @staticmethod
+    async def _add_ref(sha256, conversation_oid, insert_fields=None):
+        """Add the conversation to the file's references (once). Creates the document if insert_fields is given."""
+        update = {"$push": {"conversation_ids": conversation_oid}, "$inc": {"ref_count": 1}}
+        if insert_fields:
+            update["$setOnInsert"] = insert_fields
+        try:
+            doc = await attachments_collection.find_one_and_update(
+                {"_id": sha256, "conversation_ids": {"$ne": conversation_oid}},
+                update,
+                upsert=insert_fields is not None,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The upsert hit the existing document: this conversation already references it
+            doc = None
+        if doc is None:
+            doc = await attachments_collection.find_one({"_id": sha256})
+        return doc
+
+    @staticmethod
+    async def release_conversation(conversation_oid):
+        """Drop a deleted conversation's references and remove files left unreferenced. Returns the number removed."""
+        hashes = [doc["_id"] async for doc in attachments_collection.find({"conversation_ids": conversation_oid}, {"_id": 1})]
+        if not hashes:
+            return 0
+        await attachments_collection.update_many(
+            {"_id": {"$in": hashes}, "conversation_ids": conversation_oid},
+            {"$pull": {"conversation_ids": conversation_oid}, "$inc": {"ref_count": -1}}
+        )
+        removed = 0
+        for sha256 in hashes:
+            if await AttachmentStore._collect(sha256):
+                removed += 1
+        return removed
+
+    @staticmethod
+    async def _collect(sha256):
+        async with _hash_lock(sha256):
+            if sha256 in _preview_tasks:
+                # Let it finish, or its variants would be left behind
+                await asyncio.wait([_preview_tasks[sha256]])
+            doc = await attachments_collection.find_one_and_delete({"_id": sha256, "ref_count": {"$lte": 0}})
+            if not doc:
+                return False  # referenced again in the meantime
+            paths = [doc["path"]] + [v["path"] for v in (doc.get("image") or {}).get("variants", {}).values()]
+            for path in paths:
+                await asyncio.to_thread((UPLOAD_DIR / path).unlink, True)
+            return True
+
+
+def _move_into_place(part_path, target):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(part_path, target)
+
+
+@asynccontextmanager
+async def _hash_lock(sha256):
+    # Locks are dropped once nobody holds or waits for them
+    entry = _locks.setdefault(sha256, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _locks[sha256]
@@ -11,6 +11,7 @@ REFRESH_SECRET_KEY = os.getenv("REFRESH_SECRET_KEY", "your-refresh-secret-key-ke
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  # 30 minutes
 REFRESH_TOKEN_EXPIRE_DAYS = 7  # 7 days
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # lower only for load-test environments
 
 def verify_password(plain_password, hashed_password):
     # Truncate password to 72 bytes to avoid bcrypt limitation
@@ -28,7 +29,7 @@ def get_password_hash(password):
     # Truncate password to 72 bytes to avoid bcrypt limitation
     if len(password.encode('utf-8')) > 72:
         password = password[:72]
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
     return hashed.decode('utf-8')
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -0,0 +1,152 @@
+"""
+WS encoding benchmark: bytes on the wire and CPU per frame for JSON (with and
+without permessage-deflate) and msgpack (codec.py, compressed above
+WS_COMPRESS_MIN_BYTES), on typical events. No server or database needed.
+
+    cd Backend
+    python -m benchmarks.bench_codec --frames 2000
+    WS_COMPRESS_MIN_BYTES=512 WS_COMPRESS_LEVEL=1 python -m benchmarks.bench_codec
+
+"json+deflate" is what permessage-deflate costs per socket as uvicorn
+negotiates it (context takeover, default zlib settings); msgpack frames are
+compressed once per fan-out whatever the number of recipients.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+import codec
+
+try:
+    from websockets.frames import Frame, Opcode
+    from websockets.extensions.permessage_deflate import PerMessageDeflate
+except ImportError:  # installed with uvicorn[standard]
+    PerMessageDeflate = None
+
+SAMPLES = 20  # distinct payloads per event type
+
+WORDS = ("ok", "mai", "họp", "lúc", "mấy", "giờ", "nhé", "đã", "gửi", "file", "rồi", "cảm", "ơn",
+         "meeting", "tomorrow", "please", "check", "the", "report", "thanks", "😂", "👍")
+
+
+def _text(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, n)))
+
+
+def _message(rng, seq, members, when):
+    msg = {
+        "_id": ObjectId(),
+        "seq": seq,
+        "sender_id": rng.choice(members),
+        "text": _text(rng, 20),
+        "msg_type": "text",
+        "created_at": when,
+    }
+    if rng.random() < 0.1:
+        msg.update(msg_type="file", file_url=f"http://localhost:8000/uploads/{ObjectId()}.pdf",
+                   file_name="bao-cao-quy-3.pdf", file_size=rng.randint(10_000, 5_000_000))
+    return msg
+
+
+def sample_events(seed=1):
+    """(type, data) of typical frames, small to large"""
+    rng = random.Random(seed)
+    members = [f"user{i}@example.com" for i in range(20)]
+    now = datetime.now()
+    conversation_id = str(ObjectId())
+    history = [_message(rng, seq, members, now - timedelta(minutes=60 - seq)) for seq in range(50)]
+    conversations = []
+    for i in range(50):
+        group = i % 3 == 0
+        conversations.append({
+            "_id": ObjectId(),
+            "type": "group" if group else "direct",
+            "name": f"Nhóm dự án {i}" if group else None,
+            "participants": rng.sample(members, 8 if group else 2),
+            "admins": members[:1] if group else [],
+            "created_at": now - timedelta(days=i),
+            "created_by": members[0],
+            "status": "accepted",
+            "message_seq": rng.randint(0, 5000),
+            "last_message": {"text": _text(rng, 12), "sender_id": rng.choice(members), "created_at": now},
+            "pinned_messages": [],
+        })
+    return [
+        ("presence_batch", {"updates": [{"user_id": members[1], "online": True, "last_seen": None}]}),
+        ("send_ack", {"conversation_id": conversation_id, "message_id": str(ObjectId()), "seq": 51}),
+        ("new_message", {"conversation_id": conversation_id, "message": _message(rng, 51, members, now)}),
+        ("messages_loaded", {"conversation_id": conversation_id, "messages": history, "has_more": True, "next_cursor": 0}),
+        ("conversations_list", {"conversations": conversations}),
+    ]
+
+
+def _cpu_per_frame(func, items):
+    start = time.process_time()
+    for item in items:
+        func(item)
+    return (time.process_time() - start) / len(items)
+
+
+def measure(type_, samples, frames):
+    """
+    {mode: (bytes per frame, encode µs per frame, decode µs per frame)} for a
+    stream of `frames` events cycling through `samples` (distinct payloads,
+    so permessage-deflate can't just point back at the previous frame)
+    """
+    stream = [samples[i % len(samples)] for i in range(frames)]
+    results = {}
+
+    texts = [codec.encode_frame(type_, data) for data in stream]
+    results["json"] = (sum(len(t.encode()) for t in texts) / frames,
+                       _cpu_per_frame(lambda data: codec.encode_frame(type_, data), stream),
+                       _cpu_per_frame(codec.decode_frame, texts))
+
+    if PerMessageDeflate is not None:
+        # One connection: the compression context carries over between frames
+        server = PerMessageDeflate(False, False, 15, 15)
+        client = PerMessageDeflate(False, False, 15, 15)
+        wire = []
+
+        def deflate(data):
+            wire.append(server.encode(Frame(Opcode.TEXT, codec.encode_frame(type_, data).encode(), rsv1=False)))
+
+        encode = _cpu_per_frame(deflate, stream)
+        decode = _cpu_per_frame(lambda frame: codec.decode_frame(client.decode(frame).data.decode()), wire)
+        results["json+deflate"] = (sum(len(f.data) for f in wire) / frames, encode, decode)
+
+    if codec.msgpack is not None:
+        binaries = [codec.encode_frame(type_, data, encoding=codec.MSGPACK) for data in stream]
+        mode = "msgpack+zlib" if binaries[0][:1] == codec.HEADER_ZLIB else "msgpack"
+        results[mode] = (sum(map(len, binaries)) / frames,
+                         _cpu_per_frame(lambda data: codec.encode_frame(type_, data, encoding=codec.MSGPACK), stream),
+                         _cpu_per_frame(codec.decode_frame, binaries))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=2000, help="frames encoded / decoded per event and mode")
+    args = parser.parse_args()
+
+    print(f"json encoder: {'orjson' if codec.orjson else 'json'}, msgpack: {'yes' if codec.msgpack else 'not installed'}, "
+          f"permessage-deflate: {'yes' if PerMessageDeflate else 'websockets not installed'}, "
+          f"WS_COMPRESS_MIN_BYTES={codec.WS_COMPRESS_MIN_BYTES}, WS_COMPRESS_LEVEL={codec.WS_COMPRESS_LEVEL}")
+    print(f"{'event':<20}{'mode':<15}{'bytes':>9}{'vs json':>9}{'encode µs':>11}{'decode µs':>11}")
+    report = {}
+    events = list(zip(*(sample_events(seed) for seed in range(SAMPLES))))
+    for samples in events:
+        type_ = samples[0][0]
+        results = measure(type_, [data for _, data in samples], args.frames)
+        json_bytes = results["json"][0]
+        for mode, (size, encode, decode) in results.items():
+            print(f"{type_:<20}{mode:<15}{size:>9.0f}{size / json_bytes:>9.2f}{encode * 1e6:>11.1f}{decode * 1e6:>11.1f}")
+        report[type_] = {mode: {"bytes": round(size), "encode_us": round(encode * 1e6, 2), "decode_us": round(decode * 1e6, 2)}
+                         for mode, (size, encode, decode) in results.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Broadcast fan-out benchmark: old per-socket encode + sequential await vs
+encode-once + per-connection queues. No server or database needed.
+
+    cd Backend
+    python -m benchmarks.bench_fanout --members 1000 --broadcasts 20 --latency-ms 0.2
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import codec
+from fanout import outbound, fan_out
+from outbound import OutboundQueue
+
+
+class FakeSocket:
+    """Socket with a fixed per-frame send latency; the slow one simulates a stalled client"""
+    def __init__(self, latency, done):
+        self.latency = latency
+        self.done = done
+        self.received = 0
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        self.done()
+
+    async def close(self, code=1000):
+        pass
+
+
+def sample_message():
+    return {
+        "conversation_id": "6650f0c2a4b1c2d3e4f5a6b7",
+        "message": {
+            "_id": "6650f0c2a4b1c2d3e4f5a6b8",
+            "seq": 1234,
+            "sender_id": "alice@example.com",
+            "text": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 3,
+            "msg_type": "text",
+            "created_at": int(time.time() * 1000),
+            "status": "sent"
+        }
+    }
+
+
+async def old_broadcast(sockets, type_, data, counter):
+    # What broadcast() did before: envelope + json.dumps + await send, one socket at a time
+    for ws in sockets:
+        payload = {"type": type_, "data": data, "request_id": None, "ts": int(time.time() * 1000)}
+        counter[0] += 1
+        await ws.send_text(json.dumps(payload))
+
+
+async def run(mode, members, broadcasts, latency, slow_latency):
+    remaining = [members * broadcasts]
+    finished = asyncio.Event()
+
+    def done():
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            finished.set()
+
+    sockets = [FakeSocket(latency, done) for _ in range(members)]
+    if slow_latency:
+        sockets[0].latency = slow_latency
+
+    if mode == "queued":
+        for ws in sockets:
+            outbound[ws] = OutboundQueue(ws, maxsize=broadcasts + 1)
+
+    data = sample_message()
+    counter = [0]
+    before = codec.encode_count
+    blocked = 0.0
+    start = time.perf_counter()
+    for _ in range(broadcasts):
+        t0 = time.perf_counter()
+        if mode == "queued":
+            await fan_out(sockets, "new_message", data)
+        else:
+            await old_broadcast(sockets, "new_message", data, counter)
+        blocked += time.perf_counter() - t0
+    await finished.wait()
+    total = time.perf_counter() - start
+
+    for ws in sockets:
+        queue = outbound.pop(ws, None)
+        if queue:
+            queue.close()
+
+    encodings = counter[0] if mode == "sequential" else codec.encode_count - before
+    return {
+        "mode": mode,
+        "encodings_per_broadcast": encodings / broadcasts,
+        "sender_blocked_ms_per_broadcast": round(blocked / broadcasts * 1000, 3),
+        "fanout_latency_ms_per_broadcast": round(total / broadcasts * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--broadcasts", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="per-frame send latency of each socket")
+    parser.add_argument("--slow-ms", type=float, default=0.0, help="latency of one stalled socket")
+    args = parser.parse_args()
+
+    print(f"encoder: {'orjson' if codec.orjson else 'json'}, members={args.members}, broadcasts={args.broadcasts}")
+    results = []
+    for mode in ("sequential", "queued"):
+        results.append(asyncio.run(run(mode, args.members, args.broadcasts, args.latency_ms / 1000, args.slow_ms / 1000)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
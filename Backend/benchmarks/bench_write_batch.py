@@ -0,0 +1,87 @@
+"""
+Message insert throughput: one write per message (MessageStore.append) vs
+group commit (WriteBatcher). Writes to the configured database (MONGO_URI /
+MONGO_DB), so point it at a scratch database; the conversations it creates
+are deleted at the end.
+
+    cd Backend
+    MONGO_DB=bench python -m benchmarks.bench_write_batch --senders 200 --messages 20 --conversations 10 --window-ms 2
+
+With MONGO_URI=mongomock:// there is no network round trip, so only the
+relative bookkeeping cost shows; the batching gain needs a real server.
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+from bson import ObjectId
+
+from message_store import MessageStore, conversations_collection
+from write_batcher import WriteBatcher
+
+
+async def run(mode, senders, messages, conversations, window):
+    conv_oids = [ObjectId() for _ in range(conversations)]
+    await conversations_collection.insert_many([
+        {"_id": oid, "type": "group", "participants": [], "message_seq": 0, "bench": True}
+        for oid in conv_oids
+    ])
+    batcher = WriteBatcher(window=window) if mode == "batched" else None
+    append = batcher.append if batcher else MessageStore.append
+    latencies = []
+
+    async def sender(n):
+        # Each sender waits for its ack before sending the next message, like a client
+        conv_oid = conv_oids[n % conversations]
+        for i in range(messages):
+            now = datetime.now()
+            message = {"_id": ObjectId(), "sender_id": f"user{n}", "text": f"message {i}", "msg_type": "text", "created_at": now}
+            started = time.perf_counter()
+            await append(conv_oid, message, {"text": message["text"], "sender_id": message["sender_id"], "created_at": now})
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(n) for n in range(senders)))
+    elapsed = time.perf_counter() - started
+
+    # Check: every conversation got contiguous sequences
+    for oid in conv_oids:
+        page, _ = await MessageStore.get_page(oid, after=-1, limit=senders * messages)
+        assert [m["seq"] for m in page] == list(range(len(page))), "sequence gap"
+    for oid in conv_oids:
+        await MessageStore.delete_conversation(oid)
+    await conversations_collection.delete_many({"_id": {"$in": conv_oids}})
+
+    latencies.sort()
+    total = senders * messages
+    result = {
+        "mode": mode,
+        "messages": total,
+        "seconds": round(elapsed, 3),
+        "messages_per_s": round(total / elapsed),
+        "ack_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "ack_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    }
+    if batcher:
+        result["batches"] = batcher.batches
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--senders", type=int, default=200, help="concurrent senders")
+    parser.add_argument("--messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--conversations", type=int, default=10, help="conversations the senders share")
+    parser.add_argument("--window-ms", type=float, default=2, help="batching window")
+    args = parser.parse_args()
+
+    async def both():
+        for mode in ("single", "batched"):
+            print(json.dumps(await run(mode, args.senders, args.messages, args.conversations, args.window_ms / 1000)))
+
+    asyncio.run(both())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""
+WebSocket load generator: thousands of simulated clients against a real
+server, per-operation latency percentiles as JSON.
+
+Starts the app with uvicorn in a subprocess (or uses --server), provisions
+accounts through the bulk admin API, then runs the phases:
+
+    login     REST login of every account
+    connect   WS connect + auth
+    groups    one create_group per --group-size clients, every member joins
+    friends   friend requests inside each group, accepted by the recipient
+    steady    --duration seconds of send_message at --rate per client,
+              with --churn reconnects per second (close, connect, auth, join;
+              `reconnect` in the result, its steps as churn_*)
+
+For every operation (auth, join, create_group, send_message, ...) the result
+has count, errors, p50/p95/p99/max in ms and throughput; `deliver` is the time
+from sending a message to another member receiving its new_message.
+
+    cd Backend
+    python -m benchmarks.ws_load --clients 1000 --group-size 20 --rate 0.5 --duration 30 --output before.json
+    python -m benchmarks.ws_load --compare before.json after.json
+
+Without MONGO_URI the server uses the in-memory stand-in (mongomock://), which
+measures the app but not the database. Each client is a socket of this
+process: raise `ulimit -n` for large --clients, and keep in mind the load
+generator shares the machine (its CPU time is in the result).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import secrets
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from itertools import count
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+from websockets import connect
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+BULK_REQUEST_SIZE = 5000
+PASSWORD = "load-test-password"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class Stats:
+    """Latencies and errors per operation"""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.windows = {}  # op -> [first start, last end]
+
+    def record(self, op, started, ended=None):
+        ended = time.perf_counter() if ended is None else ended
+        self.latencies[op].append(ended - started)
+        window = self.windows.setdefault(op, [started, ended])
+        window[0] = min(window[0], started)
+        window[1] = max(window[1], ended)
+
+    def error(self, op, reason):
+        self.errors[op][reason] += 1
+
+    def summary(self):
+        result = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(op, []))
+            window = self.windows.get(op)
+            elapsed = window[1] - window[0] if window else 0
+            result[op] = {
+                "count": len(values),
+                "errors": sum(self.errors[op].values()),
+                "error_reasons": dict(self.errors[op]),
+                "p50_ms": _ms(percentile(values, 50)),
+                "p95_ms": _ms(percentile(values, 95)),
+                "p99_ms": _ms(percentile(values, 99)),
+                "max_ms": _ms(values[-1] if values else None),
+                "throughput_per_s": round(len(values) / elapsed, 1) if elapsed > 0 else None
+            }
+        return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class Client:
+    """One simulated user: a socket, a reader task, replies matched by request_id"""
+    _request_ids = count()
+
+    def __init__(self, run, user):
+        self.run = run
+        self.user_id = user["user_id"]
+        self.token = user["token"]
+        self.ws = None
+        self.reader = None
+        self.pending = {}
+        self.conversation_id = None
+        self.connected = False
+
+    async def connect(self, prefix=""):
+        """Connect and auth; ops recorded as prefix + "connect" / "auth" """
+        started = time.perf_counter()
+        try:
+            self.ws = await connect(self.run.ws_url, max_size=None, ping_interval=None, open_timeout=self.run.timeout)
+        except Exception as e:
+            self.run.stats.error(prefix + "connect", type(e).__name__)
+            return False
+        self.run.stats.record(prefix + "connect", started)
+        self.reader = asyncio.create_task(self._read())
+        if not await self.request("auth", {"token": self.token}, "auth_ok", prefix + "auth"):
+            return False
+        self.connected = True
+        return True
+
+    async def close(self):
+        self.connected = False
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    async def request(self, type_, data, expect, op=None):
+        """Send and wait for the reply with our request_id; records latency under `op` (default: type_)"""
+        op = op or type_
+        request_id = f"r{next(Client._request_ids)}"
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        started = time.perf_counter()
+        try:
+            await self.ws.send(json.dumps({"type": type_, "data": data, "request_id": request_id}))
+            frame = await asyncio.wait_for(future, self.run.timeout)
+        except asyncio.TimeoutError:
+            self.run.stats.error(op, "timeout")
+            return None
+        except Exception as e:
+            self.run.stats.error(op, type(e).__name__)
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+        if frame["type"] != expect:
+            self.run.stats.error(op, frame["data"].get("code") or frame["type"])
+            return None
+        self.run.stats.record(op, started)
+        return frame
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                frame = json.loads(raw)
+                future = self.pending.get(frame.get("request_id"))
+                if future is not None and not future.done():
+                    future.set_result(frame)
+                elif frame["type"] == "new_message":
+                    self._on_message(frame["data"]["message"])
+        except Exception as e:
+            if self.connected:
+                self.run.stats.error("connection", type(e).__name__)
+
+    def _on_message(self, message):
+        # Messages sent by this process carry their perf_counter() send time
+        if message.get("sender_id") == self.user_id:
+            return
+        text = message.get("text", "")
+        if text.startswith("load "):
+            self.run.stats.record("deliver", float(text.split(" ", 2)[1]))
+
+
+class LoadRun:
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http", "ws", 1) + "/ws"
+        self.timeout = args.timeout
+        self.stats = Stats()
+        self.phases = {}
+        self.clients = []
+
+    async def phase(self, name, coroutine):
+        started = time.perf_counter()
+        await coroutine
+        self.phases[name] = round(time.perf_counter() - started, 2)
+        print(f"[ws_load] {name}: {self.phases[name]}s", file=sys.stderr)
+
+    async def bounded(self, coroutines):
+        """Run with at most --concurrency in flight"""
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+        return await asyncio.gather(*(run(c) for c in coroutines))
+
+    async def provision(self, http):
+        prefix = self.args.prefix or f"load{secrets.token_hex(3)}"
+        accounts = [
+            {"username": f"{prefix}_{i}", "email": f"{prefix}_{i}@load.test", "password": PASSWORD}
+            for i in range(self.args.clients)
+        ]
+        for start in range(0, len(accounts), BULK_REQUEST_SIZE):
+            response = await http.post(
+                "/api/admin/users/bulk",
+                json={"users": accounts[start:start + BULK_REQUEST_SIZE]},
+                headers={"X-Admin-Token": self.args.admin_token},
+                timeout=None
+            )
+            response.raise_for_status()
+        return accounts
+
+    async def login(self, http, account):
+        started = time.perf_counter()
+        for attempt in range(3):
+            try:
+                response = await http.post("/api/login", json={"username": account["username"], "password": PASSWORD})
+                response.raise_for_status()
+                break
+            except httpx.TransportError as e:
+                # Pooled keep-alive connection closed by the server as it was reused: try again
+                error = e
+            except Exception as e:
+                self.stats.error("login", type(e).__name__)
+                return None
+        else:
+            self.stats.error("login", type(error).__name__)
+            return None
+        self.stats.record("login", started)
+        return {"user_id": response.json()["user_id"], "token": response.json()["access_token"]}
+
+    async def connect_all(self, users):
+        self.clients = [Client(self, user) for user in users if user]
+        connected = await self.bounded(client.connect() for client in self.clients)
+        self.clients = [client for client, ok in zip(self.clients, connected) if ok]
+
+    def groups(self):
+        size = self.args.group_size
+        return [self.clients[i:i + size] for i in range(0, len(self.clients), size) if len(self.clients[i:i + size]) >= 3]
+
+    async def create_group(self, members):
+        creator = members[0]
+        frame = await creator.request("create_group", {
+            "name": f"load {creator.user_id}",
+            "member_ids": [m.user_id for m in members[1:]]
+        }, "group_created")
+        if not frame:
+            return
+        conversation_id = frame["data"]["conversation"]["_id"]
+        for member in members:
+            member.conversation_id = conversation_id
+        await asyncio.gather(*(self.join(member) for member in members))
+
+    async def join(self, client):
+        await client.request("join", {"conversation_id": client.conversation_id}, "join_ok")
+
+    async def befriend(self, members):
+        # Disjoint pairs (0 -> 1, 2 -> 3, ...): each request accepted by its recipient
+        for sender, recipient in zip(members[0::2], members[1::2]):
+            if await sender.request("send_friend_request", {"to_user_id": recipient.user_id}, "friend_request_sent"):
+                await recipient.request("accept_friend_request", {"from_user_id": sender.user_id}, "friend_request_accepted")
+
+    async def send_loop(self, client, deadline):
+        rate = self.args.rate
+        n = 0
+        while True:
+            await asyncio.sleep(min(random.expovariate(rate), max(0, deadline - time.perf_counter())))
+            if time.perf_counter() >= deadline:
+                return
+            if not client.connected or not client.conversation_id:
+                continue
+            n += 1
+            await client.request("send_message", {
+                "conversation_id": client.conversation_id,
+                "client_msg_id": f"{client.user_id}-{n}",
+                "msg_type": "text",
+                "text": f"load {time.perf_counter()} " + "x" * self.args.message_bytes
+            }, "send_ack")
+
+    async def churn_loop(self, deadline):
+        reconnects = []
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(min(random.expovariate(self.args.churn), max(0, deadline - time.perf_counter())))
+            if time.perf_counter() >= deadline:
+                break
+            reconnects.append(asyncio.create_task(self.reconnect(random.choice(self.clients))))
+        await asyncio.gather(*reconnects)
+
+    async def reconnect(self, client):
+        if not client.connected:
+            return
+        started = time.perf_counter()
+        await client.close()
+        # Steps under churn_* so they don't mix with the connect phase
+        if await client.connect("churn_") and client.conversation_id:
+            if await client.request("join", {"conversation_id": client.conversation_id}, "join_ok", "churn_join"):
+                self.stats.record("reconnect", started)
+
+    async def steady(self):
+        deadline = time.perf_counter() + self.args.duration
+        tasks = [self.send_loop(client, deadline) for client in self.clients if self.args.rate > 0]
+        if self.args.churn > 0:
+            tasks.append(self.churn_loop(deadline))
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(1)  # let the last deliveries arrive
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=self.timeout) as http:
+            accounts = []
+            await self.phase("provision", self._assign(accounts, self.provision(http)))
+            users = []
+            await self.phase("login", self._assign(users, self.bounded(self.login(http, a) for a in accounts)))
+        await self.phase("connect", self.connect_all(users))
+        await self.phase("groups", asyncio.gather(*(self.create_group(g) for g in self.groups())))
+        if self.args.friends:
+            await self.phase("friends", asyncio.gather(*(self.befriend(g) for g in self.groups())))
+        await self.phase("steady", self.steady())
+        await asyncio.gather(*(client.close() for client in self.clients))
+
+    @staticmethod
+    async def _assign(target, coroutine):
+        target.extend(await coroutine)
+
+
+def start_server(args):
+    env = dict(os.environ)
+    env.setdefault("MONGO_URI", "mongomock://")
+    env.setdefault("MONGO_DB", "load")
+    env["ADMIN_TOKEN"] = args.admin_token
+    env.setdefault("BCRYPT_ROUNDS", "4")  # logins would measure bcrypt otherwise
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode} (see --server-log)")
+        try:
+            if httpx.get(base_url + "/health", timeout=1).status_code == 200:
+                return server, base_url, env["MONGO_URI"]
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("server did not start within 60s")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def without_credentials(uri):
+    """The URI without its user:password@ part (results get saved and shared)"""
+    if not uri:
+        return uri
+    parts = urlsplit(uri)
+    if "@" not in parts.netloc:
+        return uri
+    return urlunsplit(parts._replace(netloc=parts.netloc.rsplit("@", 1)[1]))
+
+
+def compare(path_a, path_b):
+    a = json.loads(Path(path_a).read_text())
+    b = json.loads(Path(path_b).read_text())
+    print(f"{path_a} ({a.get('revision')}) -> {path_b} ({b.get('revision')})")
+    print(f"{'op':24} {'p50 ms':>20} {'p95 ms':>20} {'p99 ms':>20} {'errors':>12}")
+    for op in sorted(set(a["ops"]) | set(b["ops"])):
+        old, new = a["ops"].get(op, {}), b["ops"].get(op, {})
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            x, y = old.get(key), new.get(key)
+            change = f" {(y - x) / x:+.0%}" if x and y is not None else ""
+            cells.append(f"{x} -> {y}{change}")
+        errors = f"{old.get('errors', '-')} -> {new.get('errors', '-')}"
+        print(f"{op:24} {cells[0]:>20} {cells[1]:>20} {cells[2]:>20} {errors:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--group-size", type=int, default=10, help="members per group (min 3)")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--message-bytes", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of steady traffic")
+    parser.add_argument("--churn", type=float, default=0, help="reconnects per second during steady traffic")
+    parser.add_argument("--no-friends", dest="friends", action="store_false", help="skip the friend request phase")
+    parser.add_argument("--concurrency", type=int, default=100, help="logins / connects in flight")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--server", help="base URL of a running server (needs --admin-token) instead of starting one")
+    parser.add_argument("--admin-token", default=secrets.token_hex(16))
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-log", help="write the server output to this file")
+    parser.add_argument("--prefix", help="account name prefix (default: random per run)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="write the JSON result here (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("A.json", "B.json"), help="compare two results and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.group_size < 3:
+        parser.error("--group-size must be at least 3 (create_group needs 2 members besides the creator)")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = None
+    if args.server:
+        base_url, mongo_uri = args.server.rstrip("/"), None
+    else:
+        server, base_url, mongo_uri = start_server(args)
+    run = LoadRun(args, base_url)
+    cpu_started = time.process_time()
+    try:
+        asyncio.run(run.run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("admin_token", "compare", "output", "server_log")}
+    result = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {**config, "server": without_credentials(args.server), "mongo_uri": without_credentials(mongo_uri)},
+        "connected_clients": len(run.clients),
+        "phases_s": run.phases,
+        "load_generator_cpu_s": round(time.process_time() - cpu_started, 2),
+        "ops": run.stats.summary()
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
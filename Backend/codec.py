@@ -0,0 +1,134 @@
+# codec.py
+"""
+WS frame encoding.
+
+Two encodings of the same {type, data, request_id, ts} envelope:
+
+- JSON text frames (default). Uses orjson when installed (several times
+  faster than json), falling back to the standard library.
+- MessagePack binary frames, for clients opening the socket with the
+  "chat.msgpack" subprotocol (needs `pip install msgpack`). A binary frame
+  is a 1-byte header followed by the packed envelope:
+
+      0x00  msgpack
+      0x01  zlib-compressed msgpack (envelopes of WS_COMPRESS_MIN_BYTES+)
+
+  Small frames (acks, presence, single messages) are sent as is: deflating
+  them costs more CPU than the bytes it saves. Large ones (messages_loaded,
+  conversations_list) shrink several times. A fan-out compresses once for
+  all its recipients, unlike permessage-deflate which compresses per socket.
+
+In both encodings datetime becomes epoch milliseconds and ObjectId its hex
+string, like everywhere else in the API; other unknown types are str()'d.
+"""
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+from bson import ObjectId
+import metrics
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, enables the msgpack encoding
+    msgpack = None
+
+JSON, MSGPACK = "json", "msgpack"
+# WS subprotocol -> encoding, in server preference order
+SUBPROTOCOLS = {"chat.msgpack": MSGPACK, "chat.json": JSON}
+
+WS_COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "1024"))  # 0 disables compression
+WS_COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+MAX_DECODED_BYTES = 16 * 1024 * 1024  # incoming frames, same as uvicorn's ws_max_size
+
+HEADER_PLAIN, HEADER_ZLIB = b"\x00", b"\x01"
+
+# Number of envelopes encoded since start (benchmarks / metrics)
+encode_count = 0
+compress_stats = {"frames": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return int(obj.timestamp() * 1000)
+    return str(obj)
+
+
+def negotiate(subprotocols):
+    """(subprotocol to accept, encoding) for the subprotocols offered by a client"""
+    for subprotocol, encoding in SUBPROTOCOLS.items():
+        if subprotocol in subprotocols and (encoding != MSGPACK or msgpack is not None):
+            return subprotocol, encoding
+    return None, JSON
+
+
+def encode_frame(type_, data, request_id=None, encoding=JSON):
+    """Build the {type, data, request_id, ts} envelope and encode it to a text (JSON) or binary (msgpack) frame"""
+    global encode_count
+    encode_count += 1
+    payload = {
+        "type": type_,
+        "data": data,
+        "request_id": request_id,
+        "ts": int(time.time() * 1000)
+    }
+    if encoding == MSGPACK:
+        return pack_binary(msgpack.packb(payload, default=_default))
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+    return json.dumps(payload, default=_default)
+
+
+def pack_binary(packed):
+    """Header + msgpack body, compressed when large enough"""
+    if WS_COMPRESS_MIN_BYTES and len(packed) >= WS_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(packed, WS_COMPRESS_LEVEL)
+        compress_stats["frames"] += 1
+        compress_stats["bytes_in"] += len(packed)
+        compress_stats["bytes_out"] += len(compressed)
+        return HEADER_ZLIB + compressed
+    return HEADER_PLAIN + packed
+
+
+def decode_frame(raw):
+    """Client frame (JSON text or msgpack binary) -> message dict. Raises ValueError if invalid."""
+    try:
+        if isinstance(raw, str):
+            msg = json.loads(raw)
+        elif msgpack is None:
+            raise ValueError("binary frames are not supported")
+        else:
+            header, body = raw[:1], raw[1:]
+            if header == HEADER_ZLIB:
+                decompressor = zlib.decompressobj()
+                body = decompressor.decompress(body, MAX_DECODED_BYTES)
+                if decompressor.unconsumed_tail:
+                    raise ValueError("frame too large")
+            elif header != HEADER_PLAIN:
+                raise ValueError("unknown frame header")
+            msg = msgpack.unpackb(body)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(str(e)) from e
+    if not isinstance(msg, dict):
+        raise ValueError("frame is not an object")
+    return msg
+
+
+@metrics.register_collector
+def _codec_metrics():
+    return [
+        ("chat_ws_compressed_frames_total", "counter", "Binary frames sent zlib-compressed", [({}, compress_stats["frames"])]),
+        ("chat_ws_compressed_bytes_total", "counter", "Size of compressed binary frames before / after compression", [
+            ({"stage": "in"}, compress_stats["bytes_in"]), ({"stage": "out"}, compress_stats["bytes_out"])
+        ]),
+    ]
@@ -1,11 +1,26 @@
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB = os.getenv("MONGO_DB")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+
+if MONGO_URI and MONGO_URI.startswith("mongomock://"):
+    # In-memory stand-in (tests / running without mongod), requires `pip install mongomock`
+    from mongo_memory import client, async_client
+else:
+    # Sync client: scripts and CLI tools only (check_friends.py, verify_schema.py, ...)
+    client = MongoClient(MONGO_URI)
+    # Async client: everything the server does, so the event loop never blocks on Mongo
+    async_client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE
+    )
 
-client = MongoClient(MONGO_URI)
 db = client[MONGO_DB]
+async_db = async_client[MONGO_DB]
@@ -0,0 +1,72 @@
+# downloads.py
+"""
+Serving uploaded files (GET/HEAD /uploads/{path}).
+
+- Range requests (resumable downloads, video seeking) and If-Range are
+  handled by starlette's FileResponse, which also uses zero-copy `pathsend`
+  when the ASGI server supports it
+- content-addressed files (attachments.py) and their previews get their
+  sha256 (+ variant) as a strong ETag and `Cache-Control: immutable` for a year: the URL changes whenever
+  the content does, so browsers, a reverse proxy or a CDN (PUBLIC_BASE_URL)
+  can cache them forever
+- If-None-Match is answered with 304 without touching the file
+- with ATTACHMENT_ACCEL_REDIRECT set (e.g. "/_uploads/"), the file itself is
+  left to nginx (X-Accel-Redirect to an internal location on UPLOAD_DIR),
+  which sends it with sendfile and handles ranges
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from uploads import UPLOAD_DIR
+
+ATTACHMENT_ACCEL_REDIRECT = os.getenv("ATTACHMENT_ACCEL_REDIRECT", "")
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+LEGACY_CACHE = "public, max-age=86400"  # {timestamp}_{name} files from before attachments.py
+
+# <sha256>.<ext> and its preview variants <sha256>_<variant>.<ext>
+_CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64}(?:_[a-z]+)?)(\.[a-z0-9]{1,10})?$")
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates
+
+
+async def serve_upload(request: Request, path: str):
+    # Never outside UPLOAD_DIR, never the .part files of uploads in progress
+    parts = path.split("/")
+    if not path or any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+        raise HTTPException(status_code=404, detail="Not found")
+    file_path = UPLOAD_DIR / path
+
+    try:
+        stat_result = await asyncio.to_thread(os.stat, file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    match = _CONTENT_ADDRESSED.match(path)
+    if match:
+        headers = {"ETag": f'"{match.group(1)}"', "Cache-Control": IMMUTABLE_CACHE}
+    else:
+        headers = {"ETag": f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"', "Cache-Control": LEGACY_CACHE}
+    headers["Accept-Ranges"] = "bytes"
+
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    if ATTACHMENT_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = ATTACHMENT_ACCEL_REDIRECT.rstrip("/") + "/" + path
+        return Response(headers=headers, media_type=mimetypes.guess_type(path)[0] or "application/octet-stream")
+
+    return FileResponse(file_path, headers=headers, stat_result=stat_result)
@@ -0,0 +1,138 @@
+# fanout.py
+"""
+Sending frames to sockets.
+
+Every socket registered in `outbound` has its own OutboundQueue, so sending
+is just encoding + enqueueing; the writer tasks push frames to the clients
+concurrently. Fan-out encodes a frame once per encoding (JSON / msgpack,
+see codec.py) and shares it between recipients.
+
+`deliver` is the single entry point for conversation events: it plans the
+target sockets (room members + online participants + extra users, minus
+exclusions) so each socket gets each event exactly once.
+"""
+from itertools import chain
+from fastapi import WebSocket
+from codec import encode_frame, JSON
+from outbound import DROPPABLE_TYPES, WS_QUEUE_SIZE
+import metrics
+
+# --- Connection registry ---
+rooms = {}     # conversation_id -> set of ws that joined it
+ws_user = {}   # ws -> user_id
+user_ws = {}   # user_id -> ws
+outbound = {}  # ws -> OutboundQueue
+encodings = {} # ws -> codec encoding, for sockets not using JSON
+
+# Delivery counters: candidates = sockets before de-duplication
+delivery_stats = {"events": 0, "frames": 0, "duplicates_avoided": 0}
+
+
+async def send_frame(ws: WebSocket, frame, type_=None):
+    """Send an already encoded frame"""
+    queue = outbound.get(ws)
+    if queue:
+        # Never wait on the socket here: the connection's writer task sends it
+        queue.put(frame, droppable=type_ in DROPPABLE_TYPES)
+    elif isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)
+
+
+def _count_sent(type_, frame, encoding, sockets=1):
+    size = len(frame) if isinstance(frame, bytes) or frame.isascii() else len(frame.encode())
+    metrics.ws_frames_sent.inc(type_, encoding, amount=sockets)
+    metrics.ws_bytes_sent.inc(type_, encoding, amount=size * sockets)
+
+
+async def ws_send(ws: WebSocket, type_: str, data: dict, request_id=None):
+    try:
+        encoding = encodings.get(ws, JSON)
+        frame = encode_frame(type_, data, request_id, encoding)
+        _count_sent(type_, frame, encoding)
+        await send_frame(ws, frame, type_)
+    except Exception as e:
+        print(f"[WS] send error: {e}")
+
+
+async def fan_out(sockets, type_: str, data: dict):
+    """Encode once per encoding, queue the same frame for every socket. Returns the number of sockets."""
+    sockets = list(sockets)
+    if not sockets:
+        return 0
+    by_encoding = {}
+    for ws in sockets:
+        by_encoding.setdefault(encodings.get(ws, JSON), []).append(ws)
+    for encoding, group in by_encoding.items():
+        frame = encode_frame(type_, data, encoding=encoding)
+        _count_sent(type_, frame, encoding, len(group))
+        for ws in group:
+            try:
+                await send_frame(ws, frame, type_)
+            except Exception as e:
+                print(f"[WS] send error: {e}")
+    return len(sockets)
+
+
+def plan_delivery(conversation_id=None, participants=(), user_ids=(), exclude_user_ids=()):
+    """
+    Target sockets for one event, each at most once:
+    sockets in the conversation's room + sockets of online `participants` and
+    `user_ids`, minus sockets of `exclude_user_ids`.
+    """
+    targets = {}  # dict as an ordered set
+    candidates = 0
+    for ws in rooms.get(conversation_id, ()) if conversation_id else ():
+        candidates += 1
+        targets[ws] = None
+    for uid in chain(participants, user_ids):
+        ws = user_ws.get(uid)
+        if ws is not None:
+            candidates += 1
+            targets[ws] = None
+    delivery_stats["duplicates_avoided"] += candidates - len(targets)
+    if exclude_user_ids:
+        return [ws for ws in targets if ws_user.get(ws) not in exclude_user_ids]
+    return list(targets)
+
+
+async def deliver(type_: str, data: dict, conversation_id=None, participants=(), user_ids=(), exclude_user_ids=()):
+    """Plan the targets of an event and send it once per socket. Returns the number of frames queued."""
+    targets = plan_delivery(conversation_id, participants, user_ids, exclude_user_ids)
+    delivery_stats["events"] += 1
+    delivery_stats["frames"] += len(targets)
+    return await fan_out(targets, type_, data)
+
+
+ROOM_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+QUEUE_DEPTH_BUCKETS = (0, 1, 4, 16, 64, WS_QUEUE_SIZE)
+
+
+def _distribution(values, bounds):
+    """Cumulative counts of values <= each bound (+Inf last), as gauge samples"""
+    values = sorted(values)
+    samples, i = [], 0
+    for bound in bounds:
+        while i < len(values) and values[i] <= bound:
+            i += 1
+        samples.append(({"le": str(bound)}, i))
+    samples.append(({"le": "+Inf"}, len(values)))
+    return samples
+
+
+@metrics.register_collector
+def _registry_metrics():
+    queues = [queue.stats() for queue in outbound.values()]
+    return [
+        ("chat_ws_connections", "gauge", "Open WebSocket connections", [({}, len(outbound))]),
+        ("chat_ws_authenticated_users", "gauge", "Authenticated users online", [({}, len(user_ws))]),
+        ("chat_rooms", "gauge", "Conversations with at least one joined socket", [({}, len(rooms))]),
+        ("chat_room_sockets", "gauge", "Rooms with at most `le` joined sockets", _distribution(map(len, rooms.values()), ROOM_SIZE_BUCKETS)),
+        ("chat_outbound_queue_depth", "gauge", "Sockets with at most `le` frames waiting to be sent", _distribution((q["depth"] for q in queues), QUEUE_DEPTH_BUCKETS)),
+        ("chat_outbound_queued_frames", "gauge", "Frames waiting in outbound queues", [({}, sum(q["depth"] for q in queues))]),
+        ("chat_outbound_dropped_frames", "gauge", "Frames dropped by the outbound queues of open sockets", [({}, sum(q["dropped"] for q in queues))]),
+        ("chat_delivery_events_total", "counter", "Events sent with deliver()", [({}, delivery_stats["events"])]),
+        ("chat_delivery_frames_total", "counter", "Frames queued by deliver()", [({}, delivery_stats["frames"])]),
+        ("chat_delivery_duplicates_avoided_total", "counter", "Sockets reached twice by a delivery plan and sent once", [({}, delivery_stats["duplicates_avoided"])]),
+    ]
@@ -0,0 +1,151 @@
+# loop_watchdog.py
+"""
+Event-loop stall detector (opt-in: LOOP_WATCHDOG_MS > 0).
+
+A heartbeat task on the loop wakes up every HEARTBEAT seconds and measures
+how late it was (loop lag). A daemon thread watches the heartbeat: when the
+loop has not beaten for LOOP_WATCHDOG_MS, something is running without
+yielding (a blocking call, a long CPU loop), so the thread grabs the loop
+thread's stack (sys._current_frames) while it is still stuck there.
+
+The WS loop tags its frame with the message being handled (`set_context`);
+a stall whose stack goes through a tagged frame is reported with that
+message's type and request_id.
+
+Reports (newest last, the LOOP_WATCHDOG_REPORTS most recent) are served at
+/debug/stalls; counters and the lag histogram are in /metrics.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+import metrics
+
+LOOP_WATCHDOG_MS = int(os.getenv("LOOP_WATCHDOG_MS", "0"))
+LOOP_WATCHDOG_REPORTS = int(os.getenv("LOOP_WATCHDOG_REPORTS", "50"))
+THRESHOLD = LOOP_WATCHDOG_MS / 1000
+HEARTBEAT = min(THRESHOLD / 2, 0.1)
+STACK_LIMIT = 40  # innermost frames kept per report
+
+enabled = THRESHOLD > 0
+reports = deque(maxlen=LOOP_WATCHDOG_REPORTS)
+stall_stats = {"stalls": 0, "captured": 0, "stall_seconds": 0.0, "max_stall_seconds": 0.0}
+loop_lag_seconds = metrics.Histogram(
+    "chat_loop_lag_seconds", "Event loop lag measured by the watchdog heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+_contexts = {}         # id(frame) -> (frame, tags)
+_last_beat = 0.0       # perf_counter() of the last heartbeat
+_beat = 0              # heartbeat number, so one stall is captured once
+_open_report = None    # report captured by the thread, waiting for the stall to end
+_heartbeat_task = None
+_stop = threading.Event()
+
+
+def set_context(**tags):
+    """Tag the caller's frame (e.g. type / request_id of the WS message being handled)"""
+    if enabled:
+        frame = sys._getframe(1)
+        _contexts[id(frame)] = (frame, tags)
+
+
+def clear_context():
+    if enabled:
+        _contexts.pop(id(sys._getframe(1)), None)
+
+
+def start():
+    """Start the heartbeat + watcher thread (no-op unless LOOP_WATCHDOG_MS is set)"""
+    global _heartbeat_task, _last_beat
+    if not enabled or _heartbeat_task is not None:
+        return
+    _stop.clear()
+    _last_beat = time.perf_counter()
+    _heartbeat_task = asyncio.create_task(_heartbeat())
+    loop_thread = threading.get_ident()
+    threading.Thread(target=_watch, args=(loop_thread,), name="loop-watchdog", daemon=True).start()
+    print(f"[Watchdog] Reporting event loop stalls over {LOOP_WATCHDOG_MS} ms")
+
+
+def stop():
+    global _heartbeat_task
+    _stop.set()
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+        _heartbeat_task = None
+
+
+async def _heartbeat():
+    global _last_beat, _beat, _open_report
+    while True:
+        await asyncio.sleep(HEARTBEAT)
+        now = time.perf_counter()
+        lag = max(0.0, now - _last_beat - HEARTBEAT)
+        _last_beat = now
+        _beat += 1
+        loop_lag_seconds.observe(lag)
+        if lag < THRESHOLD:
+            continue
+
+        report, _open_report = _open_report, None
+        if report is None:
+            # Too short for the thread to catch it in the act: no stack
+            report = {"at": int(time.time() * 1000), "stack": None, "tags": {}}
+            reports.append(report)
+        report["duration_ms"] = round(lag * 1000, 1)
+        stall_stats["stalls"] += 1
+        stall_stats["stall_seconds"] += lag
+        stall_stats["max_stall_seconds"] = max(stall_stats["max_stall_seconds"], lag)
+        tags = report["tags"]
+        print(f"[Watchdog] Event loop blocked for {report['duration_ms']} ms"
+              + (f" handling {tags}" if tags else "")
+              + (f" at {report['stack'][-1].strip()}" if report["stack"] else ""))
+
+
+def _watch(loop_thread):
+    global _open_report
+    captured_beat = -1
+    while not _stop.wait(THRESHOLD / 2):
+        if _beat == captured_beat or time.perf_counter() - _last_beat < THRESHOLD + HEARTBEAT:
+            continue
+        frame = sys._current_frames().get(loop_thread)
+        if frame is None:
+            continue
+        captured_beat = _beat
+        _open_report = _capture(frame)
+        reports.append(_open_report)
+        stall_stats["captured"] += 1
+
+
+def _capture(frame):
+    tags = {}
+    f = frame
+    while f is not None:
+        context = _contexts.get(id(f))
+        if context is not None and context[0] is f:
+            tags = context[1]
+            break
+        f = f.f_back
+    stack = traceback.format_list(traceback.extract_stack(frame, limit=STACK_LIMIT))
+    return {
+        "at": int(time.time() * 1000),
+        "duration_ms": None,  # set when the loop gets going again
+        "tags": {k: v for k, v in tags.items() if v is not None},
+        "stack": stack
+    }
+
+
+@metrics.register_collector
+def _stall_metrics():
+    if not enabled:
+        return []
+    return [
+        ("chat_loop_stalls_total", "counter", f"Event loop stalls over {LOOP_WATCHDOG_MS} ms", [({}, stall_stats["stalls"])]),
+        ("chat_loop_stalls_captured_total", "counter", "Stalls whose stack was captured while blocked", [({}, stall_stats["captured"])]),
+        ("chat_loop_stall_seconds_total", "counter", "Time the event loop spent blocked in stalls", [({}, stall_stats["stall_seconds"])]),
+        ("chat_loop_max_stall_seconds", "gauge", "Longest stall since start", [({}, stall_stats["max_stall_seconds"])]),
+    ]
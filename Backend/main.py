@@ -1,26 +1,54 @@
 
-import json, time, os, shutil
-from pathlib import Path
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Body, File, UploadFile, Form
+import time, os, hmac
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body, Request
+from starlette.requests import ClientDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from models import MessageModel, ConversationModel, UserModel, FriendModel
+from models import MessageModel, ConversationModel, UserModel, FriendModel, UserExists
+from schema import ensure_indexes
+from presence import PresenceCoalescer
+from outbound import OutboundQueue
+from fanout import rooms, ws_user, user_ws, outbound, encodings, ws_send, deliver
+from codec import JSON, negotiate, decode_frame
+from membership import MembershipCache
+from uploads import UPLOAD_DIR, receive_upload, discard_upload
+from attachments import AttachmentStore, attachment_url
+from downloads import serve_upload
+import previews
+import resumable
+import metrics
+import loop_watchdog
+from ws_dispatch import ws_handler, handlers, Dispatcher, by_conversation, by_user, SERIAL
 from bson import ObjectId
-from db import db
+from db import async_client, async_db
 from auth import create_access_token, create_refresh_token, verify_token, verify_password, verify_refresh_token
 
+# Enables the admin endpoints (X-Admin-Token header) when set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Bearer token for /metrics (required when set, else direct local clients only); /debug/stalls needs it
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+MAX_BULK_USERS = 10000
+
 # Import collections
-conversations_collection = db['conversations']
+conversations_collection = async_db['conversations']
 
 app = FastAPI()
 
 # Create uploads directory if it doesn't exist
-UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+@app.on_event("startup")
+async def startup():
+    loop_watchdog.start()
+    await ensure_indexes()
+
+@app.on_event("shutdown")
+async def shutdown():
+    loop_watchdog.stop()
+    previews.shutdown()
+    await async_client.close()
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -47,24 +75,42 @@ class LoginRequest(BaseModel):
 
 # --- REST API Endpoints ---
 @app.post("/api/register")
-def register(req: RegisterRequest):
+async def register(req: RegisterRequest):
     # Use email as user ID
     uid = req.email.lower().strip()
-    
-    # Check if email already exists
-    if UserModel.get_user(uid):
-        raise HTTPException(status_code=400, detail="Email already exists")
-    
-    # Check if username already exists
-    if UserModel.get_user_by_username(req.username):
-        raise HTTPException(status_code=400, detail="Username already exists")
-        
-    user = UserModel.create_user(uid, req.username, req.email, req.password)
+
+    # Email / username uniqueness is enforced by the unique indexes (no check-then-insert race)
+    try:
+        await UserModel.create_user(uid, req.username, req.email, req.password)
+    except UserExists as e:
+        raise HTTPException(status_code=400, detail="Email already exists" if e.field == "email" else "Username already exists")
     return {"status": "ok", "user_id": uid, "message": "User registered successfully"}
 
+
+class BulkUsersRequest(BaseModel):
+    users: list[RegisterRequest]
+
+
+def require_admin(request: Request):
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.post("/api/admin/users/bulk")
+async def create_users_bulk(req: BulkUsersRequest, request: Request):
+    """Provision accounts in batches (load tests, imports). Existing emails / usernames are reported, not overwritten."""
+    require_admin(request)
+    if len(req.users) > MAX_BULK_USERS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_USERS} users per request")
+    result = await UserModel.create_users_bulk([user.model_dump() for user in req.users])
+    return {"status": "ok", "created": len(result["created"]), "conflicts": result["conflicts"]}
+
 @app.post("/api/login")
-def login(req: LoginRequest):
-    user = UserModel.authenticate(req.username, req.password)
+async def login(req: LoginRequest):
+    user = await UserModel.authenticate(req.username, req.password)
     
     if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
@@ -85,7 +131,7 @@ class RefreshRequest(BaseModel):
     refresh_token: str
 
 @app.post("/api/refresh")
-def refresh(req: RefreshRequest):
+async def refresh(req: RefreshRequest):
     """Refresh access token using refresh token"""
     payload = verify_refresh_token(req.refresh_token)
     
@@ -97,7 +143,7 @@ def refresh(req: RefreshRequest):
         raise HTTPException(status_code=401, detail="Invalid refresh token")
     
     # Verify user still exists
-    user = UserModel.get_user(user_id)
+    user = await UserModel.get_user(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     
@@ -126,593 +172,749 @@ async def get_current_user(authorization: str = None):
     
     return user_id
 
+async def require_member(conversation_id, user_id):
+    """400 / 403 unless user_id is a participant of the conversation"""
+    try:
+        conv_oid = ObjectId(conversation_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid conversation_id")
+    if user_id not in await membership.get(conversation_id):
+        raise HTTPException(status_code=403, detail="Not a member of this conversation")
+    return conv_oid
+
+async def attachment_response(doc, file_name):
+    return {
+        "status": "ok",
+        "file_url": attachment_url(doc),
+        "file_name": file_name,
+        "file_size": doc["size"],
+        "sha256": doc["_id"],
+        # images: dimensions + preview variants (rendered in the background, see previews.py)
+        "image": await AttachmentStore.image_info(doc)
+    }
+
 @app.post("/api/upload")
-async def upload_file(
-    file: UploadFile = File(...),
-    conversation_id: str = Form(...),
-    text: str = Form(None),
-    authorization: str = Depends(lambda: None)  # Will be extracted manually
-):
-    """Upload file endpoint"""
-    from fastapi import Request, Header
-    from typing import Optional
-    
-    # Get token from header (manual extraction since Depends doesn't work well with form data)
-    async def inner(request: Request, auth_header: Optional[str] = Header(None, alias="Authorization")):
-        if not auth_header or not auth_header.startswith("Bearer "):
-            raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
-        
-        token = auth_header.split(" ")[1]
-        payload = verify_token(token)
-        
-        if not payload:
-            raise HTTPException(status_code=401, detail="Invalid or expired token")
-        
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        return user_id
-    
-    # For now, we'll handle auth in a simpler way
-    # In production, you'd want proper dependency injection
-    
+async def upload_file(request: Request):
+    """
+    Upload file endpoint (multipart: file, conversation_id, text).
+    Streamed to disk (uploads.py), stored once per content (attachments.py).
+    conversation_id may also be given in the query string: it is then checked
+    before the body is read.
+    """
+    # Auth before reading the body, so rejected uploads cost nothing
+    user_id = await get_current_user(request.headers.get("Authorization"))
+    conversation_id = request.query_params.get("conversation_id")
+    if conversation_id:
+        await require_member(conversation_id, user_id)
+
     try:
-        # Create unique filename
-        timestamp = int(time.time() * 1000)
-        file_extension = Path(file.filename).suffix
-        unique_filename = f"{timestamp}_{file.filename}"
-        file_path = UPLOAD_DIR / unique_filename
-        
-        # Save file
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Generate URL
-        file_url = f"http://localhost:8000/uploads/{unique_filename}"
-        
-        return {
-            "status": "ok",
-            "file_url": file_url,
-            "file_name": file.filename,
-            "file_size": file_path.stat().st_size
-        }
+        upload = await receive_upload(request)
+    except HTTPException:
+        raise
+    except ClientDisconnect:
+        raise HTTPException(status_code=400, detail="Upload interrupted")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
+
+    try:
+        conv_oid = await require_member(conversation_id or upload["fields"].get("conversation_id"), user_id)
+        doc = await AttachmentStore.put(upload, conv_oid)
+    except HTTPException:
+        await discard_upload(upload)
+        raise
     except Exception as e:
+        await discard_upload(upload)
         raise HTTPException(status_code=500, detail=f"File upload failed: {str(e)}")
 
+    return await attachment_response(doc, upload["file_name"])
 
-# --- WebSocket Global State ---
-rooms = {} 
-ws_user = {} 
-user_ws = {} 
 
-def now_ms():
-    return int(time.time() * 1000)
+# --- Resumable (chunked) uploads, see resumable.py ---
+class ResumableUploadRequest(BaseModel):
+    conversation_id: str
+    file_name: str
+    size: int
+    content_type: str = None
+    chunk_size: int = None
 
-async def ws_send(ws: WebSocket, type_: str, data: dict, request_id=None):
+@app.post("/api/uploads")
+async def initiate_upload(req: ResumableUploadRequest, request: Request):
+    user_id = await get_current_user(request.headers.get("Authorization"))
+    await require_member(req.conversation_id, user_id)
+    return await resumable.initiate(user_id, req.conversation_id, req.file_name, req.size, req.content_type, req.chunk_size)
+
+@app.get("/api/uploads/{upload_id}")
+async def upload_status(upload_id: str, request: Request):
+    user_id = await get_current_user(request.headers.get("Authorization"))
+    return await resumable.status(upload_id, user_id)
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request):
+    user_id = await get_current_user(request.headers.get("Authorization"))
     try:
-        payload = {
-            "type": type_,
-            "data": data,
-            "request_id": request_id,
-            "ts": now_ms()
-        }
-        try:
-            text = json.dumps(payload)
-        except TypeError:
-            text = json.dumps(payload, default=str)
-        await ws.send_text(text)
-    except Exception as e:
-        print(f"[WS] send error: {e}")
+        return await resumable.put_chunk(upload_id, user_id, index, request)
+    except ClientDisconnect:
+        raise HTTPException(status_code=400, detail="Upload interrupted")
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, request: Request):
+    user_id = await get_current_user(request.headers.get("Authorization"))
+
+    async def store(upload, meta):
+        conv_oid = await require_member(meta["conversation_id"], user_id)
+        return await AttachmentStore.put(upload, conv_oid), upload["file_name"]
+
+    doc, file_name = await resumable.complete(upload_id, user_id, store)
+    return await attachment_response(doc, file_name)
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload(upload_id: str, request: Request):
+    user_id = await get_current_user(request.headers.get("Authorization"))
+    await resumable.status(upload_id, user_id)  # 404 unless it is the caller's
+    await resumable.discard(upload_id)
+    return {"status": "ok"}
+
+
+@app.api_route("/uploads/{path:path}", methods=["GET", "HEAD"])
+async def download_file(path: str, request: Request):
+    """Uploaded files: Range, ETag / 304, immutable caching for content-addressed ones (downloads.py)"""
+    return await serve_upload(request, path)
+
+
+class AttachmentLookupRequest(BaseModel):
+    sha256: str
+    conversation_id: str
+    file_name: str = None
+
+@app.post("/api/attachments/lookup")
+async def lookup_attachment(req: AttachmentLookupRequest, request: Request):
+    """
+    Dedupe before uploading: if the server already stores this content, reference
+    it for the conversation and return its URL (404 = upload it).
+    """
+    user_id = await get_current_user(request.headers.get("Authorization"))
+    sha256 = req.sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise HTTPException(status_code=400, detail="Invalid sha256")
+    conv_oid = await require_member(req.conversation_id, user_id)
+    doc = await AttachmentStore.lookup(sha256, conv_oid)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Unknown content")
+    return await attachment_response(doc, req.file_name)
+
+
+def now_ms():
+    return int(time.time() * 1000)
 
 async def broadcast(conversation_id: str, type_: str, data: dict, exclude_sender_id: str = None):
     """Broadcast message to all in room, optionally excluding sender"""
-    for ws in list(rooms.get(conversation_id, set())):
-        try:
-            # Skip sender if exclude_sender_id is provided
-            if exclude_sender_id and ws_user.get(ws) == exclude_sender_id:
-                continue
-            await ws_send(ws, type_, data)
-        except:
-            pass
-
-async def notify_participants(conversation_id: str, type_: str, data: dict, exclude_user_id: str = None):
-    """Send event to all participants whether or not they're in the room"""
-    conv = conversations_collection.find_one({"_id": ObjectId(conversation_id)}) if len(conversation_id) == 24 else None
-    participants = conv.get("participants", []) if conv else []
-    for pid in participants:
-        if exclude_user_id and pid == exclude_user_id:
-            continue
-        ws = user_ws.get(pid)
-        if ws:
-            await ws_send(ws, type_, data)
+    await deliver(type_, data, conversation_id, exclude_user_ids={exclude_sender_id} if exclude_sender_id else ())
+
+membership = MembershipCache()
+
+@metrics.register_collector
+def _membership_metrics():
+    return [
+        ("chat_membership_cache_requests_total", "counter", "Membership cache lookups by result", [
+            ({"result": "hit"}, membership.hits), ({"result": "miss"}, membership.misses)
+        ]),
+        ("chat_membership_cache_entries", "gauge", "Conversations in the membership cache", [({}, len(membership))]),
+    ]
+
+presence = PresenceCoalescer(ws_send)
+presence_audience = {}  # user_id -> contact ids that see their presence (loaded at auth, see link/refresh_presence)
+
+def link_presence(*user_ids):
+    """Make online users see each other's presence (new friend / new group member)"""
+    for uid in user_ids:
+        if uid in presence_audience:
+            presence_audience[uid].update(u for u in user_ids if u != uid)
+
+async def refresh_presence(*user_ids):
+    """Reload the audience of online users who lost a shared conversation (member removed / conversation deleted)"""
+    for uid in set(user_ids):
+        if uid in presence_audience:
+            contacts = await UserModel.get_contact_ids(uid)
+            if uid in presence_audience:  # not disconnected meanwhile
+                presence_audience[uid] = contacts
 
 async def broadcast_presence(user_id: str, online: bool, last_seen=None):
-    """Notify all connected clients about presence change."""
-    payload = {"user_id": user_id, "online": online}
-    if last_seen:
-        payload["last_seen"] = last_seen
-    for ws in list(ws_user.keys()):
-        try:
-            await ws_send(ws, "presence_update", payload)
-        except:
-            pass
+    """Notify the user's friends and conversation members about presence change (coalesced)."""
+    payload = {"user_id": user_id, "online": online, "last_seen": last_seen}
+    audience = presence_audience.get(user_id, ())
+    presence.publish([user_ws[uid] for uid in audience if uid in user_ws], payload)
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+PROXY_HEADERS = ("forwarded", "x-forwarded-for", "x-real-ip")
+
+def require_local_or_token(request: Request):
+    """
+    METRICS_TOKEN as bearer token when it is set; otherwise only direct
+    loopback clients (behind a local reverse proxy every request looks local,
+    so proxied requests never count as local).
+    """
+    if METRICS_TOKEN:
+        authorized = hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()
+        )
+    else:
+        proxied = any(header in request.headers for header in PROXY_HEADERS)
+        authorized = not proxied and request.client is not None and request.client.host in ("127.0.0.1", "::1", "localhost")
+    if not authorized:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.get("/metrics")
+def get_metrics(request: Request):
+    """Prometheus scrape endpoint (see metrics.py)"""
+    require_local_or_token(request)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/stalls")
+def get_stalls(request: Request):
+    """
+    Recent event loop stalls with the blocked stack (LOOP_WATCHDOG_MS, see loop_watchdog.py).
+    Stack traces are never served on loopback trust alone: only with METRICS_TOKEN set, and the token.
+    """
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    require_local_or_token(request)
+    return {
+        "enabled": loop_watchdog.enabled,
+        "threshold_ms": loop_watchdog.LOOP_WATCHDOG_MS,
+        "stats": loop_watchdog.stall_stats,
+        "stalls": list(loop_watchdog.reports)
+    }
+
+# --- WebSocket message handlers (registered in ws_dispatch.handlers) ---
+
+# --- AUTH (Modified for JWT) ---
+@ws_handler("auth", inline=True)
+async def handle_auth(ws, sender_id, data, request_id):
+    token = data.get("token")
+    user_id = data.get("user_id") # Fallback or initial handshake?
+
+    # Verify Token
+    payload = None
+    if token:
+        payload = verify_token(token)
+
+    if payload:
+        user_id = payload.get("sub")
+    else:
+        # If no valid token, fail
+        await ws_send(ws, "error", {"code": "UNAUTH", "message": "Invalid or missing token"}, request_id)
+        return
+
+    ws_user[ws] = user_id
+    user_ws[user_id] = ws
+
+    await ws_send(ws, "auth_ok", {"user_id": user_id}, request_id)
+    # Broadcast presence online (friends + conversation members only)
+    presence_audience[user_id] = await UserModel.get_contact_ids(user_id)
+    await broadcast_presence(user_id, True)
+
+
+# --- GET OR CREATE DIRECT CONVERSATION ---
+@ws_handler("get_direct_conversation", order=by_user("other_user_id"))
+async def handle_get_direct_conversation(ws, sender_id, data, request_id):
+    other_user_id = data.get("other_user_id")
+    if not other_user_id:
+        return
+
+    # tìm user
+    target_user_id = None
+    if await UserModel.get_user(other_user_id):
+        target_user_id = other_user_id
+    else:
+        user_doc = await UserModel.get_user_by_username(other_user_id)
+        if user_doc:
+            target_user_id = user_doc.get("_id")
+
+    if not target_user_id:
+        await ws_send(ws, "error", {"code": "USER_NOT_FOUND", "message": "User không tồn tại"}, request_id)
+        return
+
+    conv = await ConversationModel.create_or_get_direct_conversation(sender_id, target_user_id, initiator_id=sender_id)
+    membership.set(conv["_id"], conv.get("participants", []))
+    link_presence(sender_id, target_user_id)
+
+    # Notify recipient if new and pending
+    if conv.get('status') == 'pending' and conv.get('initiator') == sender_id:
+        recipient_ws = user_ws.get(target_user_id)
+        if recipient_ws:
+            await ws_send(recipient_ws, "new_conversation", {"conversation": conv})
+
+    await ws_send(ws, "direct_conversation", {"conversation": conv}, request_id)
+
+
+# --- GET USER CONVERSATIONS ---
+@ws_handler("get_conversations", order=SERIAL)
+async def handle_get_conversations(ws, sender_id, data, request_id):
+    convs = await ConversationModel.get_user_conversations(sender_id)
+    await ws_send(ws, "conversations_list", {"conversations": convs}, request_id)
+
+
+# --- JOIN ROOM ---
+@ws_handler("join", order=by_conversation)
+async def handle_join(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    if conv_id:
+        rooms.setdefault(conv_id, set()).add(ws)
+        await ws_send(ws, "join_ok", {"conversation_id": conv_id}, request_id)
+
+
+# --- LOAD MESSAGES ---
+@ws_handler("load_messages", order=lambda data: ("load_messages", str(data.get("conversation_id"))))
+async def handle_load_messages(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    if conv_id:
+        if data.get("before") not in (None, "") and data.get("after") not in (None, ""):
+            await ws_send(ws, "error", {"code": "BAD_REQUEST", "message": "Use either before or after, not both"}, request_id)
+            return
+        try:
+            # Optional cursors: before/after = seq or message id, limit = page size
+            page = await MessageModel.get_message_page(
+                conv_id,
+                before=data.get("before"),
+                after=data.get("after"),
+                limit=data.get("limit") or 50,
+                viewer_id=sender_id
+            )
+            await ws_send(ws, "messages_loaded", {
+                "conversation_id": conv_id,
+                "messages": page["messages"],
+                "has_more": page["has_more"],
+                "next_cursor": page["next_cursor"],
+                "before": data.get("before"),
+                "after": data.get("after")
+            }, request_id)
+        except Exception as e:
+            print(f"[WS] load_messages error: {e}")
+            await ws_send(ws, "error", {
+                "code": "LOAD_MESSAGES_ERROR",
+                "message": str(e)
+            }, request_id)
+
+
+# --- RECEIPT  ---
+@ws_handler("receipt")
+async def handle_receipt(ws, sender_id, data, request_id):
+    await ws_send(ws, "info", {"message": "receipts_disabled"}, request_id)
+
+
+# --- PIN MESSAGE ---
+@ws_handler("pin_message", order=by_conversation)
+async def handle_pin_message(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    message_id = data.get("message_id")
+    result = await ConversationModel.pin_message(conv_id, message_id, sender_id)
+    if result.get("status") == "success":
+        payload = {
+            "conversation_id": conv_id,
+            "pinned_message": result.get("pinned_message"),
+            "pinned_messages": result.get("pinned_messages")
+        }
+        await deliver("pinned_message_updated", payload, conv_id, await membership.get(conv_id))
+    else:
+        await ws_send(ws, "error", {"code": "PIN_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- UNPIN MESSAGE ---
+@ws_handler("unpin_message", order=by_conversation)
+async def handle_unpin_message(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    # message_id optional: without it the latest pin is removed
+    result = await ConversationModel.unpin_message(conv_id, data.get("message_id"))
+    if result.get("status") == "success":
+        payload = {
+            "conversation_id": conv_id,
+            "pinned_message": result.get("pinned_message"),
+            "pinned_messages": result.get("pinned_messages")
+        }
+        await deliver("pinned_message_updated", payload, conv_id, await membership.get(conv_id))
+    else:
+        await ws_send(ws, "error", {"code": "UNPIN_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- SEND MESSAGE ---
+@ws_handler("send_message", order=by_conversation)
+async def handle_send_message(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    client_msg_id = data.get("client_msg_id")
+    msg_type = data.get("msg_type", "text")
+    text = data.get("text", "")
+    file_url = data.get("file_url")
+    file_name = data.get("file_name")
+    file_size = data.get("file_size")
+
+    if not conv_id or not client_msg_id: return
+
+    # Image dimensions + preview variants, so clients can load a small one first
+    image = None
+    if file_url and msg_type == "image":
+        attachment = await AttachmentStore.find_by_url(file_url)
+        if attachment:
+            image = await AttachmentStore.image_info(attachment)
+
+    # INSERT message into db (conversation)
+    saved_msg = await MessageModel.insert_message(
+        conv_id, sender_id, text, msg_type,
+        file_url=file_url, file_name=file_name, file_size=file_size, image=image
+    )
+
+    if not saved_msg:
+
+        return
+
+    server_msg_id = saved_msg['_id']
+
+    # Add status field for frontend
+    saved_msg['status'] = 'sent'
+
+    # Ack
+    await ws_send(ws, "send_ack", {
+        "conversation_id": conv_id,
+        "client_msg_id": client_msg_id,
+        "server_msg_id": server_msg_id,
+        "status": "sent",
+        "created_at": saved_msg["created_at"]
+    }, request_id)
+
+    # Room (sender included so UI updates immediately) + other participants
+    # not in the room; membership from cache, no query
+    participants = await membership.get(conv_id)
+    await deliver("new_message", {
+        "conversation_id": conv_id,
+        "message": saved_msg
+    }, conv_id, [pid for pid in participants if pid != sender_id])
+
+
+# --- SEARCH USERS ---
+@ws_handler("search_users", order=SERIAL)
+async def handle_search_users(ws, sender_id, data, request_id):
+    query = data.get("query", "")
+    users = await UserModel.search_users(query, viewer_id=sender_id)
+    await ws_send(ws, "search_results", {"query": query, "users": users}, request_id)
+
+
+# --- SEND FRIEND REQUEST ---
+@ws_handler("send_friend_request", order=by_user("to_user_id"))
+async def handle_send_friend_request(ws, sender_id, data, request_id):
+    to_user_id = data.get("to_user_id")
+    if to_user_id:
+        target_user_id = None
+        # Try exact user_id first
+        if await UserModel.get_user(to_user_id):
+            target_user_id = to_user_id
+        else:
+            # Fallback to username lookup
+            user_doc = await UserModel.get_user_by_username(to_user_id)
+            if user_doc:
+                target_user_id = user_doc.get("_id")
+
+        if not target_user_id:
+            await ws_send(ws, "error", {"code": "USER_NOT_FOUND", "message": "User không tồn tại"}, request_id)
+            return
+
+        result = await FriendModel.send_friend_request(sender_id, target_user_id)
+        if result.get("status") == "error":
+            err_msg = result.get("message", "Lỗi khi gửi lời mời kết bạn")
+            err_code = "USER_NOT_FOUND" if "không tồn tại" in err_msg.lower() else "FRIEND_REQUEST_ERROR"
+            await ws_send(ws, "error", {"code": err_code, "message": err_msg}, request_id)
+        else:
+            await ws_send(ws, "friend_request_sent", result, request_id)
+            # Notify
+            recipient_ws = user_ws.get(target_user_id)
+            if recipient_ws:
+                await ws_send(recipient_ws, "friend_request_received", {"from_user_id": sender_id})
+
+
+# --- ACCEPT FRIEND REQUEST ---
+@ws_handler("accept_friend_request", order=by_user("from_user_id"))
+async def handle_accept_friend_request(ws, sender_id, data, request_id):
+    from_user_id = data.get("from_user_id")
+    if from_user_id:
+        success = await FriendModel.accept_friend_request(sender_id, from_user_id)
+        await ws_send(ws, "friend_request_accepted", {"success": success, "friend_id": from_user_id}, request_id)
+
+        if success:
+            link_presence(sender_id, from_user_id)
+            # Notify the sender
+            sender_ws = user_ws.get(from_user_id)
+            if sender_ws:
+                await ws_send(sender_ws, "friend_accepted", {"user_id": sender_id})
+
+            # Send updated conversation lists to both users so status changes from pending to accepted
+            convs_acceptor = await ConversationModel.get_user_conversations(sender_id)
+            await ws_send(ws, "conversations_list", {"conversations": convs_acceptor}, "r_refresh_after_friend")
+
+            if sender_ws:
+                convs_sender = await ConversationModel.get_user_conversations(from_user_id)
+                await ws_send(sender_ws, "conversations_list", {"conversations": convs_sender}, "r_refresh_after_friend")
+
+
+# --- CLOSE/ACCEPT CONVERSATION ---
+@ws_handler("accept_conversation", order=by_conversation)
+async def handle_accept_conversation(ws, sender_id, data, request_id):
+    conv_id = data.get("conversation_id")
+    if conv_id:
+        await ConversationModel.accept_conversation(conv_id)
+        await ws_send(ws, "conversation_accepted", {"conversation_id": conv_id}, request_id)
+
+
+# --- GET FRIENDS LIST ---
+@ws_handler("get_friends", order=SERIAL)
+async def handle_get_friends(ws, sender_id, data, request_id):
+    # Online status comes straight from the connection registry;
+    # optional offset/limit for very large friend lists
+    page = await FriendModel.get_friends_page(
+        sender_id, user_ws,
+        offset=data.get("offset") or 0,
+        limit=data.get("limit")
+    )
+    await ws_send(ws, "friends_list", page, request_id)
+
+
+# --- GET FRIEND REQUESTS  ---
+@ws_handler("get_friend_requests", order=SERIAL)
+async def handle_get_friend_requests(ws, sender_id, data, request_id):
+    # Returns { received: [], sent: [] }
+    requests = await FriendModel.get_pending_requests(sender_id)
+    await ws_send(ws, "friend_requests", requests, request_id)
+
+
+# --- REJECT FRIEND REQUEST ---
+@ws_handler("reject_friend_request", order=by_user("from_user_id"))
+async def handle_reject_friend_request(ws, sender_id, data, request_id):
+    from_user_id = data.get("from_user_id")
+    if from_user_id:
+        try:
+            print(f"[WS] Rejecting friend request: {sender_id} rejecting {from_user_id}")
+            success = await FriendModel.reject_friend_request(sender_id, from_user_id)
+            print(f"[WS] Reject result: {success}")
+            await ws_send(ws, "friend_request_rejected", {"success": success, "user_id": from_user_id}, request_id)
+
+            if success:
+                sender_ws = user_ws.get(from_user_id)
+                if sender_ws:
+                    await ws_send(sender_ws, "friend_rejected", {"user_id": sender_id})
+        except Exception as e:
+            print(f"[WS] Error rejecting friend request: {e}")
+            import traceback
+            traceback.print_exc()
+            await ws_send(ws, "error", {"code": "REJECT_ERROR", "message": str(e)}, request_id)
+
+
+# --- CREATE GROUP CONVERSATION ---
+@ws_handler("create_group")
+async def handle_create_group(ws, sender_id, data, request_id):
+    name = data.get("name", "")
+    member_ids = data.get("member_ids", [])
+
+    result = await ConversationModel.create_group_conversation(sender_id, name, member_ids)
+
+    if result.get("status") == "success":
+        conversation = result["conversation"]
+        membership.set(conversation["_id"], conversation.get("participants", []))
+        await ws_send(ws, "group_created", {"conversation": conversation}, request_id)
+        link_presence(*conversation.get("participants", []))
+
+        # Notify all members
+        await deliver("new_conversation", {"conversation": conversation},
+                      user_ids=conversation.get("participants", []), exclude_user_ids={sender_id})
+    else:
+        await ws_send(ws, "error", {"code": "CREATE_GROUP_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- ADD GROUP MEMBER ---
+@ws_handler("add_group_member", order=by_conversation)
+async def handle_add_group_member(ws, sender_id, data, request_id):
+    conversation_id = data.get("conversation_id")
+    new_member_id = data.get("member_id")
+
+    if conversation_id and new_member_id:
+        result = await ConversationModel.add_group_member(conversation_id, sender_id, new_member_id)
+        membership.invalidate(conversation_id)
+
+        if result.get("status") == "success":
+            await ws_send(ws, "member_added", {"conversation_id": conversation_id, "member_id": new_member_id}, request_id)
+
+            # Notify the new member
+            member_ws = user_ws.get(new_member_id)
+            if member_ws:
+                # Get updated conversation info
+                conv = await conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
+                if conv:
+                    conv['_id'] = str(conv['_id'])
+                    if conv.get('created_at'):
+                        conv['created_at'] = int(conv['created_at'].timestamp() * 1000)
+                    await ws_send(member_ws, "new_conversation", {"conversation": conv})
+
+            # Broadcast to all members in the room
+            await broadcast(conversation_id, "member_added", {"member_id": new_member_id, "added_by": sender_id, "conversation_id": conversation_id})
+
+            # Broadcast updated conversation metadata to refresh participant list
+            conv = await conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
+            if conv:
+                link_presence(*conv.get("participants", []))
+                conv['_id'] = str(conv['_id'])
+                if conv.get('created_at'):
+                    conv['created_at'] = int(conv['created_at'].timestamp() * 1000)
+                if conv.get('last_message') and conv['last_message'].get('created_at'):
+                    conv['last_message']['created_at'] = int(conv['last_message']['created_at'].timestamp() * 1000)
+                await deliver("conversation_updated", {"conversation": conv}, conversation_id, conv.get("participants", []))
+        else:
+            await ws_send(ws, "error", {"code": "ADD_MEMBER_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- REMOVE GROUP MEMBER ---
+@ws_handler("remove_group_member", order=by_conversation)
+async def handle_remove_group_member(ws, sender_id, data, request_id):
+    conversation_id = data.get("conversation_id")
+    member_id = data.get("member_id")
+
+    if conversation_id and member_id:
+        result = await ConversationModel.remove_group_member(conversation_id, sender_id, member_id)
+        membership.invalidate(conversation_id)
+
+        if result.get("status") == "success":
+            await ws_send(ws, "member_removed", {"conversation_id": conversation_id, "member_id": member_id}, request_id)
+
+            # Notify the removed member
+            member_ws = user_ws.get(member_id)
+            if member_ws:
+                await ws_send(member_ws, "removed_from_group", {"conversation_id": conversation_id})
+
+            # Broadcast to remaining members
+            await broadcast(conversation_id, "member_removed", {"member_id": member_id, "removed_by": sender_id, "conversation_id": conversation_id})
+
+            # Send updated conversation info (without messages) to remaining members for immediate UI refresh
+            try:
+                conv = await conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
+                if conv:
+                    # The removed member and the rest of the group stop seeing each other's presence
+                    # (unless they are still friends or share another conversation)
+                    await refresh_presence(member_id, *conv.get("participants", []))
+                    conv["_id"] = str(conv["_id"])
+                    if conv.get("created_at"):
+                        conv["created_at"] = int(conv["created_at"].timestamp() * 1000)
+                    if conv.get("last_message") and conv["last_message"].get("created_at"):
+                        conv["last_message"]["created_at"] = int(conv["last_message"]["created_at"].timestamp() * 1000)
+                    await broadcast(conversation_id, "conversation_updated", {"conversation": conv})
+            except Exception as e:
+                print(f"[WS] conversation update after remove failed: {e}")
+        else:
+            await ws_send(ws, "error", {"code": "REMOVE_MEMBER_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- UPDATE GROUP INFO ---
+@ws_handler("update_group_info", order=by_conversation)
+async def handle_update_group_info(ws, sender_id, data, request_id):
+    conversation_id = data.get("conversation_id")
+    name = data.get("name")
+    avatar = data.get("avatar")
+
+    if conversation_id:
+        result = await ConversationModel.update_group_info(conversation_id, sender_id, name, avatar)
+
+        if result.get("status") == "success":
+            await ws_send(ws, "group_updated", {"conversation_id": conversation_id}, request_id)
+
+            # Broadcast to all members
+            update_data = {"conversation_id": conversation_id}
+            if name:
+                update_data["name"] = name
+            if avatar:
+                update_data["avatar"] = avatar
+            await broadcast(conversation_id, "group_info_updated", update_data)
+        else:
+            await ws_send(ws, "error", {"code": "UPDATE_GROUP_ERROR", "message": result.get("message")}, request_id)
+
+
+# --- DELETE CONVERSATION ---
+@ws_handler("delete_conversation", order=by_conversation)
+async def handle_delete_conversation(ws, sender_id, data, request_id):
+    conversation_id = data.get("conversation_id")
+
+    if conversation_id:
+        result = await ConversationModel.delete_conversation(conversation_id, sender_id)
+        membership.invalidate(conversation_id)
+
+        if result.get("status") == "success":
+            await ws_send(ws, "conversation_deleted", {"conversation_id": conversation_id}, request_id)
+            await refresh_presence(*result.get("participants", []))
+
+            # Notify all participants
+            await deliver("conversation_deleted", {"conversation_id": conversation_id},
+                          participants=result.get("participants", []), exclude_user_ids={sender_id})
+        else:
+            await ws_send(ws, "error", {"code": "DELETE_ERROR", "message": result.get("message")}, request_id)
+
 @app.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
-    await ws.accept()
+    # "chat.msgpack" subprotocol: binary msgpack frames (codec.py), JSON otherwise
+    subprotocol, encoding = negotiate(ws.scope.get("subprotocols", []))
+    await ws.accept(subprotocol=subprotocol)
+    if encoding != JSON:
+        encodings[ws] = encoding
+    outbound[ws] = OutboundQueue(ws)
+    # Handlers run concurrently per connection, see ws_dispatch.py
+    dispatcher = Dispatcher(ws)
 
     try:
         while True:
-            raw = await ws.receive_text()
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            raw = message.get("text")
+            if raw is None:
+                raw = message.get("bytes")
             try:
-                msg = json.loads(raw)
-            except:
-                await ws_send(ws, "error", {"code": "BAD_JSON", "message": "Invalid JSON"})
+                msg = decode_frame(raw)
+            except ValueError:
+                if isinstance(raw, str):
+                    await ws_send(ws, "error", {"code": "BAD_JSON", "message": "Invalid JSON"})
+                else:
+                    await ws_send(ws, "error", {"code": "BAD_FRAME", "message": "Invalid binary frame"})
                 continue
 
             type_ = msg.get("type")
             data = msg.get("data", {}) or {}
             request_id = msg.get("request_id")
 
-            # --- AUTH (Modified for JWT) ---
-            if type_ == "auth":
-                token = data.get("token")
-                user_id = data.get("user_id") # Fallback or initial handshake?
-                
-                # Verify Token
-                payload = None
-                if token:
-                    payload = verify_token(token)
-                
-                if payload:
-                    user_id = payload.get("sub")
-                else:
-                    # If no valid token, fail
-                    await ws_send(ws, "error", {"code": "UNAUTH", "message": "Invalid or missing token"}, request_id)
-                    continue
-
-                ws_user[ws] = user_id
-                user_ws[user_id] = ws
-
-                await ws_send(ws, "auth_ok", {"user_id": user_id}, request_id)
-                # Broadcast presence online
-                await broadcast_presence(user_id, True)
-                
-                # Broadcast presence
-                for other_ws in list(ws_user.keys()):
-                    if getattr(other_ws, "client_state", None) and other_ws.client_state.name == "CONNECTED":
-                         try:
-                             await ws_send(other_ws, "presence_update", {"user_id": user_id, "online": True, "last_seen": None})
-                         except:
-                             pass
-                continue
-
-            # require auth for below
-            if ws not in ws_user:
+            # require auth for everything but auth itself
+            if type_ != "auth" and ws not in ws_user:
                 await ws_send(ws, "error", {"code": "UNAUTH", "message": "Please auth first"}, request_id)
                 continue
-
-            sender_id = ws_user[ws]
-
-            # --- GET OR CREATE DIRECT CONVERSATION ---
-            if type_ == "get_direct_conversation":
-                other_user_id = data.get("other_user_id")
-                if not other_user_id: 
-                     continue
-
-                # tìm user
-                target_user_id = None
-                if UserModel.get_user(other_user_id):
-                    target_user_id = other_user_id
-                else:
-                    user_doc = UserModel.get_user_by_username(other_user_id)
-                    if user_doc:
-                        target_user_id = user_doc.get("_id")
-                
-                if not target_user_id:
-                    await ws_send(ws, "error", {"code": "USER_NOT_FOUND", "message": "User không tồn tại"}, request_id)
-                    continue
-
-                conv = ConversationModel.create_or_get_direct_conversation(sender_id, target_user_id, initiator_id=sender_id)
-                
-                # Notify recipient if new and pending
-                if conv.get('status') == 'pending' and conv.get('initiator') == sender_id:
-                    recipient_ws = user_ws.get(target_user_id)
-                    if recipient_ws:
-                        await ws_send(recipient_ws, "new_conversation", {"conversation": conv})
-                
-                await ws_send(ws, "direct_conversation", {"conversation": conv}, request_id)
-                continue
-            
-            # --- GET USER CONVERSATIONS ---
-            if type_ == "get_conversations":
-                convs = ConversationModel.get_user_conversations(sender_id)
-                await ws_send(ws, "conversations_list", {"conversations": convs}, request_id)
-                continue
-
-            # --- JOIN ROOM ---
-            if type_ == "join":
-                conv_id = data.get("conversation_id")
-                if conv_id:
-                    rooms.setdefault(conv_id, set()).add(ws)
-                    await ws_send(ws, "join_ok", {"conversation_id": conv_id}, request_id)
-                continue
-            
-            # --- LOAD MESSAGES ---
-            if type_ == "load_messages":
-                conv_id = data.get("conversation_id")
-                if conv_id:
-                    try:
-                        messages = MessageModel.get_messages(conv_id, viewer_id=sender_id)
-                        await ws_send(ws, "messages_loaded", {
-                            "conversation_id": conv_id,
-                            "messages": messages
-                        }, request_id)
-                    except Exception as e:
-                        print(f"[WS] load_messages error: {e}")
-                        await ws_send(ws, "error", {
-                            "code": "LOAD_MESSAGES_ERROR",
-                            "message": str(e)
-                        }, request_id)
+            if not isinstance(data, dict):
+                await ws_send(ws, "error", {"code": "BAD_REQUEST", "message": "data must be an object"}, request_id)
                 continue
 
-            # --- RECEIPT  ---
-            if type_ == "receipt":
-                await ws_send(ws, "info", {"message": "receipts_disabled"}, request_id)
-                continue
-
-            # --- PIN MESSAGE ---
-            if type_ == "pin_message":
-                conv_id = data.get("conversation_id")
-                message_id = data.get("message_id")
-                result = ConversationModel.pin_message(conv_id, message_id, sender_id)
-                if result.get("status") == "success":
-                    payload = {
-                        "conversation_id": conv_id,
-                        "pinned_message": result.get("pinned_message")
-                    }
-                    await broadcast(conv_id, "pinned_message_updated", payload)
-                    await notify_participants(conv_id, "pinned_message_updated", payload)
-                else:
-                    await ws_send(ws, "error", {"code": "PIN_ERROR", "message": result.get("message")}, request_id)
+            handler = handlers.get(type_) if isinstance(type_, str) else None
+            if handler is None:
+                await ws_send(ws, "error", {"code": "UNKNOWN_TYPE", "message": f"Unknown type: {type_}"}, request_id)
                 continue
-
-            # --- UNPIN MESSAGE ---
-            if type_ == "unpin_message":
-                conv_id = data.get("conversation_id")
-                result = ConversationModel.unpin_message(conv_id)
-                if result.get("status") == "success":
-                    payload = {
-                        "conversation_id": conv_id,
-                        "pinned_message": None
-                    }
-                    await broadcast(conv_id, "pinned_message_updated", payload)
-                    await notify_participants(conv_id, "pinned_message_updated", payload)
-                else:
-                    await ws_send(ws, "error", {"code": "UNPIN_ERROR", "message": result.get("message")}, request_id)
-                continue
-
-            # --- SEND MESSAGE ---
-            if type_ == "send_message":
-                conv_id = data.get("conversation_id")
-                client_msg_id = data.get("client_msg_id")
-                msg_type = data.get("msg_type", "text")
-                text = data.get("text", "")
-                file_url = data.get("file_url")
-                file_name = data.get("file_name")
-                file_size = data.get("file_size")
-
-                if not conv_id or not client_msg_id: continue
-
-                # INSERT message into db (conversation)
-                saved_msg = MessageModel.insert_message(
-                    conv_id, sender_id, text, msg_type,
-                    file_url=file_url, file_name=file_name, file_size=file_size
-                )
-                
-                if not saved_msg:
-
-                    continue
-
-                server_msg_id = saved_msg['_id']
-                
-                # Add status field for frontend
-                saved_msg['status'] = 'sent'
-                
-                # Ack
-                await ws_send(ws, "send_ack", {
-                    "conversation_id": conv_id,
-                    "client_msg_id": client_msg_id,
-                    "server_msg_id": server_msg_id,
-                    "status": "sent",
-                    "created_at": saved_msg["created_at"]
-                }, request_id)
-
-                # Broadcast to room (include sender so UI updates immediately)
-                await broadcast(conv_id, "new_message", {
-                    "conversation_id": conv_id,
-                    "message": saved_msg
-                })
-                
-                # Notify all participants who are not in room
-                conv = conversations_collection.find_one({"_id": ObjectId(conv_id)}) if len(conv_id) == 24 else None
-                if conv:
-                    participants = conv.get('participants', [])
-                    for participant_id in participants:
-                        if participant_id == sender_id:
-                            continue  # Don't notify sender
-                        
-                        recipient_ws = user_ws.get(participant_id)
-                        if recipient_ws:
-                            # If not in room, send notification
-                            if recipient_ws not in rooms.get(conv_id, set()):
-                                await ws_send(recipient_ws, "new_message", {
-                                    "conversation_id": conv_id,
-                                    "message": saved_msg
-                                })
-                continue
-
-            # --- SEARCH USERS ---
-            if type_ == "search_users":
-                query = data.get("query", "")
-                users = UserModel.search_users(query)
-                await ws_send(ws, "search_results", {"query": query, "users": users}, request_id)
-                continue
-            
-            # --- SEND FRIEND REQUEST ---
-            if type_ == "send_friend_request":
-                to_user_id = data.get("to_user_id")
-                if to_user_id:
-                    target_user_id = None
-                    # Try exact user_id first
-                    if UserModel.get_user(to_user_id):
-                        target_user_id = to_user_id
-                    else:
-                        # Fallback to username lookup
-                        user_doc = UserModel.get_user_by_username(to_user_id)
-                        if user_doc:
-                            target_user_id = user_doc.get("_id")
-
-                    if not target_user_id:
-                        await ws_send(ws, "error", {"code": "USER_NOT_FOUND", "message": "User không tồn tại"}, request_id)
-                        continue
-
-                    result = FriendModel.send_friend_request(sender_id, target_user_id)
-                    if result.get("status") == "error":
-                        err_msg = result.get("message", "Lỗi khi gửi lời mời kết bạn")
-                        err_code = "USER_NOT_FOUND" if "không tồn tại" in err_msg.lower() else "FRIEND_REQUEST_ERROR"
-                        await ws_send(ws, "error", {"code": err_code, "message": err_msg}, request_id)
-                    else:
-                        await ws_send(ws, "friend_request_sent", result, request_id)
-                        # Notify
-                        recipient_ws = user_ws.get(target_user_id)
-                        if recipient_ws:
-                            await ws_send(recipient_ws, "friend_request_received", {"from_user_id": sender_id})
-                continue
-            
-            # --- ACCEPT FRIEND REQUEST ---
-            if type_ == "accept_friend_request":
-                from_user_id = data.get("from_user_id")
-                if from_user_id:
-                    success = FriendModel.accept_friend_request(sender_id, from_user_id)
-                    await ws_send(ws, "friend_request_accepted", {"success": success, "friend_id": from_user_id}, request_id)
-                    
-                    if success:
-                        # Notify the sender
-                        sender_ws = user_ws.get(from_user_id)
-                        if sender_ws:
-                            await ws_send(sender_ws, "friend_accepted", {"user_id": sender_id})
-                        
-                        # Send updated conversation lists to both users so status changes from pending to accepted
-                        convs_acceptor = ConversationModel.get_user_conversations(sender_id)
-                        await ws_send(ws, "conversations_list", {"conversations": convs_acceptor}, "r_refresh_after_friend")
-                        
-                        if sender_ws:
-                            convs_sender = ConversationModel.get_user_conversations(from_user_id)
-                            await ws_send(sender_ws, "conversations_list", {"conversations": convs_sender}, "r_refresh_after_friend")
-                continue
-            
-            # --- CLOSE/ACCEPT CONVERSATION ---
-            if type_ == "accept_conversation":
-                conv_id = data.get("conversation_id")
-                if conv_id:
-                    ConversationModel.accept_conversation(conv_id)
-                    await ws_send(ws, "conversation_accepted", {"conversation_id": conv_id}, request_id)
-                continue
-            
-            # --- GET FRIENDS LIST ---
-            if type_ == "get_friends":
-                print(f"[WS] get_friends request from: {sender_id}")
-                # Create online_users dict from user_ws
-                online_users = {uid: True for uid in user_ws.keys()}
-                friends = FriendModel.get_friends(sender_id, online_users)
-                print(f"[WS] Sending {len(friends)} friends to {sender_id}")
-                await ws_send(ws, "friends_list", {"friends": friends}, request_id)
-                continue
-            
-            # --- GET FRIEND REQUESTS  ---
-            if type_ == "get_friend_requests":
-                # Returns { received: [], sent: [] }
-                requests = FriendModel.get_pending_requests(sender_id)
-                await ws_send(ws, "friend_requests", requests, request_id)
-                continue
-
-            # --- REJECT FRIEND REQUEST ---
-            if type_ == "reject_friend_request":
-                from_user_id = data.get("from_user_id")
-                if from_user_id:
-                    try:
-                        print(f"[WS] Rejecting friend request: {sender_id} rejecting {from_user_id}")
-                        success = FriendModel.reject_friend_request(sender_id, from_user_id)
-                        print(f"[WS] Reject result: {success}")
-                        await ws_send(ws, "friend_request_rejected", {"success": success, "user_id": from_user_id}, request_id)
-                        
-                        if success:
-                            sender_ws = user_ws.get(from_user_id)
-                            if sender_ws:
-                                await ws_send(sender_ws, "friend_rejected", {"user_id": sender_id})
-                    except Exception as e:
-                        print(f"[WS] Error rejecting friend request: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        await ws_send(ws, "error", {"code": "REJECT_ERROR", "message": str(e)}, request_id)
-                continue
-
-            # --- CREATE GROUP CONVERSATION ---
-            if type_ == "create_group":
-                name = data.get("name", "")
-                member_ids = data.get("member_ids", [])
-                
-                result = ConversationModel.create_group_conversation(sender_id, name, member_ids)
-                
-                if result.get("status") == "success":
-                    conversation = result["conversation"]
-                    await ws_send(ws, "group_created", {"conversation": conversation}, request_id)
-                    
-                    # Notify all members
-                    for member_id in conversation.get("participants", []):
-                        if member_id != sender_id:
-                            member_ws = user_ws.get(member_id)
-                            if member_ws:
-                                await ws_send(member_ws, "new_conversation", {"conversation": conversation})
-                else:
-                    await ws_send(ws, "error", {"code": "CREATE_GROUP_ERROR", "message": result.get("message")}, request_id)
-                continue
-
-            # --- ADD GROUP MEMBER ---
-            if type_ == "add_group_member":
-                conversation_id = data.get("conversation_id")
-                new_member_id = data.get("member_id")
-                
-                if conversation_id and new_member_id:
-                    result = ConversationModel.add_group_member(conversation_id, sender_id, new_member_id)
-                    
-                    if result.get("status") == "success":
-                        await ws_send(ws, "member_added", {"conversation_id": conversation_id, "member_id": new_member_id}, request_id)
-                        
-                        # Notify the new member
-                        member_ws = user_ws.get(new_member_id)
-                        if member_ws:
-                            # Get updated conversation info
-                            conv = conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
-                            if conv:
-                                conv['_id'] = str(conv['_id'])
-                                if conv.get('created_at'):
-                                    conv['created_at'] = int(conv['created_at'].timestamp() * 1000)
-                                await ws_send(member_ws, "new_conversation", {"conversation": conv})
-                        
-                        # Broadcast to all members in the room
-                        await broadcast(conversation_id, "member_added", {"member_id": new_member_id, "added_by": sender_id, "conversation_id": conversation_id})
-
-                        # Broadcast updated conversation metadata to refresh participant list
-                        conv = conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
-                        if conv:
-                            conv['_id'] = str(conv['_id'])
-                            if conv.get('created_at'):
-                                conv['created_at'] = int(conv['created_at'].timestamp() * 1000)
-                            if conv.get('last_message') and conv['last_message'].get('created_at'):
-                                conv['last_message']['created_at'] = int(conv['last_message']['created_at'].timestamp() * 1000)
-                            await broadcast(conversation_id, "conversation_updated", {"conversation": conv})
-                            await notify_participants(conversation_id, "conversation_updated", {"conversation": conv})
-                    else:
-                        await ws_send(ws, "error", {"code": "ADD_MEMBER_ERROR", "message": result.get("message")}, request_id)
-                continue
-
-            # --- REMOVE GROUP MEMBER ---
-            if type_ == "remove_group_member":
-                conversation_id = data.get("conversation_id")
-                member_id = data.get("member_id")
-                
-                if conversation_id and member_id:
-                    result = ConversationModel.remove_group_member(conversation_id, sender_id, member_id)
-                    
-                    if result.get("status") == "success":
-                        await ws_send(ws, "member_removed", {"conversation_id": conversation_id, "member_id": member_id}, request_id)
-                        
-                        # Notify the removed member
-                        member_ws = user_ws.get(member_id)
-                        if member_ws:
-                            await ws_send(member_ws, "removed_from_group", {"conversation_id": conversation_id})
-                        
-                        # Broadcast to remaining members
-                        await broadcast(conversation_id, "member_removed", {"member_id": member_id, "removed_by": sender_id, "conversation_id": conversation_id})
-
-                        # Send updated conversation info (without messages) to remaining members for immediate UI refresh
-                        try:
-                            conv = conversations_collection.find_one({"_id": ObjectId(conversation_id)}, {"messages": 0})
-                            if conv:
-                                conv["_id"] = str(conv["_id"])
-                                if conv.get("created_at"):
-                                    conv["created_at"] = int(conv["created_at"].timestamp() * 1000)
-                                if conv.get("last_message") and conv["last_message"].get("created_at"):
-                                    conv["last_message"]["created_at"] = int(conv["last_message"]["created_at"].timestamp() * 1000)
-                                await broadcast(conversation_id, "conversation_updated", {"conversation": conv})
-                        except Exception as e:
-                            print(f"[WS] conversation update after remove failed: {e}")
-                    else:
-                        await ws_send(ws, "error", {"code": "REMOVE_MEMBER_ERROR", "message": result.get("message")}, request_id)
-                continue
-
-            # --- UPDATE GROUP INFO ---
-            if type_ == "update_group_info":
-                conversation_id = data.get("conversation_id")
-                name = data.get("name")
-                avatar = data.get("avatar")
-                
-                if conversation_id:
-                    result = ConversationModel.update_group_info(conversation_id, sender_id, name, avatar)
-                    
-                    if result.get("status") == "success":
-                        await ws_send(ws, "group_updated", {"conversation_id": conversation_id}, request_id)
-                        
-                        # Broadcast to all members
-                        update_data = {"conversation_id": conversation_id}
-                        if name:
-                            update_data["name"] = name
-                        if avatar:
-                            update_data["avatar"] = avatar
-                        await broadcast(conversation_id, "group_info_updated", update_data)
-                    else:
-                        await ws_send(ws, "error", {"code": "UPDATE_GROUP_ERROR", "message": result.get("message")}, request_id)
-                continue
-            
-            # --- DELETE CONVERSATION ---
-            if type_ == "delete_conversation":
-                conversation_id = data.get("conversation_id")
-                
-                if conversation_id:
-                    result = ConversationModel.delete_conversation(conversation_id, sender_id)
-                    
-                    if result.get("status") == "success":
-                        await ws_send(ws, "conversation_deleted", {"conversation_id": conversation_id}, request_id)
-                        
-                        # Notify all participants
-                        participants = result.get("participants", [])
-                        for participant_id in participants:
-                            if participant_id != sender_id:
-                                participant_ws = user_ws.get(participant_id)
-                                if participant_ws:
-                                    await ws_send(participant_ws, "conversation_deleted", {"conversation_id": conversation_id})
-                    else:
-                        await ws_send(ws, "error", {"code": "DELETE_ERROR", "message": result.get("message")}, request_id)
-                continue
-
-            await ws_send(ws, "error", {"code": "UNKNOWN_TYPE", "message": f"Unknown type: {type_}"}, request_id)
-
-
-
+            await dispatcher.dispatch(type_, handler, ws_user.get(ws), data, request_id)
 
     except WebSocketDisconnect:
+        # Let the messages already received finish before going offline
+        await dispatcher.drain()
         user_id = ws_user.get(ws)
         if user_id:
             ws_user.pop(ws, None)
             user_ws.pop(user_id, None)
             for conv_id in list(rooms.keys()):
                 rooms[conv_id].discard(ws)
+            presence.discard(ws)
             # broadcast offline presence
             await broadcast_presence(user_id, False, now_ms())
+            presence_audience.pop(user_id, None)
+    finally:
+        dispatcher.cancel()
+        encodings.pop(ws, None)
+        queue = outbound.pop(ws, None)
+        if queue:
+            queue.close()
@@ -0,0 +1,53 @@
+# membership.py
+"""
+In-process cache of conversation participants for the send / notify hot path.
+
+Bounded LRU. Entries are updated or invalidated explicitly by the handlers
+that change membership (create_group, add/remove member, delete), so a
+cached conversation costs no query at all. Being per process, it assumes a
+single server process (as the WS registry already does).
+"""
+import os
+from collections import OrderedDict
+from models import ConversationModel
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "10000"))
+
+
+class MembershipCache:
+    def __init__(self, maxsize=MEMBERSHIP_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # conversation_id -> frozenset(participants)
+        self._invalidations = 0
+
+    async def get(self, conversation_id):
+        """Participants of a conversation (empty if it does not exist)"""
+        participants = self._entries.get(conversation_id)
+        if participants is not None:
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return participants
+
+        self.misses += 1
+        seen = self._invalidations
+        loaded = await ConversationModel.get_participants(conversation_id)
+        participants = frozenset(loaded or [])
+        # Don't cache what may already be stale (membership changed while loading)
+        if loaded is not None and seen == self._invalidations:
+            self.set(conversation_id, participants)
+        return participants
+
+    def set(self, conversation_id, participants):
+        self._entries[conversation_id] = frozenset(participants)
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, conversation_id):
+        self._invalidations += 1
+        self._entries.pop(conversation_id, None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,329 @@
+# message_store.py
+"""
+Bucketed message storage.
+
+Messages used to live in a `messages` array embedded in each conversation
+document, which grows without bound (16 MB document limit) and makes every
+$push rewrite a bigger document. Messages now go to `message_buckets`:
+
+    {
+        "conversation_id": ObjectId,
+        "bucket": int,          # seq // BUCKET_SIZE
+        "count": int,
+        "messages": [ {"_id", "seq", "sender_id", "text", ...} ]
+    }
+
+Each conversation keeps a `message_seq` counter (number of messages allocated).
+Allocation and bucket write of a conversation's messages happen under one
+lock (per conversation, in this process), so messages are stored in sequence
+order: a reader catching up with `after` never sees seq N+1 before seq N. A
+failed write gives its sequence numbers back when it can; readers still
+don't assume sequences are gap free.
+Conversations without that field still use the legacy embedded layout and are
+moved over by `migrate_conversation` (lazily on first write, or in bulk with
+`migrate_messages.py`).
+Indexes are declared in schema.py.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from db import async_db
+from metrics import timed_methods
+
+BUCKET_SIZE = int(os.getenv("MESSAGE_BUCKET_SIZE", "200"))
+
+conversations_collection = async_db['conversations']
+message_buckets_collection = async_db['message_buckets']
+
+
+_conversation_locks = {}  # conv_oid -> [lock, holders + waiters]
+
+
+def bucket_of(seq):
+    return seq // BUCKET_SIZE
+
+
+@asynccontextmanager
+async def conversation_lock(conv_oid):
+    """Serialize allocate + write of one conversation's messages"""
+    entry = _conversation_locks.setdefault(conv_oid, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _conversation_locks.pop(conv_oid, None)
+
+
+def serialize_message(msg):
+    """Convert a stored message to the JSON shape sent to clients"""
+    msg = dict(msg)
+    msg['_id'] = str(msg['_id'])
+    if isinstance(msg.get('created_at'), datetime):
+        msg['created_at'] = int(msg['created_at'].timestamp() * 1000)
+    # Remove legacy receipts, keep simple status
+    msg.pop('receipts', None)
+    msg['status'] = 'sent'
+    return msg
+
+
+@timed_methods
+class MessageStore:
+    @staticmethod
+    async def append(conv_oid, message, last_message):
+        """
+        Allocate the next sequence number and store the message in its bucket.
+        Returns the stored message (with `seq`) or None if the conversation does not exist.
+        """
+        async with conversation_lock(conv_oid):
+            allocated = await MessageStore.allocate(conv_oid, 1, last_message)
+            if allocated is None:
+                return None
+            seq, previous = allocated
+            message["seq"] = seq
+            try:
+                await MessageStore.write_buckets({(conv_oid, bucket_of(seq)): [message]})
+            except Exception:
+                await MessageStore.release(conv_oid, seq, 1, previous)
+                raise
+        return message
+
+    @staticmethod
+    async def allocate(conv_oid, count, last_message):
+        """
+        Reserve `count` consecutive sequence numbers and set last_message in one update.
+        Returns (first sequence number, previous last_message), or None if the
+        conversation does not exist. Callers hold conversation_lock (or write
+        one batch at a time) until the messages are stored.
+        """
+        for _ in range(3):
+            conv = await conversations_collection.find_one_and_update(
+                {"_id": conv_oid, "message_seq": {"$exists": True}},
+                {"$inc": {"message_seq": count}, "$set": {"last_message": last_message}},
+                projection={"message_seq": 1, "last_message": 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            if conv:
+                return conv["message_seq"], conv.get("last_message")
+            # Legacy (embedded) conversation or missing one
+            if not await MessageStore.migrate_conversation(conv_oid):
+                return None
+        return None
+
+    @staticmethod
+    async def release(conv_oid, first, count, previous_last_message):
+        """
+        Undo an allocate whose messages could not be written: sequence numbers
+        and last_message go back, unless something was allocated since (then
+        the gap stays, readers cope with it).
+        """
+        try:
+            await conversations_collection.update_one(
+                {"_id": conv_oid, "message_seq": first + count},
+                {"$inc": {"message_seq": -count}, "$set": {"last_message": previous_last_message}}
+            )
+        except Exception as e:
+            print(f"[DB] Could not release seq {first}..{first + count - 1} of {conv_oid}: {e}")
+
+    @staticmethod
+    async def write_buckets(groups):
+        """Push messages into their buckets: {(conv_oid, bucket): [messages]}, one bulk_write"""
+        def ops(upsert):
+            return [
+                UpdateOne(
+                    {"conversation_id": conv_oid, "bucket": bucket},
+                    {
+                        "$push": {"messages": {"$each": messages, "$sort": {"seq": 1}}},
+                        "$inc": {"count": len(messages)}
+                    },
+                    upsert=upsert
+                )
+                for (conv_oid, bucket), messages in groups.items()
+            ]
+
+        try:
+            await message_buckets_collection.bulk_write(ops(True), ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if not errors or any(err.get("code") != 11000 for err in errors):
+                raise
+            # Another writer created some buckets at the same time - they exist now
+            items = list(groups.items())
+            groups = dict(items[err["index"]] for err in errors)
+            await message_buckets_collection.bulk_write(ops(False), ordered=False)
+
+    @staticmethod
+    async def get_page(conv_oid, before=None, after=None, limit=50):
+        """
+        One page of history in chronological order, using sequence cursors.
+        - before=S: the `limit` messages right before seq S (scrolling up)
+        - after=S:  the `limit` messages right after seq S (catching up)
+        - neither:  the latest `limit` messages
+        Passing both is an error (ValueError).
+        Each page reads limit // BUCKET_SIZE + 2 buckets through the
+        (conversation_id, bucket) index, however deep the cursor is (more only
+        if sequence gaps leave them short).
+        Returns (messages, has_more).
+        """
+        if before is not None and after is not None:
+            raise ValueError("Use either before or after, not both")
+        if before is None and after is None:
+            conv = await conversations_collection.find_one(
+                {"_id": conv_oid},
+                {"message_seq": 1, "messages": {"$slice": -(limit + 1)}}
+            )
+            if not conv:
+                return [], False
+            if "message_seq" not in conv:
+                # Legacy layout: served from the embedded array until migrated
+                messages = conv.get("messages", [])
+                return messages[-limit:], len(messages) > limit
+        elif not await MessageStore.migrate_conversation(conv_oid):
+            return [], False
+
+        max_buckets = limit // BUCKET_SIZE + 2
+        query = {"conversation_id": conv_oid}
+        if after is not None:
+            query["bucket"] = {"$gte": bucket_of(after + 1)}
+            order = 1
+        else:
+            if before is not None:
+                if before <= 0:
+                    return [], False
+                query["bucket"] = {"$lte": bucket_of(before - 1)}
+            order = -1
+
+        buckets = message_buckets_collection.find(query, {"messages": 1}).sort("bucket", order).batch_size(max_buckets)
+
+        result = []
+        async for b in buckets:
+            msgs = b.get("messages", [])
+            if after is not None:
+                result.extend(m for m in msgs if m["seq"] > after)
+            else:
+                result = [m for m in msgs if before is None or m["seq"] < before] + result
+            if len(result) > limit:
+                break
+
+        # Buckets are read until there is one message past the page (or none left)
+        if after is not None:
+            return result[:limit], len(result) > limit
+        return result[-limit:], len(result) > limit
+
+    @staticmethod
+    async def resolve_cursor(conv_oid, cursor):
+        """Turn a cursor (sequence number or message id) into a sequence number"""
+        if cursor is None or cursor == "":
+            return None
+        if isinstance(cursor, int) or (isinstance(cursor, str) and cursor.isdigit()):
+            return int(cursor)
+        try:
+            msg_oid = ObjectId(cursor)
+        except (InvalidId, TypeError):
+            raise ValueError(f"Invalid cursor: {cursor}")
+        msg = await MessageStore.find_message(conv_oid, msg_oid)
+        if msg and "seq" not in msg:
+            # Cursor into a legacy conversation: move it to buckets first
+            await MessageStore.migrate_conversation(conv_oid)
+            msg = await MessageStore.find_message(conv_oid, msg_oid)
+        if not msg:
+            raise ValueError(f"Unknown cursor: {cursor}")
+        return msg["seq"]
+
+    @staticmethod
+    async def find_message(conv_oid, msg_oid):
+        """Fetch a single message by id without loading the rest of the history"""
+        doc = await message_buckets_collection.find_one(
+            {"conversation_id": conv_oid, "messages._id": msg_oid},
+            {"messages": {"$elemMatch": {"_id": msg_oid}}}
+        )
+        if not doc:
+            # Not migrated yet
+            doc = await conversations_collection.find_one(
+                {"_id": conv_oid, "messages._id": msg_oid},
+                {"messages": {"$elemMatch": {"_id": msg_oid}}}
+            )
+        if doc and doc.get("messages"):
+            return doc["messages"][0]
+        return None
+
+    @staticmethod
+    async def delete_conversation(conv_oid):
+        await message_buckets_collection.delete_many({"conversation_id": conv_oid})
+
+    @staticmethod
+    async def migrate_conversation(conv_oid, max_retries=5):
+        """
+        Move the embedded `messages` array of one conversation into buckets.
+        Idempotent and safe to run while the conversation is in use (several
+        writers, or migrate_messages.py next to the server): buckets are only
+        ever inserted or given the messages they are missing, never replaced,
+        so messages appended after another migrator finished are kept. The
+        switch-over only happens if the embedded array did not change in the
+        meantime (otherwise we retry).
+        Returns False if the conversation does not exist.
+        """
+        for _ in range(max_retries):
+            conv = await conversations_collection.find_one(
+                {"_id": conv_oid}, {"messages": 1, "message_seq": 1}
+            )
+            if not conv:
+                return False
+            if "message_seq" in conv:
+                return True
+
+            messages = conv.get("messages") or []
+            for i, msg in enumerate(messages):
+                msg["seq"] = i
+            await MessageStore._copy_to_buckets(conv_oid, messages)
+
+            unchanged = {"messages": {"$size": len(messages)}} if "messages" in conv else {"messages": {"$exists": False}}
+            res = await conversations_collection.update_one(
+                {"_id": conv_oid, "message_seq": {"$exists": False}, **unchanged},
+                {"$set": {"message_seq": len(messages)}, "$unset": {"messages": ""}}
+            )
+            if res.modified_count:
+                return True
+        return False
+
+    @staticmethod
+    async def _copy_to_buckets(conv_oid, messages):
+        """Insert-only copy of numbered messages: new buckets whole, existing ones get the seqs they lack"""
+        buckets = [
+            {
+                "conversation_id": conv_oid,
+                "bucket": bucket_of(start),
+                "count": len(messages[start:start + BUCKET_SIZE]),
+                "messages": messages[start:start + BUCKET_SIZE]
+            }
+            for start in range(0, len(messages), BUCKET_SIZE)
+        ]
+        if not buckets:
+            return
+        try:
+            await message_buckets_collection.insert_many(buckets, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if not errors or any(err.get("code") != 11000 for err in errors):
+                raise
+            # Written by another migrator (possibly with newer messages since)
+            existing = [buckets[err["index"]] for err in errors]
+
+        await message_buckets_collection.bulk_write([
+            UpdateOne(
+                {"conversation_id": conv_oid, "bucket": b["bucket"], "messages.seq": {"$ne": msg["seq"]}},
+                {
+                    "$push": {"messages": {"$each": [msg], "$sort": {"seq": 1}}},
+                    "$inc": {"count": 1}
+                }
+            )
+            for b in existing for msg in b["messages"]
+        ], ordered=False)
@@ -0,0 +1,156 @@
+# metrics.py
+"""
+Prometheus metrics in the text exposition format, served at GET /metrics.
+
+No client library: counters and histograms are dicts keyed by label values,
+updated inline (a dict lookup and an add; no locks, everything runs on the
+event loop). Values describing current state (sockets, rooms, queues,
+caches, upload counters...) are read from the modules' own registries and
+*_stats dicts by collectors when scraped, so they cost nothing in between.
+
+Label sets are capped per metric (MAX_SERIES); further label values are
+counted as "other", so client-chosen values (WS message types) can't blow
+up the number of series.
+"""
+import time
+from bisect import bisect_left
+from functools import wraps
+from inspect import iscoroutinefunction
+
+# Seconds: from a cached lookup to a slow query / large upload
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MAX_SERIES = 200
+
+_metrics = []     # Counter / Histogram, in registration order
+_collectors = []  # functions returning [(name, type, help, [(labels, value)])]
+_started = time.time()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._series = {}
+        _metrics.append(self)
+
+    def _key(self, values):
+        if values in self._series or len(self._series) < MAX_SERIES:
+            return values
+        return ("other",) * len(self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return lines + self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_label_text(self.labels, key)} {_number(value)}" for key, value in self._series.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # [per-bucket counts (last one: above every bound), sum]
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {cumulative}")
+        return lines
+
+
+def register_collector(collector):
+    """
+    Add a function called on every scrape, returning
+    [(name, "gauge" | "counter", help, [({label: value}, number)])].
+    Usable as a decorator.
+    """
+    _collectors.append(collector)
+    return collector
+
+
+def timed_methods(cls):
+    """Class decorator: time every async static method as db_method_seconds{method="Class.method"}"""
+    for attr, member in list(vars(cls).items()):
+        if isinstance(member, staticmethod) and iscoroutinefunction(member.__func__):
+            setattr(cls, attr, staticmethod(_timed(f"{cls.__name__}.{attr}", member.__func__)))
+    return cls
+
+
+def _timed(label, func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            db_method_seconds.observe(time.perf_counter() - started, label)
+    return wrapper
+
+
+def render():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for collector in [_process] + _collectors:
+        for name, kind, help_, samples in collector():
+            lines += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_label_text(labels.keys(), labels.values())} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _process():
+    return [("chat_process_start_time_seconds", "gauge", "Start time of the server process (unix seconds)", [({}, _started)])]
+
+
+# --- Metrics updated inline ---
+ws_handler_seconds = Histogram("chat_ws_handler_seconds", "Time to handle one WS message, by message type", ["type"])
+db_method_seconds = Histogram("chat_db_method_seconds", "Duration of model / store methods (Mongo round trips), by method", ["method"])
+ws_frames_sent = Counter("chat_ws_frames_sent_total", "Frames queued to sockets, by event type and encoding", ["type", "encoding"])
+ws_bytes_sent = Counter("chat_ws_bytes_sent_total", "Encoded bytes queued to sockets, by event type and encoding", ["type", "encoding"])
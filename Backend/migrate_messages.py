@@ -0,0 +1,58 @@
+"""
+Move conversations from the embedded `messages` array to message buckets.
+
+Safe to run while the server is up and safe to interrupt: converted
+conversations get a `message_seq` field and are skipped on the next run.
+
+    python migrate_messages.py [--limit N] [--sleep SECONDS]
+"""
+import argparse
+import asyncio
+from db import async_db
+from message_store import MessageStore
+from schema import ensure_indexes
+
+conversations_collection = async_db['conversations']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate embedded messages to message buckets")
+    parser.add_argument("--limit", type=int, default=0, help="Stop after N conversations (0 = all)")
+    parser.add_argument("--sleep", type=float, default=0.0, help="Pause between conversations to limit load")
+    args = parser.parse_args()
+    asyncio.run(migrate(args))
+
+
+async def migrate(args):
+    await ensure_indexes()
+
+    pending = await conversations_collection.count_documents({"message_seq": {"$exists": False}})
+    print(f"[Migrate] {pending} conversations to migrate")
+
+    done = failed = 0
+    last_id = None
+    while True:
+        query = {"message_seq": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        conv = await conversations_collection.find_one(query, {"_id": 1}, sort=[("_id", 1)])
+        if not conv:
+            break
+        last_id = conv["_id"]
+
+        if await MessageStore.migrate_conversation(conv["_id"]):
+            done += 1
+        else:
+            failed += 1
+            print(f"[Migrate] Could not migrate {conv['_id']} (busy or deleted), will retry on next run")
+
+        if args.limit and done + failed >= args.limit:
+            break
+        if args.sleep:
+            await asyncio.sleep(args.sleep)
+
+    print(f"[Migrate] Migrated {done}, failed {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,238 @@
 # models.py
-from db import db
+import asyncio
+from db import async_db
 from datetime import datetime
 from bson import ObjectId
 from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from auth import get_password_hash, verify_password
+from message_store import MessageStore, serialize_message
+from write_batcher import append_message
+from attachments import AttachmentStore
+from metrics import timed_methods
+from user_search import normalize, search_fields, prefix_filter, gram_filter, rank, search_cache, SEARCH_CANDIDATES
+
+MAX_PAGE_SIZE = 200
+MAX_FRIENDS_PAGE = 500
+MAX_PINNED_MESSAGES = 20  # oldest pin is dropped beyond this
+USER_BULK_BATCH = 1000  # accounts per insert_many in create_users_bulk
 
 # Collection references
-users_collection = db['users']
-conversations_collection = db['conversations']
+users_collection = async_db['users']
+conversations_collection = async_db['conversations']
 # friends_collection OLD - DEPRECATED (Now embedded in users)
-# messages_collection OLD - DEPRECATED (Now embedded in conversations)
+# messages_collection OLD - DEPRECATED (Now stored in message_buckets, see message_store.py)
+
+def direct_pair_key(user_id_1, user_id_2):
+    """Canonical key of a direct conversation: same for (a, b) and (b, a)"""
+    return "|".join(sorted([user_id_1, user_id_2]))
+
+
+def pinned_state(conv):
+    """
+    {"pinned_messages": [...], "pinned_message": latest or None} of a conversation
+    document, datetimes as ms. Documents not backfilled yet only have `pinned_message`.
+    """
+    pins = conv.get('pinned_messages')
+    if pins is None:
+        pins = [conv['pinned_message']] if conv.get('pinned_message') else []
+    result = []
+    for pin in pins:
+        pin = dict(pin)
+        for field in ('created_at', 'pinned_at'):
+            if isinstance(pin.get(field), datetime):
+                pin[field] = int(pin[field].timestamp() * 1000)
+        result.append(pin)
+    return {"pinned_messages": result, "pinned_message": result[-1] if result else None}
+
+
+class UserExists(Exception):
+    """Registration conflict; `field` is "email" or "username" """
+    def __init__(self, field):
+        super().__init__(f"{field} already exists")
+        self.field = field
+
+
+def new_user_document(user_id, username, email, password_hash, avatar=None):
+    return {
+        "_id": user_id,  # Using email as ID
+        "username": username,
+        "email": email,
+        "password_hash": password_hash,
+        "avatar": avatar,
+        "created_at": datetime.now(),
+        "friends": [],         # List of friend user_ids
+        "friend_requests": [], # List of { from_user: id, created_at: date }
+        "sent_requests": [],   # List of { to_user: id, created_at: date }
+        **search_fields(user_id, username)
+    }
+
+
+async def _duplicate_field(error, user_id):
+    """Which unique key (email = _id, username) a duplicate key error is about"""
+    key_pattern = (error.get("keyPattern") if isinstance(error, dict) else None) or {}
+    if "_id" in key_pattern:
+        return "email"
+    if "username" in key_pattern:
+        return "username"
+    # Servers / drivers that don't report the key: only reached on conflicts
+    return "email" if await users_collection.find_one({"_id": user_id}, {"_id": 1}) else "username"
+
 
+@timed_methods
 class UserModel:
     @staticmethod
-    def create_user(user_id, username, email, password, avatar=None):
-        """Tạo user mới với password"""
-        # Check exists
-        if users_collection.find_one({"_id": user_id}):
-            return None
-            
-        user = {
-            "_id": user_id,  # Using email as ID
-            "username": username,
-            "email": email,
-            "password_hash": get_password_hash(password),
-            "avatar": avatar,
-            "created_at": datetime.now(),
-            "friends": [],         # List of friend user_ids
-            "friend_requests": [], # List of { from_user: id, created_at: date }
-            "sent_requests": []    # List of { to_user: id, created_at: date }
-        }
-        users_collection.insert_one(user)
+    async def create_user(user_id, username, email, password, avatar=None):
+        """
+        Tạo user mới với password. One insert: uniqueness of the email (_id) and
+        username is left to their unique indexes. Raises UserExists on conflict.
+        """
+        user = new_user_document(user_id, username, email, await asyncio.to_thread(get_password_hash, password), avatar)
+        try:
+            await users_collection.insert_one(user)
+        except DuplicateKeyError as e:
+            raise UserExists(await _duplicate_field(e.details, user_id))
+        search_cache.clear()
         return user
+
+    @staticmethod
+    async def create_users_bulk(accounts):
+        """
+        Provision many accounts ({"username", "email", "password"}), USER_BULK_BATCH per
+        unordered insert_many. Returns {"created": [user_id], "conflicts": [{"user_id", "field"}]}.
+        """
+        created, conflicts = [], []
+        for start in range(0, len(accounts), USER_BULK_BATCH):
+            batch = accounts[start:start + USER_BULK_BATCH]
+            # bcrypt releases the GIL: hash the batch on the thread pool in parallel
+            hashes = await asyncio.gather(*(asyncio.to_thread(get_password_hash, a["password"]) for a in batch))
+            docs = [
+                new_user_document(a["email"].lower().strip(), a["username"], a["email"], password_hash)
+                for a, password_hash in zip(batch, hashes)
+            ]
+            failed = set()
+            try:
+                await users_collection.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    if error.get("code") != 11000:
+                        raise
+                    failed.add(error["index"])
+                    user_id = docs[error["index"]]["_id"]
+                    conflicts.append({"user_id": user_id, "field": await _duplicate_field(error, user_id)})
+            created += [doc["_id"] for i, doc in enumerate(docs) if i not in failed]
+        if created:
+            search_cache.clear()
+        return {"created": created, "conflicts": conflicts}
     
     @staticmethod
-    def get_user(user_id):
+    async def get_user(user_id):
         """Lấy thông tin user (loại bỏ sensitive info)"""
-        user = users_collection.find_one({"_id": user_id})
+        user = await users_collection.find_one({"_id": user_id})
         if user:
             user.pop('password_hash', None)
         return user
     
     @staticmethod
-    def get_user_by_username(username):
+    async def get_user_by_username(username):
         """Lấy user theo username"""
-        user = users_collection.find_one({"username": username})
+        user = await users_collection.find_one({"username": username})
         if user:
             user.pop('password_hash', None)
         return user
     
     @staticmethod
-    def authenticate(user_id, password):
+    async def authenticate(user_id, password):
         """Xác thực user - user_id có thể là email hoặc username"""
-        # Try to find by email first (_id)
-        user = users_collection.find_one({"_id": user_id})
-        
-        # If not found, try by username
-        if not user:
-            user = users_collection.find_one({"username": user_id})
-        
+        # One query on both unique indexes; an email match wins over a username match
+        email = user_id.lower().strip()
+        users = await users_collection.find(
+            {"$or": [{"_id": email}, {"username": user_id}]}
+        ).limit(2).to_list(2)
+        user = next((u for u in users if u["_id"] == email), users[0] if users else None)
+
         if not user:
             return False
-        if not verify_password(password, user.get('password_hash', '')):
+        # bcrypt is deliberately slow, keep it off the event loop
+        if not await asyncio.to_thread(verify_password, password, user.get('password_hash', '')):
             return False
         return user
     
     @staticmethod
-    def search_users(query, limit=10):
+    async def get_contact_ids(user_id):
+        """Friends + members of the user's conversations (who should see their presence)"""
+        doc = await users_collection.find_one({"_id": user_id}, {"friends": 1})
+        contacts = set(doc.get('friends', [])) if doc else set()
+        async for conv in conversations_collection.find({"participants": user_id}, {"participants": 1}):
+            contacts.update(conv.get('participants', []))
+        contacts.discard(user_id)
+        return contacts
+
+    @staticmethod
+    async def search_users(query, limit=10, viewer_id=None):
+        """Users matching query (see user_search.py): exact, then prefix, then substring; the viewer's friends first"""
+        query = normalize(query)
         if not query:
             return []
-        users = users_collection.find({
-            "$or": [
-                {"_id": {"$regex": query, "$options": "i"}},
-                {"username": {"$regex": query, "$options": "i"}}
-            ]
-        }).limit(limit)
-        
-        result = []
-        for user in users:
-            result.append({
+        candidates = search_cache.get(query)
+        if candidates is None:
+            candidates = await UserModel._search_candidates(query)
+            search_cache.set(query, candidates)
+
+        friends = set()
+        if viewer_id:
+            doc = await users_collection.find_one({"_id": viewer_id}, {"friends": 1})
+            friends = set(doc.get('friends', [])) if doc else set()
+        ranked = sorted(candidates, key=lambda user: (user['rank'], user['user_id'] not in friends, user['username'].lower()))
+        return [
+            {"user_id": user['user_id'], "username": user['username'], "avatar": user['avatar']}
+            for user in ranked[:limit]
+        ]
+
+    @staticmethod
+    async def _search_candidates(query):
+        """Ranked matches from the prefix index, plus the trigram index for substrings"""
+        projection = {"username": 1, "avatar": 1, "search_keys": 1}
+        found = {}
+        for filter_ in (prefix_filter(query), gram_filter(query)):
+            if filter_ is None:
+                continue
+            async for user in users_collection.find(filter_, projection).limit(SEARCH_CANDIDATES):
+                found.setdefault(user['_id'], user)
+
+        candidates = []
+        for user in found.values():
+            user_rank = rank(query, user.get('search_keys', []))
+            if user_rank is None:
+                continue  # trigrams all present, but not as one substring
+            candidates.append({
                 "user_id": user['_id'],
                 "username": user.get('username', user['_id']),
-                "avatar": user.get('avatar')
+                "avatar": user.get('avatar'),
+                "rank": user_rank
             })
-        return result
+        return candidates
 
+@timed_methods
 class FriendModel:
     @staticmethod
-    def send_friend_request(from_user_id, to_user_id):
+    async def send_friend_request(from_user_id, to_user_id):
         """Gửi lời mời kết bạn (update arrays trong user docs)"""
         if from_user_id == to_user_id:
             return {"status": "error", "message": "Không thể kết bạn với chính mình"}
         
-        to_user = users_collection.find_one({"_id": to_user_id})
+        to_user = await users_collection.find_one({"_id": to_user_id})
         if not to_user:
             return {"status": "error", "message": "User không tồn tại"}
             
         # Check if already friends or requested
-        if to_user_id in users_collection.find_one({"_id": from_user_id}).get('friends', []):
+        from_user = await users_collection.find_one({"_id": from_user_id}, {"friends": 1})
+        if to_user_id in (from_user or {}).get('friends', []):
             return {"status": "error", "message": "Đã là bạn bè"}
         
         # Check pending requests
-        existing_req = users_collection.find_one({
+        existing_req = await users_collection.find_one({
             "_id": to_user_id, 
             "friend_requests.from_user": from_user_id
         })
@@ -111,7 +242,7 @@ class FriendModel:
         now = datetime.now()
         
         # Add to 'friend_requests' of recipient
-        users_collection.update_one(
+        await users_collection.update_one(
             {"_id": to_user_id},
             {"$push": {"friend_requests": {
                 "from_user": from_user_id,
@@ -120,7 +251,7 @@ class FriendModel:
         )
         
         # Add to 'sent_requests' of sender
-        users_collection.update_one(
+        await users_collection.update_one(
             {"_id": from_user_id},
             {"$push": {"sent_requests": {
                 "to_user": to_user_id, 
@@ -131,40 +262,36 @@ class FriendModel:
         return {"status": "sent", "to_user_id": to_user_id, "timestamp": int(now.timestamp() * 1000)}
 
     @staticmethod
-    def accept_friend_request(user_id, requester_id):
+    async def accept_friend_request(user_id, requester_id):
         """Chấp nhận lời mời (Move from requests -> friends)"""
         now = datetime.now()
         
         # 1. Remove request from recipient
-        res1 = users_collection.update_one(
+        res1 = await users_collection.update_one(
             {"_id": user_id},
             {"$pull": {"friend_requests": {"from_user": requester_id}}}
         )
         
         # 2. Remove sent_request from sender
-        users_collection.update_one(
+        await users_collection.update_one(
             {"_id": requester_id},
             {"$pull": {"sent_requests": {"to_user": user_id}}}
         )
         
         if res1.modified_count > 0:
             # 3. Add to friends list (both sides)
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"_id": user_id},
                 {"$addToSet": {"friends": requester_id}}
             )
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"_id": requester_id},
                 {"$addToSet": {"friends": user_id}}
             )
             
             # 4. Update any pending conversations between these two users to 'accepted'
-            conversations_collection.update_many(
-                {
-                    "type": "direct",
-                    "participants": {"$all": [user_id, requester_id]},
-                    "status": "pending"
-                },
+            await conversations_collection.update_one(
+                {"pair_key": direct_pair_key(user_id, requester_id), "status": "pending"},
                 {"$set": {"status": "accepted"}}
             )
             
@@ -172,38 +299,49 @@ class FriendModel:
         return False
 
     @staticmethod
-    def get_friends(user_id, online_users=None):
+    async def get_friends(user_id, online_users=None):
         """Get friends list with full user information and online status"""
-        print(f"[FriendModel] Getting friends for user_id: {user_id}")
-        doc = users_collection.find_one({"_id": user_id}, {"friends": 1})
-        print(f"[FriendModel] User doc: {doc}")
+        page = await FriendModel.get_friends_page(user_id, online_users)
+        return page["friends"]
+
+    @staticmethod
+    async def get_friends_page(user_id, online_users=None, offset=0, limit=None):
+        """
+        Friends with username/avatar, hydrated in one $in query.
+        `online_users` is any container of online user ids (e.g. the WS registry),
+        `limit=None` returns the whole list.
+        """
+        doc = await users_collection.find_one({"_id": user_id}, {"friends": 1})
         friend_ids = doc.get('friends', []) if doc else []
-        print(f"[FriendModel] Friend IDs: {friend_ids}")
-        
-        if not friend_ids:
-            return []
-        
-        # Get full user info for each friend
+        total = len(friend_ids)
+
+        offset = max(0, int(offset or 0))
+        end = total if limit is None else offset + max(1, min(int(limit), MAX_FRIENDS_PAGE))
+        page_ids = friend_ids[offset:end]
+        if not page_ids:
+            return {"friends": [], "total": total, "next_offset": None}
+
+        users = {}
+        async for friend_user in users_collection.find({"_id": {"$in": page_ids}}, {"username": 1, "avatar": 1}):
+            users[friend_user["_id"]] = friend_user
+
         friends_data = []
-        for fid in friend_ids:
-            friend_user = users_collection.find_one({"_id": fid}, {"password_hash": 0})
+        for fid in page_ids:  # keep the order of the friends list
+            friend_user = users.get(fid)
             if friend_user:
-                friend_info = {
-                    "user_id": friend_user["_id"],
-                    "username": friend_user.get("username", friend_user["_id"]),
+                friends_data.append({
+                    "user_id": fid,
+                    "username": friend_user.get("username", fid),
                     "avatar": friend_user.get("avatar"),
-                    "online": online_users.get(fid, False) if online_users else False  # Check if online
-                }
-                friends_data.append(friend_info)
-                print(f"[FriendModel] Added friend: {friend_info}")
-        
-        print(f"[FriendModel] Returning {len(friends_data)} friends")
-        return friends_data
+                    "online": fid in online_users if online_users else False
+                })
+
+        return {"friends": friends_data, "total": total, "next_offset": end if end < total else None}
 
     @staticmethod
-    def get_pending_requests(user_id):
+    async def get_pending_requests(user_id):
         """Lấy danh sách lời mời nhận được"""
-        doc = users_collection.find_one({"_id": user_id}, {"friend_requests": 1})
+        doc = await users_collection.find_one({"_id": user_id}, {"friend_requests": 1})
         if not doc: return {"received": [], "sent": []}
         
         received = []
@@ -214,7 +352,7 @@ class FriendModel:
             })
             
         # Get sent
-        doc_sent = users_collection.find_one({"_id": user_id}, {"sent_requests": 1})
+        doc_sent = await users_collection.find_one({"_id": user_id}, {"sent_requests": 1})
         sent = []
         for req in doc_sent.get('sent_requests', []) if doc_sent else []:
             sent.append({
@@ -225,28 +363,28 @@ class FriendModel:
         return {"received": received, "sent": sent}
 
     @staticmethod
-    def are_friends(user1, user2):
-        doc = users_collection.find_one({
+    async def are_friends(user1, user2):
+        doc = await users_collection.find_one({
             "_id": user1,
             "friends": user2
         })
         return doc is not None
 
     @staticmethod
-    def reject_friend_request(user_id, requester_id):
+    async def reject_friend_request(user_id, requester_id):
         """Từ Chối lời mời kết bạn"""
         try:
             print(f"[Model] Rejecting: user={user_id}, requester={requester_id}")
             
             # 1. Remove request from recipient
-            res1 = users_collection.update_one(
+            res1 = await users_collection.update_one(
                 {"_id": user_id},
                 {"$pull": {"friend_requests": {"from_user": requester_id}}}
             )
             print(f"[Model] Removed from recipient: modified={res1.modified_count}")
             
             # 2. Remove sent_request from sender
-            res2 = users_collection.update_one(
+            res2 = await users_collection.update_one(
                 {"_id": requester_id},
                 {"$pull": {"sent_requests": {"to_user": user_id}}}
             )
@@ -259,10 +397,11 @@ class FriendModel:
             traceback.print_exc()
             raise
 
+@timed_methods
 class MessageModel:
     @staticmethod
-    def insert_message(conversation_id, sender_id, text, msg_type="text", file_url=None, file_name=None, file_size=None):
-        """Embed message into Conversation document with optional file metadata"""
+    async def insert_message(conversation_id, sender_id, text, msg_type="text", file_url=None, file_name=None, file_size=None, image=None):
+        """Store message in its conversation bucket with optional file metadata"""
         msg_id = ObjectId()
         now = datetime.now()
         
@@ -281,6 +420,8 @@ class MessageModel:
             message["file_name"] = file_name
         if file_size:
             message["file_size"] = file_size
+        if image:
+            message["image"] = image
         
         try:
             conv_oid = ObjectId(conversation_id)
@@ -288,20 +429,14 @@ class MessageModel:
              # Fallback if string id
             return None
 
-        # Push to messages array
-        conversations_collection.update_one(
-            {"_id": conv_oid},
-            {
-                "$push": {"messages": message},
-                "$set": {
-                    "last_message": {
-                         "text": text if text else (file_name if file_name else "File"),
-                         "sender_id": sender_id,
-                         "created_at": now
-                    }
-                }
-            }
-        )
+        last_message = {
+            "text": text if text else (file_name if file_name else "File"),
+            "sender_id": sender_id,
+            "created_at": now
+        }
+        # Batched with concurrent inserts when MESSAGE_BATCH_WINDOW_MS is set
+        if not await append_message(conv_oid, message, last_message):
+            return None
         
         # Helpers for returning data
         message['_id'] = str(msg_id)
@@ -309,116 +444,130 @@ class MessageModel:
         return message
     
     @staticmethod
-    def get_messages(conversation_id, limit=50, viewer_id=None):
-        """Lấy messages từ mảng embedded"""
+    async def get_messages(conversation_id, limit=50, viewer_id=None):
+        """Lấy messages mới nhất từ message buckets"""
+        page = await MessageModel.get_message_page(conversation_id, limit=limit, viewer_id=viewer_id)
+        return page["messages"]
+
+    @staticmethod
+    async def get_message_page(conversation_id, before=None, after=None, limit=50, viewer_id=None):
+        """
+        Phân trang lịch sử tin nhắn theo cursor (seq hoặc message id).
+        `next_cursor` trỏ tới trang tiếp theo theo cùng chiều (cũ hơn với `before`, mới hơn với `after`).
+        """
+        empty = {"messages": [], "has_more": False, "next_cursor": None}
         try:
             conv_oid = ObjectId(conversation_id)
         except:
-            return []
-            
-        # Projection w/ slice to limit (MongoDB $slice: -limit means last N)
-        conv = conversations_collection.find_one(
-            {"_id": conv_oid},
-            {"messages": {"$slice": -limit}} 
-        )
-        
-        if not conv or 'messages' not in conv:
-            return []
-            
-        result = []
-        for msg in conv['messages']:
-            msg['_id'] = str(msg['_id'])
-            if isinstance(msg['created_at'], datetime):
-                msg['created_at'] = int(msg['created_at'].timestamp() * 1000)
-            # Remove legacy receipts, keep simple status
-            msg.pop('receipts', None)
-            msg['status'] = 'sent'
+            return empty
 
-            result.append(msg)
-            
-        return result # Already in order if pushed in order
+        limit = max(1, min(int(limit or 50), MAX_PAGE_SIZE))
+        before = await MessageStore.resolve_cursor(conv_oid, before)
+        after = await MessageStore.resolve_cursor(conv_oid, after)
+
+        messages, has_more = await MessageStore.get_page(conv_oid, before=before, after=after, limit=limit)
+        next_cursor = None
+        if has_more and messages:
+            edge = messages[-1] if after is not None else messages[0]
+            # Legacy (not yet migrated) messages have no seq, fall back to the id
+            next_cursor = edge["seq"] if "seq" in edge else str(edge["_id"])
+
+        return {
+            "messages": [serialize_message(msg) for msg in messages],
+            "has_more": has_more,
+            "next_cursor": next_cursor
+        }
 
     @staticmethod
-    def update_receipt(conversation_id, message_id, user_id, status):
+    async def update_receipt(conversation_id, message_id, user_id, status):
         # receipts disabled (no-op)
         return
 
 
+@timed_methods
 class ConversationModel:
     @staticmethod
-    def create_or_get_direct_conversation(user_id_1, user_id_2, initiator_id=None):
-        # Check if conversation already exists
-        existing = conversations_collection.find_one({
-            "type": "direct",
-            "participants": {"$all": [user_id_1, user_id_2]}
-        })
-        
-        if existing:
-            existing['_id'] = str(existing['_id'])
-            if 'messages' in existing:
-                del existing['messages'] # Don't return all messages in summary
-            if existing.get('last_message') and isinstance(existing['last_message'].get('created_at'), datetime):
-                existing['last_message']['created_at'] = int(existing['last_message']['created_at'].timestamp() * 1000)
-            return existing
-        
-        are_friends = FriendModel.are_friends(user_id_1, user_id_2)
-        
+    async def create_or_get_direct_conversation(user_id_1, user_id_2, initiator_id=None):
+        """
+        Lookup-or-create in one upsert on the canonical pair key (unique index),
+        so two users opening the chat at the same time still get one conversation.
+        """
+        pair_key = direct_pair_key(user_id_1, user_id_2)
+        new_id = ObjectId()
         now = datetime.now()
-        conv = {
-            "type": "direct",
-            "participants": sorted([user_id_1, user_id_2]),
-            "created_at": now,
-            "last_message": None,
-            "status": "accepted" if are_friends else "pending",
-            "initiator": initiator_id,
-            "messages": [] # Embed messages here
-        }
-        result = conversations_collection.insert_one(conv)
-        conv['_id'] = str(result.inserted_id)
-        conv['created_at'] = int(now.timestamp() * 1000)
+        try:
+            conv = await conversations_collection.find_one_and_update(
+                {"pair_key": pair_key},
+                {"$setOnInsert": {
+                    "_id": new_id,
+                    "type": "direct",
+                    "participants": sorted([user_id_1, user_id_2]),
+                    "created_at": now,
+                    "last_message": None,
+                    "status": "pending",
+                    "initiator": initiator_id,
+                    "message_seq": 0 # Messages live in message_buckets
+                }},
+                projection={"messages": 0}, # Don't return all messages in summary
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Lost the race against a concurrent upsert: the other one created it
+            conv = await conversations_collection.find_one({"pair_key": pair_key}, {"messages": 0})
+
+        if conv['_id'] == new_id and await FriendModel.are_friends(user_id_1, user_id_2):
+            # Only on creation: friends skip the pending state
+            await conversations_collection.update_one({"_id": new_id}, {"$set": {"status": "accepted"}})
+            conv['status'] = "accepted"
+
+        conv['_id'] = str(conv['_id'])
+        if isinstance(conv.get('created_at'), datetime):
+            conv['created_at'] = int(conv['created_at'].timestamp() * 1000)
+        if conv.get('last_message') and isinstance(conv['last_message'].get('created_at'), datetime):
+            conv['last_message']['created_at'] = int(conv['last_message']['created_at'].timestamp() * 1000)
         return conv
     
     @staticmethod
-    def get_user_conversations(user_id):
+    async def get_participants(conversation_id):
+        """Participant ids only (None if the conversation does not exist)"""
+        try:
+            conv_oid = ObjectId(conversation_id)
+        except (InvalidId, TypeError):
+            return None
+        conv = await conversations_collection.find_one({"_id": conv_oid}, {"participants": 1})
+        return conv.get("participants", []) if conv else None
+
+    @staticmethod
+    async def get_user_conversations(user_id):
         convs = conversations_collection.find(
             {"participants": user_id},
             {"messages": 0} # Exclude messages list for summary
         ).sort("last_message.created_at", -1)
         
         result = []
-        for c in convs:
+        async for c in convs:
             c['_id'] = str(c['_id'])
             if c.get('created_at'):
                 c['created_at'] = int(c['created_at'].timestamp() * 1000)
             if c.get('last_message') and c['last_message'].get('created_at'):
                 c['last_message']['created_at'] = int(c['last_message']['created_at'].timestamp() * 1000)
-            pinned = c.get('pinned_message')
-            if pinned:
-                if isinstance(pinned.get('pinned_at'), datetime):
-                    pinned['pinned_at'] = int(pinned['pinned_at'].timestamp() * 1000)
-                if isinstance(pinned.get('created_at'), datetime):
-                    pinned['created_at'] = int(pinned['created_at'].timestamp() * 1000)
+            c.update(pinned_state(c))
             result.append(c)
         return result
 
     @staticmethod
-    def pin_message(conversation_id, message_id, pinned_by):
+    async def pin_message(conversation_id, message_id, pinned_by):
         try:
             conv_oid = ObjectId(conversation_id)
             msg_oid = ObjectId(message_id)
         except:
             return {"status": "error", "message": "Invalid IDs"}
 
-        conv = conversations_collection.find_one({"_id": conv_oid})
-        if not conv:
-            return {"status": "error", "message": "Conversation not found"}
-
-        msg = None
-        for m in conv.get("messages", []):
-            if m.get("_id") == msg_oid:
-                msg = m
-                break
+        msg = await MessageStore.find_message(conv_oid, msg_oid)
         if not msg:
+            if not await conversations_collection.find_one({"_id": conv_oid}, {"_id": 1}):
+                return {"status": "error", "message": "Conversation not found"}
             return {"status": "error", "message": "Message not found"}
 
         pinned = {
@@ -434,50 +583,60 @@ class ConversationModel:
             "pinned_at": datetime.now()
         }
 
-        conversations_collection.update_one(
-            {"_id": conv_oid},
-            {"$set": {"pinned_message": pinned}}
+        # One atomic write: append unless already pinned, keep the newest pins only
+        conv = await conversations_collection.find_one_and_update(
+            {"_id": conv_oid, "pinned_messages.message_id": {"$ne": pinned["message_id"]}},
+            {"$push": {"pinned_messages": {"$each": [pinned], "$slice": -MAX_PINNED_MESSAGES}}},
+            projection={"pinned_messages": 1},
+            return_document=ReturnDocument.AFTER
         )
+        if conv is None:
+            # Already pinned, nothing to change
+            conv = await conversations_collection.find_one({"_id": conv_oid}, {"pinned_messages": 1})
+            if conv is None:
+                # Deleted since the message was found
+                return {"status": "error", "message": "Conversation not found"}
 
-        # Prepare serializable copy
-        pinned_serializable = pinned.copy()
-        if isinstance(pinned_serializable.get("created_at"), datetime):
-            pinned_serializable["created_at"] = int(pinned_serializable["created_at"].timestamp() * 1000)
-        if isinstance(pinned_serializable.get("pinned_at"), datetime):
-            pinned_serializable["pinned_at"] = int(pinned_serializable["pinned_at"].timestamp() * 1000)
-
-        return {"status": "success", "pinned_message": pinned_serializable}
+        return {"status": "success", **pinned_state(conv)}
 
     @staticmethod
-    def unpin_message(conversation_id):
+    async def unpin_message(conversation_id, message_id=None):
+        """Unpin one message, or the latest pin if no message_id is given"""
         try:
             conv_oid = ObjectId(conversation_id)
         except:
             return {"status": "error", "message": "Invalid conversation id"}
 
-        conversations_collection.update_one(
-            {"_id": conv_oid},
-            {"$unset": {"pinned_message": ""}}
+        if message_id:
+            update = {"$pull": {"pinned_messages": {"message_id": str(message_id)}}}
+        else:
+            update = {"$pop": {"pinned_messages": 1}}
+        conv = await conversations_collection.find_one_and_update(
+            {"_id": conv_oid}, update,
+            projection={"pinned_messages": 1},
+            return_document=ReturnDocument.AFTER
         )
-        return {"status": "success", "pinned_message": None}
+        if conv is None:
+            return {"status": "error", "message": "Conversation not found"}
+        return {"status": "success", **pinned_state(conv)}
 
     @staticmethod
-    def accept_conversation(conversation_id):
+    async def accept_conversation(conversation_id):
         # ... same logic ...
         try:
             oid = ObjectId(conversation_id)
-            conversations_collection.update_one({"_id": oid}, {"$set": {"status": "accepted"}})
+            await conversations_collection.update_one({"_id": oid}, {"$set": {"status": "accepted"}})
         except:
             pass
     
     @staticmethod
-    def update_last_message(conversation_id, message):
+    async def update_last_message(conversation_id, message):
         # This is now handled inside MessageModel.insert_message mostly
         # But keeping for compatibility if utilized elsewhere
         pass
 
     @staticmethod
-    def create_group_conversation(creator_id, name, member_ids):
+    async def create_group_conversation(creator_id, name, member_ids):
         """Tạo nhóm chat mới"""
         try:
             # Validate members
@@ -497,13 +656,12 @@ class ConversationModel:
                 "admins": [creator_id],  # Creator is admin
                 "last_message": None,
                 "status": "accepted",
-                "messages": []
+                "message_seq": 0
             }
             
-            result = conversations_collection.insert_one(group)
+            result = await conversations_collection.insert_one(group)
             group['_id'] = str(result.inserted_id)
             group['created_at'] = int(now.timestamp() * 1000)
-            del group['messages']  # Don't return messages array
             
             return {"status": "success", "conversation": group}
         except Exception as e:
@@ -511,11 +669,11 @@ class ConversationModel:
             return {"status": "error", "message": str(e)}
 
     @staticmethod
-    def add_group_member(conversation_id, user_id, new_member_id):
+    async def add_group_member(conversation_id, user_id, new_member_id):
         """Thêm thành viên vào nhóm (chỉ admin)"""
         try:
             conv_oid = ObjectId(conversation_id)
-            conv = conversations_collection.find_one({"_id": conv_oid})
+            conv = await conversations_collection.find_one({"_id": conv_oid})
             
             if not conv or conv.get('type') != 'group':
                 return {"status": "error", "message": "Nhóm không tồn tại"}
@@ -525,7 +683,7 @@ class ConversationModel:
                 return {"status": "error", "message": "Chỉ admin mới có thể thêm thành viên"}
             
             # Add member
-            result = conversations_collection.update_one(
+            result = await conversations_collection.update_one(
                 {"_id": conv_oid},
                 {"$addToSet": {"participants": new_member_id}}
             )
@@ -536,11 +694,11 @@ class ConversationModel:
             return {"status": "error", "message": str(e)}
 
     @staticmethod
-    def remove_group_member(conversation_id, user_id, member_to_remove):
+    async def remove_group_member(conversation_id, user_id, member_to_remove):
         """Xóa thành viên khỏi nhóm (admin hoặc tự rời)"""
         try:
             conv_oid = ObjectId(conversation_id)
-            conv = conversations_collection.find_one({"_id": conv_oid})
+            conv = await conversations_collection.find_one({"_id": conv_oid})
             
             if not conv or conv.get('type') != 'group':
                 return {"status": "error", "message": "Nhóm không tồn tại"}
@@ -557,7 +715,7 @@ class ConversationModel:
                 return {"status": "error", "message": "Không thể xóa người tạo nhóm"}
             
             # Remove member
-            result = conversations_collection.update_one(
+            result = await conversations_collection.update_one(
                 {"_id": conv_oid},
                 {"$pull": {"participants": member_to_remove, "admins": member_to_remove}}
             )
@@ -568,11 +726,11 @@ class ConversationModel:
             return {"status": "error", "message": str(e)}
 
     @staticmethod
-    def update_group_info(conversation_id, user_id, name=None, avatar=None):
+    async def update_group_info(conversation_id, user_id, name=None, avatar=None):
         """Cập nhật thông tin nhóm (chỉ admin)"""
         try:
             conv_oid = ObjectId(conversation_id)
-            conv = conversations_collection.find_one({"_id": conv_oid})
+            conv = await conversations_collection.find_one({"_id": conv_oid})
             
             if not conv or conv.get('type') != 'group':
                 return {"status": "error", "message": "Nhóm không tồn tại"}
@@ -590,7 +748,7 @@ class ConversationModel:
             if not update_fields:
                 return {"status": "error", "message": "Không có gì để cập nhật"}
             
-            conversations_collection.update_one(
+            await conversations_collection.update_one(
                 {"_id": conv_oid},
                 {"$set": update_fields}
             )
@@ -601,11 +759,11 @@ class ConversationModel:
             return {"status": "error", "message": str(e)}
     
     @staticmethod
-    def delete_conversation(conversation_id, user_id):
+    async def delete_conversation(conversation_id, user_id):
         """Xóa conversation (chỉ admin/creator)"""
         try:
             conv_oid = ObjectId(conversation_id)
-            conv = conversations_collection.find_one({"_id": conv_oid})
+            conv = await conversations_collection.find_one({"_id": conv_oid})
             
             if not conv:
                 return {"status": "error", "message": "Conversation không tồn tại"}
@@ -619,8 +777,10 @@ class ConversationModel:
                 if user_id not in conv.get('participants', []):
                     return {"status": "error", "message": "Không có quyền xóa"}
             
-            # Delete conversation
-            conversations_collection.delete_one({"_id": conv_oid})
+            # Delete conversation, its message buckets and its attachment references
+            await conversations_collection.delete_one({"_id": conv_oid})
+            await MessageStore.delete_conversation(conv_oid)
+            await AttachmentStore.release_conversation(conv_oid)
             
             return {"status": "success", "conversation_id": conversation_id, "participants": conv.get('participants', [])}
         except Exception as e:
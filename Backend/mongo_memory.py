@@ -0,0 +1,108 @@
+"""
+In-memory MongoDB stand-in built on mongomock, used when MONGO_URI=mongomock://
+
+Exposes a sync `client` and an `async_client` with the subset of the
+AsyncMongoClient API the app uses. Both share the same data, so
+verify_schema.py can check through `db` what the server wrote through `async_db`.
+"""
+import mongomock
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+class AsyncMemoryCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n):
+        self._cursor = self._cursor.skip(n)
+        return self
+
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+
+    def batch_size(self, n):
+        self._cursor = self._cursor.batch_size(n)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        docs = list(self._cursor)
+        return docs[:length] if length else docs
+
+
+class AsyncMemoryCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return AsyncMemoryCursor(iter(self._collection.aggregate(pipeline, **kwargs)))
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        # mongomock's bulk_write does not accept current pymongo operation objects
+        errors = []
+        for index, op in enumerate(requests):
+            try:
+                if isinstance(op, UpdateOne):
+                    self._collection.update_one(op._filter, op._doc, upsert=op._upsert)
+                elif isinstance(op, InsertOne):
+                    self._collection.insert_one(op._doc)
+                else:
+                    raise NotImplementedError(f"bulk_write: {type(op).__name__}")
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": []})
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return call
+
+
+class AsyncMemoryDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return AsyncMemoryCollection(self._database[name])
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+class AsyncMemoryClient:
+    def __init__(self, sync_client):
+        self._client = sync_client
+
+    def __getitem__(self, name):
+        return AsyncMemoryDatabase(self._client[name])
+
+    async def close(self):
+        pass
+
+
+client = mongomock.MongoClient()
+async_client = AsyncMemoryClient(client)
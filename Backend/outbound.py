@@ -0,0 +1,112 @@
+# outbound.py
+"""
+Per-connection outbound queue.
+
+Each socket gets a bounded queue drained by its own writer task, so a slow
+or stalled client only delays itself: senders enqueue and move on.
+
+When a queue is full:
+- droppable frames (presence) are dropped, and queued presence frames are
+  evicted first to make room for anything else
+- if there is still no room, WS_QUEUE_FULL_POLICY decides:
+    "disconnect" (default) - close the socket (1013 try again later), the
+                             client reconnects and reloads its state
+    "drop"                 - drop the new frame and keep the connection
+"""
+import asyncio
+import os
+from collections import deque
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_QUEUE_FULL_POLICY = os.getenv("WS_QUEUE_FULL_POLICY", "disconnect")
+
+# Soft state: the next update supersedes it, safe to lose under pressure
+DROPPABLE_TYPES = {"presence_batch", "presence_update"}
+
+
+class OutboundQueue:
+    def __init__(self, ws, maxsize=WS_QUEUE_SIZE, policy=WS_QUEUE_FULL_POLICY):
+        self.ws = ws
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._frames = deque()  # (frame, droppable)
+        self._ready = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    def put(self, frame, droppable=False):
+        """Queue a text (str) or binary (bytes) frame. Never blocks; returns False if it was dropped."""
+        if self.closed:
+            return False
+        if len(self._frames) >= self.maxsize:
+            if droppable or not self._evict_droppable():
+                self.dropped += 1
+                if not droppable and self.policy == "disconnect":
+                    self._disconnect()
+                return False
+        self._frames.append((frame, droppable))
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+        return True
+
+    def _evict_droppable(self):
+        for i, (_, droppable) in enumerate(self._frames):
+            if droppable:
+                del self._frames[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def _disconnect(self):
+        print(f"[WS] Outbound queue full ({self.maxsize}), disconnecting slow client")
+        self.closed = True
+        self._frames.clear()
+        self._writer_task.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.ws.close(code=1013)
+        except Exception:
+            pass
+
+    async def _writer(self):
+        while True:
+            if not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            frame, _ = self._frames.popleft()
+            try:
+                if isinstance(frame, bytes):
+                    await self.ws.send_bytes(frame)
+                else:
+                    await self.ws.send_text(frame)
+            except Exception as e:
+                print(f"[WS] send error: {e}")
+                self.closed = True
+                self._frames.clear()
+                return
+            self.sent += 1
+
+    def close(self):
+        """Stop the writer (connection is gone); unsent frames are discarded"""
+        self.closed = True
+        self._frames.clear()
+        self._writer_task.cancel()
+
+    def stats(self):
+        return {
+            "depth": len(self._frames),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,44 @@
+# presence.py
+"""
+Coalesced presence fan-out.
+
+Presence changes are queued per recipient socket and flushed once per window
+as a single `presence_batch` frame: {"updates": [{"user_id", "online", "last_seen"}]}.
+Within a window only the latest state of each user is kept, so reconnect
+flapping (offline -> online -> offline ...) costs one entry per recipient.
+"""
+import asyncio
+import os
+
+PRESENCE_WINDOW = int(os.getenv("PRESENCE_COALESCE_MS", "250")) / 1000
+
+
+class PresenceCoalescer:
+    def __init__(self, send, window=PRESENCE_WINDOW):
+        self._send = send          # async send(ws, type_, data)
+        self._window = window
+        self._pending = {}         # ws -> {user_id: payload}
+        self._flush_task = None
+
+    def publish(self, recipients, payload):
+        """Queue `payload` (must contain user_id) for every socket in `recipients`"""
+        for ws in recipients:
+            self._pending.setdefault(ws, {})[payload["user_id"]] = payload
+        if self._pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def discard(self, ws):
+        """Drop updates queued for a socket that went away"""
+        self._pending.pop(ws, None)
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self._window)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for ws, updates in pending.items():
+            await self._send(ws, "presence_batch", {"updates": list(updates.values())})
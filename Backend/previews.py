@@ -0,0 +1,128 @@
+# previews.py
+"""
+Image previews, rendered in a process pool.
+
+For an uploaded image, `generate` writes resized, recompressed variants next
+to the original (`<sha256>_<variant>.webp`, JPEG when Pillow has no WebP)
+and returns the dimensions:
+
+    {"width", "height", "variants": {"thumb": {"path", "width", "height", "size"}, ...}}
+
+Decoding and resizing are CPU bound, so they run in PREVIEW_WORKERS worker
+processes and never hold the event loop or the GIL of the server process.
+Variants larger than the original are skipped (clients use the original).
+
+Pillow is optional: without it `available()` is False and uploads just
+have no previews. Kept free of app imports, workers only load this module.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # optional dependency
+    Image = None
+
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", "2"))
+# (name, max width/height)
+PREVIEW_VARIANTS = (("thumb", 160), ("small", 480), ("large", 1280))
+PREVIEW_QUALITY = 80
+PREVIEW_MAX_PIXELS = 50_000_000  # larger images are not decoded (decompression bombs)
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+
+_pool = None
+
+
+def available():
+    return Image is not None
+
+
+def is_image(content_type, path):
+    return (content_type or "").startswith("image/") or os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def render_previews(src_path, out_base, variants=PREVIEW_VARIANTS):
+    """
+    Worker process: write the variants of `src_path` to `out_base` + "_<name>.<ext>".
+    Returns the metadata dict (paths are absolute here).
+    """
+    Image.MAX_IMAGE_PIXELS = PREVIEW_MAX_PIXELS
+    ext, fmt = (".webp", "WEBP") if features.check("webp") else (".jpg", "JPEG")
+    with Image.open(src_path) as im:
+        width, height = im.size
+        if width * height > PREVIEW_MAX_PIXELS:
+            raise ValueError(f"image too large ({width}x{height})")
+        # Decode at a reduced scale when the format allows it (JPEG)
+        im.draft("RGB", (variants[-1][1], variants[-1][1]))
+        drafted = im.size
+        im = ImageOps.exif_transpose(im)
+        if im.size != drafted:
+            # EXIF rotation by 90 degrees
+            width, height = height, width
+        if fmt == "JPEG" or im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if fmt == "WEBP" and "A" in im.getbands() else "RGB")
+
+        result = {"width": width, "height": height, "variants": {}}
+        for name, max_side in variants:
+            if max(width, height) <= max_side:
+                continue
+            variant = im.copy()
+            variant.thumbnail((max_side, max_side), Image.LANCZOS)
+            path = f"{out_base}_{name}{ext}"
+            tmp_path = path + ".tmp"
+            variant.save(tmp_path, fmt, quality=PREVIEW_QUALITY)
+            os.replace(tmp_path, path)
+            result["variants"][name] = {
+                "path": path,
+                "width": variant.width,
+                "height": variant.height,
+                "size": os.path.getsize(path)
+            }
+    return result
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn: don't fork the server process (event loop, db client threads)
+        _pool = ProcessPoolExecutor(PREVIEW_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _undecodable(error):
+    """True if the error means the file is not a usable image (as opposed to a crash or an I/O error)"""
+    if isinstance(error, (ValueError, SyntaxError, Image.DecompressionBombError)):
+        return True
+    # Pillow reports unknown formats and broken data as OSErrors without errno
+    return isinstance(error, OSError) and error.errno is None
+
+
+async def generate(src_path, out_base):
+    """
+    Render previews in the pool. Returns the metadata, {} if the file is not
+    a decodable image (final), or None if rendering failed and may be retried
+    (worker crash, I/O error).
+    """
+    if not available():
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_pool(), render_previews, str(src_path), str(out_base))
+    except BrokenProcessPool as e:
+        # A worker died (e.g. out of memory on a huge image): start a fresh pool next time
+        print(f"[Preview] {src_path}: {e}")
+        shutdown()
+        return None
+    except Exception as e:
+        print(f"[Preview] {src_path}: {e}")
+        return {} if _undecodable(e) else None
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
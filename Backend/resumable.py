@@ -0,0 +1,246 @@
+# resumable.py
+"""
+Chunked, resumable uploads for large files.
+
+    POST   /api/uploads                        initiate -> {upload_id, chunk_size, chunk_count, received}
+    PUT    /api/uploads/{id}/chunks/{index}    one chunk (raw body), any order, in parallel, idempotent
+    GET    /api/uploads/{id}                   which chunks the server has (resume after a drop)
+    POST   /api/uploads/{id}/complete          assemble + store like /api/upload
+    DELETE /api/uploads/{id}                   abort
+
+State lives on disk, so an interrupted upload resumes even across restarts:
+
+    uploads/.resumable/<upload_id>/meta.json   owner, conversation, file name, sizes
+    uploads/.resumable/<upload_id>/<index>     received chunks (renamed from .part when complete)
+
+Each chunk request is short and only holds its own chunk. Assembly copies the
+chunks into one file inside the kernel (copy_file_range / sendfile), and the
+sha256 for the attachment store is computed over an mmap of the result, so the
+file data never goes through Python buffers. Unfinished uploads are removed
+after RESUMABLE_UPLOAD_TTL_HOURS.
+"""
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import time
+import uuid
+from fastapi import HTTPException, Request
+from uploads import UPLOAD_DIR, UPLOAD_CHUNK_SIZE, upload_stats
+
+RESUMABLE_DIR = UPLOAD_DIR / ".resumable"
+MAX_RESUMABLE_UPLOAD_BYTES = int(os.getenv("MAX_RESUMABLE_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+RESUMABLE_CHUNK_SIZE = int(os.getenv("RESUMABLE_CHUNK_SIZE", str(8 * 1024 ** 2)))
+RESUMABLE_UPLOAD_TTL = int(os.getenv("RESUMABLE_UPLOAD_TTL_HOURS", "24")) * 3600
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 ** 2
+
+_completing = set()  # upload ids being assembled
+
+
+def _upload_dir(upload_id):
+    # upload ids are uuid4 hex: anything else is not ours (and not a path)
+    if len(upload_id) != 32 or any(c not in "0123456789abcdef" for c in upload_id):
+        raise HTTPException(status_code=404, detail="Unknown upload")
+    return RESUMABLE_DIR / upload_id
+
+
+def _read_meta(directory):
+    try:
+        with open(directory / "meta.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _received(directory):
+    return sorted(int(name) for name in os.listdir(directory) if name.isdigit())
+
+
+def _chunk_length(meta, index):
+    if index == meta["chunk_count"] - 1:
+        return meta["size"] - index * meta["chunk_size"]
+    return meta["chunk_size"]
+
+
+def _status(upload_id, meta, received):
+    return {
+        "upload_id": upload_id,
+        "file_name": meta["file_name"],
+        "size": meta["size"],
+        "chunk_size": meta["chunk_size"],
+        "chunk_count": meta["chunk_count"],
+        "received": received
+    }
+
+
+async def _load(upload_id, user_id):
+    """(directory, meta) of an upload owned by user_id, 404 otherwise"""
+    directory = _upload_dir(upload_id)
+    meta = await asyncio.to_thread(_read_meta, directory)
+    if not meta or meta["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Unknown upload")
+    return directory, meta
+
+
+def _sweep_expired():
+    if not RESUMABLE_DIR.exists():
+        return
+    cutoff = time.time() - RESUMABLE_UPLOAD_TTL
+    for entry in os.scandir(RESUMABLE_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+async def initiate(user_id, conversation_id, file_name, size, content_type=None, chunk_size=None):
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    if size > MAX_RESUMABLE_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large (max {MAX_RESUMABLE_UPLOAD_BYTES} bytes)")
+    chunk_size = min(max(chunk_size or RESUMABLE_CHUNK_SIZE, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    await asyncio.to_thread(_sweep_expired)
+    upload_id = uuid.uuid4().hex
+    meta = {
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "file_name": os.path.basename(file_name.replace("\\", "/")) or "file",
+        "content_type": content_type or "application/octet-stream",
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunk_count": -(-size // chunk_size),
+        "created_at": time.time()
+    }
+
+    def create():
+        directory = RESUMABLE_DIR / upload_id
+        directory.mkdir(parents=True)
+        with open(directory / "meta.json", "w") as f:
+            json.dump(meta, f)
+    await asyncio.to_thread(create)
+    return _status(upload_id, meta, [])
+
+
+async def status(upload_id, user_id):
+    directory, meta = await _load(upload_id, user_id)
+    return _status(upload_id, meta, await asyncio.to_thread(_received, directory))
+
+
+async def put_chunk(upload_id, user_id, index, request: Request):
+    """Stream one chunk to disk; its length must be exactly the expected one"""
+    directory, meta = await _load(upload_id, user_id)
+    if not 0 <= index < meta["chunk_count"]:
+        raise HTTPException(status_code=400, detail="Chunk index out of range")
+    expected = _chunk_length(meta, index)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+
+    part_path = directory / f"{index}.{uuid.uuid4().hex}.part"
+    received = 0
+    fh = await asyncio.to_thread(open, part_path, "wb")
+    try:
+        buffer = bytearray()
+        async for data in request.stream():
+            received += len(data)
+            if received > expected:
+                raise HTTPException(status_code=413, detail=f"Chunk {index} must be {expected} bytes")
+            buffer += data
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                data, buffer = bytes(buffer), bytearray()
+                await asyncio.to_thread(fh.write, data)
+        if buffer:
+            await asyncio.to_thread(fh.write, bytes(buffer))
+        await asyncio.to_thread(fh.close)
+        if received != expected:
+            raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+        # Atomic: a chunk file is either absent or complete (re-sending it just replaces it)
+        await asyncio.to_thread(os.replace, part_path, directory / str(index))
+    except BaseException:
+        def cleanup():
+            fh.close()
+            part_path.unlink(missing_ok=True)
+        await asyncio.to_thread(cleanup)
+        raise
+    upload_stats["bytes"] += received
+    # Touch the upload so the TTL counts from the last activity
+    await asyncio.to_thread(os.utime, directory)
+    return {"upload_id": upload_id, "index": index, "size": received}
+
+
+def _copy_fd(src_fd, dst_fd, count):
+    """Append `count` bytes of src to dst without going through user space when the OS can"""
+    while count > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count)
+        except (AttributeError, OSError):
+            try:
+                copied = os.sendfile(dst_fd, src_fd, None, count)
+            except (AttributeError, OSError):
+                # Portable fallback
+                data = os.read(src_fd, min(count, UPLOAD_CHUNK_SIZE))
+                copied = os.write(dst_fd, data) if data else 0
+        if copied == 0:
+            raise IOError("Chunk shorter than expected")
+        count -= copied
+
+
+def _assemble(directory, meta, target):
+    with open(target, "wb") as out:
+        for index in range(meta["chunk_count"]):
+            with open(directory / str(index), "rb") as chunk:
+                _copy_fd(chunk.fileno(), out.fileno(), _chunk_length(meta, index))
+
+    hasher = hashlib.sha256()
+    with open(target, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        hasher.update(data)  # hashlib releases the GIL while hashing
+    return hasher.hexdigest()
+
+
+async def complete(upload_id, user_id, store):
+    """
+    Assemble the chunks into a `.part` file in UPLOAD_DIR and hand it to
+    `await store(upload, meta)` (upload dict like uploads.receive_upload).
+    The chunks are removed once store succeeds; returns what store returns.
+    """
+    directory, meta = await _load(upload_id, user_id)
+    if upload_id in _completing:
+        raise HTTPException(status_code=409, detail="Upload is already being completed")
+    # Claimed before any await: a concurrent /complete (client retry) gets the 409 above
+    # instead of assembling into the same .part file
+    _completing.add(upload_id)
+    try:
+        missing = sorted(set(range(meta["chunk_count"])) - set(await asyncio.to_thread(_received, directory)))
+        if missing:
+            raise HTTPException(status_code=409, detail={"message": "Missing chunks", "missing": missing[:1000]})
+
+        part_path = UPLOAD_DIR / f".{upload_id}.part"
+        try:
+            sha256 = await asyncio.to_thread(_assemble, directory, meta, part_path)
+            upload = {
+                "fields": {"conversation_id": meta["conversation_id"]},
+                "file_name": meta["file_name"],
+                "part_path": part_path,
+                "size": meta["size"],
+                "sha256": sha256,
+                "content_type": meta["content_type"],
+            }
+            result = await store(upload, meta)
+        except BaseException:
+            # Chunks are kept: completing can be retried
+            await asyncio.to_thread(part_path.unlink, True)
+            raise
+        upload_stats["completed"] += 1
+        # Still claimed until the chunks are gone, so a retry can't store the file twice
+        await discard(upload_id)
+        return result
+    finally:
+        _completing.discard(upload_id)
+
+
+async def discard(upload_id):
+    """Remove an upload's chunks (after completion, or to abort)"""
+    await asyncio.to_thread(shutil.rmtree, _upload_dir(upload_id), True)
+    _completing.discard(upload_id)
@@ -0,0 +1,226 @@
+# schema.py
+"""
+Index bootstrap.
+
+Indexes are declared as versioned steps. On startup `ensure_indexes` applies
+every step newer than the version recorded in `schema_meta` (create_index is
+idempotent, so running it from several workers at once is harmless) and then
+records the new version. To add an index, append a step with the next version;
+to remove one, add a drop step (indexes no query uses still cost every write).
+A version can also have a backfill, run before its indexes are created, for
+fields the new indexes depend on (or on its own, for data-only changes).
+
+CLI:
+    python schema.py apply     # create missing indexes
+    python schema.py explain   # show which index each hot query uses
+"""
+import sys
+import asyncio
+from datetime import datetime
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+from db import async_db
+from models import direct_pair_key
+from user_search import search_fields, prefix_filter, gram_filter
+
+# (version, collection, index)
+INDEX_STEPS = [
+    # Message buckets: (conversation, sequence range) + single message lookups
+    (1, "message_buckets", IndexModel([("conversation_id", 1), ("bucket", -1)], unique=True, name="conversation_bucket")),
+    (1, "message_buckets", IndexModel([("conversation_id", 1), ("messages._id", 1)], name="conversation_message_id")),
+    # get_user_by_username / authenticate; also what makes registration race-free
+    (1, "users", IndexModel([("username", 1)], unique=True, name="username_unique")),
+    # get_user_conversations: filter on participants, sort on last message time
+    (1, "conversations", IndexModel([("participants", 1), ("last_message.created_at", -1)], name="participants_last_message")),
+    # Direct conversations: one per user pair, looked up / created by upsert
+    (2, "conversations", IndexModel([("pair_key", 1)], unique=True, sparse=True, name="direct_pair_key")),
+    # Attachment references released when a conversation is deleted
+    (4, "attachments", IndexModel([("conversation_ids", 1)], name="attachment_conversations")),
+    # UserModel.search_users: prefix range on normalized keys, trigrams for substrings
+    (5, "users", IndexModel([("search_keys", 1)], name="user_search_keys")),
+    (5, "users", IndexModel([("search_grams", 1)], name="user_search_grams")),
+]
+
+# (version, collection, index name)
+DROP_STEPS = [
+    # Direct conversation lookup by type + participants, replaced by pair_key (version 2)
+    (6, "conversations", "type_participants"),
+]
+
+
+# Queries on the hot path, checked by `python schema.py explain`
+# (name, collection, filter, sort)
+HOT_QUERIES = [
+    ("UserModel.get_user", "users", {"_id": "someone@example.com"}, None),
+    ("UserModel.get_user_by_username", "users", {"username": "someone"}, None),
+    ("UserModel.authenticate", "users", {"$or": [{"_id": "someone"}, {"username": "someone"}]}, None),
+    ("UserModel.search_users (prefix)", "users", prefix_filter("some"), None),
+    ("UserModel.search_users (substring)", "users", gram_filter("meon"), None),
+    ("ConversationModel.get_user_conversations", "conversations", {"participants": "someone@example.com"}, [("last_message.created_at", -1)]),
+    ("ConversationModel.create_or_get_direct_conversation", "conversations",
+     {"pair_key": "a@example.com|b@example.com"}, None),
+    ("MessageStore.get_page", "message_buckets", {"conversation_id": None, "bucket": {"$lte": 10}}, [("bucket", -1)]),
+    ("MessageStore.find_message", "message_buckets", {"conversation_id": None, "messages._id": None}, None),
+]
+
+schema_meta_collection = async_db['schema_meta']
+conversations_collection = async_db['conversations']
+users_collection = async_db['users']
+
+
+async def backfill_direct_pair_keys():
+    """
+    Give existing direct conversations their pair key. If a pair already has
+    several conversations (created by the old check-then-insert race), only
+    the oldest one gets the key; the others stay reachable by id.
+    """
+    seen = set()
+    async for conv in conversations_collection.find(
+        {"type": "direct", "pair_key": {"$exists": False}}, {"participants": 1}
+    ).sort("_id", 1):
+        participants = conv.get("participants") or []
+        if len(participants) != 2:
+            continue
+        key = direct_pair_key(*participants)
+        if key in seen or await conversations_collection.find_one({"pair_key": key}, {"_id": 1}):
+            continue
+        seen.add(key)
+        await conversations_collection.update_one({"_id": conv["_id"]}, {"$set": {"pair_key": key}})
+
+
+async def backfill_pinned_messages():
+    """Single `pinned_message` -> `pinned_messages` list (several pins per conversation)"""
+    async for conv in conversations_collection.find(
+        {"pinned_message": {"$exists": True}, "pinned_messages": {"$exists": False}}, {"pinned_message": 1}
+    ):
+        pins = [conv["pinned_message"]] if conv.get("pinned_message") else []
+        await conversations_collection.update_one(
+            {"_id": conv["_id"], "pinned_messages": {"$exists": False}},
+            {"$set": {"pinned_messages": pins}, "$unset": {"pinned_message": ""}}
+        )
+
+
+async def backfill_user_search_keys():
+    """search_keys / search_grams for users created before user search used them"""
+    async for user in users_collection.find({"search_keys": {"$exists": False}}, {"username": 1}):
+        await users_collection.update_one(
+            {"_id": user["_id"]},
+            {"$set": search_fields(user["_id"], user.get("username"))}
+        )
+
+
+# version -> backfill to run before that version's indexes
+BACKFILLS = {
+    2: backfill_direct_pair_keys,
+    3: backfill_pinned_messages,
+    5: backfill_user_search_keys,
+}
+
+INDEX_VERSION = max(max(step[0] for step in INDEX_STEPS + DROP_STEPS), max(BACKFILLS))
+
+
+async def ensure_indexes(force=False):
+    """Create indexes added since the last recorded version. Never raises (startup must go on)."""
+    meta = await schema_meta_collection.find_one({"_id": "indexes"}) or {}
+    current = 0 if force else meta.get("version", 0)
+    if current >= INDEX_VERSION:
+        return current
+
+    applied = current
+    failed = False
+    for version in sorted({step[0] for step in INDEX_STEPS + DROP_STEPS} | set(BACKFILLS)):
+        if version <= current:
+            continue
+        if version in BACKFILLS:
+            try:
+                await BACKFILLS[version]()
+            except PyMongoError as e:
+                failed = True
+                print(f"[Schema] Backfill for index version {version} failed: {e}")
+
+        for step_version, collection, index in INDEX_STEPS:
+            if step_version != version:
+                continue
+            try:
+                await async_db[collection].create_indexes([index])
+                print(f"[Schema] {collection}: ensured {index.document['name']}")
+            except PyMongoError as e:
+                # e.g. duplicate usernames already in the data: keep serving and keep
+                # applying the other steps, this version is retried on next startup
+                failed = True
+                print(f"[Schema] Failed to create {index.document['name']} on {collection}: {e}")
+
+        for step_version, collection, name in DROP_STEPS:
+            if step_version != version:
+                continue
+            try:
+                # Absent on new databases (never created) and once dropped
+                if name in await async_db[collection].index_information():
+                    await async_db[collection].drop_index(name)
+                    print(f"[Schema] {collection}: dropped {name}")
+            except PyMongoError as e:
+                failed = True
+                print(f"[Schema] Failed to drop {name} on {collection}: {e}")
+
+        if not failed:
+            applied = version
+
+    if applied > current:
+        await schema_meta_collection.update_one(
+            {"_id": "indexes"},
+            {"$set": {"version": applied, "applied_at": datetime.now()}},
+            upsert=True
+        )
+    return applied
+
+
+def _plan_stages(plan):
+    """Flatten an explain plan into (stage, index name) pairs"""
+    if not isinstance(plan, dict):
+        return []
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    for key in ("inputStage", "queryPlan"):
+        stages += _plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+
+async def explain_hot_queries():
+    print(f"{'query':55} {'plan':10} index")
+    for name, collection, query, sort in HOT_QUERIES:
+        cursor = async_db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.limit(1).explain()
+        stages = _plan_stages(plan.get("queryPlanner", {}).get("winningPlan", {}))
+        indexes = [idx for _, idx in stages if idx]
+        kinds = [stage for stage, _ in stages if stage]
+        if "COLLSCAN" in kinds:
+            verdict = "COLLSCAN"
+        elif "SORT" in kinds:
+            # index used for the filter but the sort happens in memory
+            verdict = "IX+SORT"
+        elif indexes:
+            verdict = "IXSCAN"
+        elif "IDHACK" in kinds or "EXPRESS_IXSCAN" in kinds:
+            verdict = "_id"
+        else:
+            verdict = "?"
+        print(f"{name:55} {verdict:10} {', '.join(indexes) or '-'}")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "apply"
+    if command == "apply":
+        version = asyncio.run(ensure_indexes(force="--force" in sys.argv))
+        print(f"[Schema] Index version {version}/{INDEX_VERSION}")
+    elif command == "explain":
+        asyncio.run(explain_hot_queries())
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
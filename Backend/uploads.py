@@ -0,0 +1,207 @@
+# uploads.py
+"""
+Streaming multipart uploads.
+
+The request body is parsed as it arrives (python-multipart's streaming
+parser) instead of being spooled by the framework first. File data is
+written in UPLOAD_CHUNK_SIZE blocks from a worker thread, together with the
+sha256 update, so the event loop only shuffles buffers and concurrent
+uploads don't delay WebSocket traffic.
+
+- the size limit (MAX_UPLOAD_BYTES) is checked against Content-Length
+  before reading anything, then enforced while streaming (413)
+- data goes to a `.part` file that the caller moves into place (see
+  attachments.py) once the whole upload is received; on any failure
+  (limit, bad request, client disconnect) the partial file is removed
+"""
+import asyncio
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+import metrics
+
+UPLOAD_DIR = Path("uploads")
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+MAX_FIELD_BYTES = 64 * 1024  # text fields (conversation_id, text)
+MULTIPART_OVERHEAD = 64 * 1024  # boundaries + part headers + text fields
+
+# Counters since start (metrics)
+upload_stats = {"active": 0, "completed": 0, "failed": 0, "rejected_too_large": 0, "bytes": 0}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _write_chunk(fh, hasher, data):
+    # Runs in a worker thread: hashlib releases the GIL on large buffers
+    hasher.update(data)
+    fh.write(data)
+
+
+class _FormState:
+    """What the parser callbacks collect for the current part"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.fields = {}
+        self.file_name = None
+        self.content_type = None
+        self.size = 0
+        self.buffer = bytearray()   # file data not written yet
+        self.file_done = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._part_name = None
+        self._part_is_file = False
+        self._part_value = bytearray()
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._part_value = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._part_name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        self._part_is_file = filename is not None
+        if self._part_is_file:
+            if self.file_name is not None:
+                raise HTTPException(status_code=400, detail="Only one file per upload")
+            # Keep the base name only (no directories from the client)
+            self.file_name = Path(filename.decode("utf-8", "replace").replace("\\", "/")).name or "file"
+            self.content_type = self._headers.get(b"content-type", b"application/octet-stream").decode("latin-1")
+
+    def on_part_data(self, data, start, end):
+        if self._part_is_file:
+            self.size += end - start
+            if self.size > self.max_bytes:
+                raise UploadTooLarge()
+            self.buffer += data[start:end]
+        else:
+            self._part_value += data[start:end]
+            if len(self._part_value) > MAX_FIELD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Field {self._part_name} too large")
+
+    def on_part_end(self):
+        if self._part_is_file:
+            self.file_done = True
+        else:
+            self.fields[self._part_name] = self._part_value.decode("utf-8", "replace")
+
+
+async def receive_upload(request: Request, max_bytes=None):
+    """
+    Stream a multipart/form-data request with one file part to a `.part` file in UPLOAD_DIR.
+    Returns {"fields": {name: str}, "file_name", "part_path", "size", "sha256", "content_type"};
+    the caller owns `part_path` (move it into place or `discard_upload`).
+    Raises HTTPException (400 / 413) on bad or too large uploads.
+    """
+    if max_bytes is None:
+        max_bytes = MAX_UPLOAD_BYTES
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD:
+        upload_stats["rejected_too_large"] += 1
+        raise HTTPException(status_code=413, detail=f"File too large (max {max_bytes} bytes)")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+
+    state = _FormState(max_bytes)
+    parser = MultipartParser(boundary, state.callbacks())
+    hasher = hashlib.sha256()
+    part_path = UPLOAD_DIR / f".{uuid.uuid4().hex}.part"
+    fh = None
+
+    upload_stats["active"] += 1
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if state.file_name is None:
+                continue
+            if fh is None:
+                fh = await asyncio.to_thread(open, part_path, "wb")
+            if len(state.buffer) >= UPLOAD_CHUNK_SIZE or (state.file_done and state.buffer):
+                data, state.buffer = bytes(state.buffer), bytearray()
+                await asyncio.to_thread(_write_chunk, fh, hasher, data)
+        parser.finalize()
+
+        if state.file_name is None or not state.file_done:
+            raise HTTPException(status_code=400, detail="No file in upload")
+        if state.buffer:
+            await asyncio.to_thread(_write_chunk, fh, hasher, bytes(state.buffer))
+        await asyncio.to_thread(fh.close)
+    except UploadTooLarge:
+        upload_stats["rejected_too_large"] += 1
+        await _discard(fh, part_path)
+        raise HTTPException(status_code=413, detail=f"File too large (max {max_bytes} bytes)")
+    except BaseException:
+        # Includes client disconnects and cancellation
+        upload_stats["failed"] += 1
+        await _discard(fh, part_path)
+        raise
+    finally:
+        upload_stats["active"] -= 1
+
+    upload_stats["completed"] += 1
+    upload_stats["bytes"] += state.size
+    return {
+        "fields": state.fields,
+        "file_name": state.file_name,
+        "part_path": part_path,
+        "size": state.size,
+        "sha256": hasher.hexdigest(),
+        "content_type": state.content_type,
+    }
+
+
+async def discard_upload(upload):
+    """Remove the `.part` file of an upload that won't be kept"""
+    await _discard(None, upload["part_path"])
+
+
+async def _discard(fh, part_path):
+    def cleanup():
+        if fh is not None and not fh.closed:
+            fh.close()
+        part_path.unlink(missing_ok=True)
+    await asyncio.to_thread(cleanup)
+
+
+@metrics.register_collector
+def _upload_metrics():
+    return [
+        ("chat_uploads_active", "gauge", "Uploads being received", [({}, upload_stats["active"])]),
+        ("chat_uploads_total", "counter", "Finished uploads by result", [
+            ({"result": result}, upload_stats[result]) for result in ("completed", "failed", "rejected_too_large")
+        ]),
+        ("chat_upload_bytes_total", "counter", "File bytes received (multipart and chunked uploads)", [({}, upload_stats["bytes"])]),
+    ]
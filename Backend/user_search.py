@@ -0,0 +1,132 @@
+# user_search.py
+"""
+Normalized search keys for user search (UserModel.search_users).
+
+Every user document carries
+
+    "search_keys":  [username, user id (email), local part of the email]
+    "search_grams": trigrams of the search keys
+
+both indexed (schema.py). Keys are lowercased, without accents
+("Đức Anh" -> "ducanh") and without whitespace, and queries are normalized
+the same way, so the search is case and accent insensitive.
+
+- prefix matches are an index range scan on search_keys
+- substring matches (queries of GRAM_SIZE+ characters) use the query's
+  trigrams ($all on search_grams), candidates are then checked for the
+  actual substring
+
+Results are ranked exact > prefix > substring, friends first within a rank.
+Candidate lists of recent queries are kept in a small LRU (hot prefixes
+while typing), cleared whenever a user is created.
+"""
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+import metrics
+
+GRAM_SIZE = 3
+SEARCH_CANDIDATES = 200  # per index query, before ranking
+USER_SEARCH_CACHE_SIZE = int(os.getenv("USER_SEARCH_CACHE_SIZE", "256"))  # 0 disables the cache
+USER_SEARCH_CACHE_TTL = float(os.getenv("USER_SEARCH_CACHE_TTL", "30"))
+
+RANK_EXACT, RANK_PREFIX, RANK_SUBSTRING = 0, 1, 2
+
+# Letters with no decomposition in NFKD
+_FOLD = str.maketrans({"đ": "d", "ð": "d", "ø": "o", "ł": "l", "ß": "ss", "æ": "ae", "œ": "oe"})
+
+
+def normalize(text):
+    """Lowercase, accents and whitespace removed"""
+    text = unicodedata.normalize("NFKD", (text or "").lower().translate(_FOLD))
+    return "".join(c for c in text if not unicodedata.combining(c) and not c.isspace())
+
+
+def grams(key):
+    return {key[i:i + GRAM_SIZE] for i in range(len(key) - GRAM_SIZE + 1)}
+
+
+def search_fields(user_id, username):
+    """search_keys / search_grams of a user document"""
+    keys = []
+    for value in (username, user_id, (user_id or "").split("@", 1)[0]):
+        key = normalize(value)
+        if key and key not in keys:
+            keys.append(key)
+    return {"search_keys": keys, "search_grams": sorted(set().union(*map(grams, keys)))}
+
+
+def prefix_filter(query):
+    """
+    Range on search_keys matching keys that start with the normalized query.
+    $elemMatch: both bounds must hold for the same key (search_keys is an
+    array), which also lets Mongo scan the bounded index range.
+    """
+    return {"search_keys": {"$elemMatch": {"$gte": query, "$lt": query[:-1] + chr(ord(query[-1]) + 1)}}}
+
+
+def gram_filter(query):
+    """Candidates containing the query: every trigram of it (None if the query is too short)"""
+    if len(query) < GRAM_SIZE:
+        return None
+    return {"search_grams": {"$all": sorted(grams(query))}}
+
+
+def rank(query, keys):
+    """RANK_* of the best matching key, None if no key contains the query"""
+    best = None
+    for key in keys:
+        if key == query:
+            return RANK_EXACT
+        if key.startswith(query):
+            best = RANK_PREFIX
+        elif query in key and best is None:
+            best = RANK_SUBSTRING
+    return best
+
+
+class SearchCache:
+    """LRU of normalized query -> ranked candidates, entries expire after `ttl` seconds"""
+    def __init__(self, maxsize=USER_SEARCH_CACHE_SIZE, ttl=USER_SEARCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # query -> (expires_at, candidates)
+
+    def get(self, query):
+        entry = self._entries.get(query)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(query)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, query, candidates):
+        if self.maxsize <= 0:
+            return
+        self._entries[query] = (time.monotonic() + self.ttl, candidates)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+search_cache = SearchCache()
+
+
+@metrics.register_collector
+def _search_cache_metrics():
+    return [
+        ("chat_user_search_cache_requests_total", "counter", "User search cache lookups by result", [
+            ({"result": "hit"}, search_cache.hits), ({"result": "miss"}, search_cache.misses)
+        ]),
+        ("chat_user_search_cache_entries", "gauge", "Queries in the user search cache", [({}, len(search_cache))]),
+    ]
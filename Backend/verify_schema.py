@@ -1,4 +1,7 @@
 # verify_schema.py
+# End-to-end check of the REST + WS flow.
+# Runs against the mongod in MONGO_URI, or in memory without one:
+#   MONGO_URI=mongomock:// MONGO_DB=test python verify_schema.py
 from fastapi.testclient import TestClient
 from main import app
 from db import db
@@ -12,13 +15,14 @@ def test_flow():
     
     # Cleanup test users
     db.users.delete_many({"username": {"$in": ["verifyA", "verifyB"]}})
+    db.conversations.delete_many({"participants": {"$in": ["verifya@example.com", "verifyb@example.com"]}})
     
     # 1. Register
     print("\n[1/6] Registering verifyA and verifyB...")
-    resA = client.post("/api/register", json={"username": "verifyA", "password": "password123"})
+    resA = client.post("/api/register", json={"username": "verifyA", "email": "verifya@example.com", "password": "password123"})
     assert resA.status_code == 200, f"Register A failed: {resA.text}"
     
-    resB = client.post("/api/register", json={"username": "verifyB", "password": "password123"})
+    resB = client.post("/api/register", json={"username": "verifyB", "email": "verifyb@example.com", "password": "password123"})
     assert resB.status_code == 200, f"Register B failed: {resB.text}"
 
     # 2. Login
@@ -85,8 +89,8 @@ def test_flow():
         else:
             raise Exception("FAILED: Friend ID not found in User document.")
 
-        # 6. Conversation & Message Embedding Check
-        print("\n[6/6] Testing Message Embedding...")
+        # 6. Conversation & Message Bucket Check
+        print("\n[6/6] Testing Message Buckets...")
         # Get conv
         wsA.send_json({"type": "get_direct_conversation", "data": {"other_user_id": idB}})
         while True:
@@ -100,7 +104,7 @@ def test_flow():
             "data": {
                 "conversation_id": conv_id, 
                 "client_msg_id": "verify_msg_1",
-                "text": "Checking Embedded Messages"
+                "text": "Checking Message Buckets"
             }
         })
         time.sleep(0.5)
@@ -108,20 +112,22 @@ def test_flow():
         # CHECK DB
         try:
             conv_oid = ObjectId(conv_id)
-            conv_doc = db.conversations.find_one({"_id": conv_oid})
-            msgs = conv_doc.get("messages", [])
-            print(f"   DB Check: Conversation {conv_id} has {len(msgs)} messages.")
+            bucket = db.message_buckets.find_one({"conversation_id": conv_oid}, sort=[("bucket", -1)])
+            msgs = bucket.get("messages", []) if bucket else []
+            print(f"   DB Check: Conversation {conv_id} latest bucket has {len(msgs)} messages.")
             
-            if len(msgs) > 0 and msgs[-1]["text"] == "Checking Embedded Messages":
-                print("   ✅ SUCCESS: Message is EMBEDDED in Conversation document.")
+            if len(msgs) > 0 and msgs[-1]["text"] == "Checking Message Buckets":
+                print("   ✅ SUCCESS: Message is stored in the conversation's message bucket.")
             else:
-                raise Exception("FAILED: Message not found embedded in Conversation.")
+                raise Exception("FAILED: Message not found in message buckets.")
         except Exception as e:
             raise Exception(f"DB Check Failed: {e}")
 
 if __name__ == "__main__":
     try:
-        test_flow()
+        # Keep a single event loop for the whole run (the async Mongo client is bound to it)
+        with client:
+            test_flow()
         print("\n--- ALL CHECKS PASSED ---")
     except Exception as e:
         print(f"\n❌ ERROR: {e}")
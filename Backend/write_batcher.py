@@ -0,0 +1,142 @@
+# write_batcher.py
+"""
+Group commit for message inserts.
+
+With MESSAGE_BATCH_WINDOW_MS > 0, inserts arriving within the window are
+written together: one sequence allocation per conversation (concurrently),
+then one bulk_write for all the buckets touched. Messages of a conversation
+get consecutive sequence numbers in arrival order. Each `append` returns only
+once its batch is stored, so acks are never sent for unwritten messages; if
+the flush fails, every waiter of the batch gets the error.
+
+A batch is flushed when the window expires or MESSAGE_BATCH_MAX inserts are
+pending, whichever comes first; while a flush is running the next batch
+builds up behind it. A window of 0 (default) disables batching: MessageStore
+writes every message on its own.
+"""
+import asyncio
+import os
+from message_store import MessageStore, bucket_of
+import metrics
+
+MESSAGE_BATCH_WINDOW = int(os.getenv("MESSAGE_BATCH_WINDOW_MS", "0")) / 1000
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", "500"))
+
+
+class WriteBatcher:
+    def __init__(self, window=MESSAGE_BATCH_WINDOW, max_batch=MESSAGE_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        # counters
+        self.batches = 0
+        self.messages = 0
+        self._pending = []  # (conv_oid, message, last_message, future)
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def append(self, conv_oid, message, last_message):
+        """Same contract as MessageStore.append, resolved when the batch is flushed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((conv_oid, message, last_message, future))
+        if len(self._pending) >= self.max_batch:
+            asyncio.create_task(self._flush(self._take()))
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    def _take(self):
+        pending, self._pending = self._pending, []
+        return pending
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._flush_task = None
+        await self._flush(self._take())
+
+    async def _flush(self, pending):
+        if not pending:
+            return
+        try:
+            # One flush at a time: a later batch never overtakes an earlier one,
+            # which keeps sequence order = arrival order across batches
+            async with self._lock:
+                stored = await self._write(pending)
+        except Exception as e:
+            print(f"[DB] Message batch of {len(pending)} failed: {e}")
+            for *_, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.messages += len(pending)
+        for (_, message, _, future), ok in zip(pending, stored):
+            if not future.done():
+                future.set_result(message if ok else None)
+
+    async def _write(self, pending):
+        """Store a batch. Returns, per entry, whether its conversation exists."""
+        by_conversation = {}  # conv_oid -> [indexes into pending], arrival order
+        for i, (conv_oid, *_) in enumerate(pending):
+            by_conversation.setdefault(conv_oid, []).append(i)
+
+        async def allocate(conv_oid, indexes):
+            last_message = pending[indexes[-1]][2]
+            return await MessageStore.allocate(conv_oid, len(indexes), last_message)
+
+        allocations = await asyncio.gather(*(
+            allocate(conv_oid, indexes) for conv_oid, indexes in by_conversation.items()
+        ))
+
+        stored = [False] * len(pending)
+        groups = {}  # (conv_oid, bucket) -> [messages]
+        for (conv_oid, indexes), allocated in zip(by_conversation.items(), allocations):
+            if allocated is None:
+                continue
+            for offset, i in enumerate(indexes):
+                message = pending[i][1]
+                message["seq"] = allocated[0] + offset
+                groups.setdefault((conv_oid, bucket_of(message["seq"])), []).append(message)
+                stored[i] = True
+        if groups:
+            try:
+                await MessageStore.write_buckets(groups)
+            except Exception:
+                # Nothing else allocates while this flush holds the lock: give the numbers back
+                await asyncio.gather(*(
+                    MessageStore.release(conv_oid, allocated[0], len(indexes), allocated[1])
+                    for (conv_oid, indexes), allocated in zip(by_conversation.items(), allocations)
+                    if allocated is not None
+                ))
+                raise
+        return stored
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "pending": len(self._pending)
+        }
+
+
+# Shared writer, None when batching is disabled
+batcher = WriteBatcher() if MESSAGE_BATCH_WINDOW > 0 else None
+
+
+async def append_message(conv_oid, message, last_message):
+    if batcher is not None:
+        return await batcher.append(conv_oid, message, last_message)
+    return await MessageStore.append(conv_oid, message, last_message)
+
+
+@metrics.register_collector
+def _batcher_metrics():
+    if batcher is None:
+        return []
+    stats = batcher.stats()
+    return [
+        ("chat_message_batches_total", "counter", "Message write batches flushed", [({}, stats["batches"])]),
+        ("chat_message_batched_total", "counter", "Messages written in batches", [({}, stats["messages"])]),
+        ("chat_message_batch_pending", "gauge", "Messages waiting for the next batch", [({}, stats["pending"])]),
+    ]
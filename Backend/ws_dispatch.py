@@ -0,0 +1,120 @@
+# ws_dispatch.py
+"""
+WS message handlers: registry and per-connection dispatch.
+
+Handlers are registered by message type:
+
+    @ws_handler("send_message", order=by_conversation)
+    async def handle_send_message(ws, sender_id, data, request_id): ...
+
+Each connection handles up to WS_MAX_INFLIGHT messages concurrently, so a
+slow request (a big conversation list, a search) doesn't hold up the next
+ones. Replies still carry the request_id of their message.
+
+Ordering is kept only where it matters, through `order`: messages whose
+order key is equal run one after the other, in arrival order; messages
+without a key run as soon as a slot is free.
+
+    by_conversation    sends / pins / membership changes of one conversation
+    by_user(field)     friend requests etc. with one other user
+    SERIAL             one at a time per message type (later replies supersede
+                       earlier ones, e.g. search results while typing)
+
+Handlers registered with inline=True (auth) are awaited before the next
+frame is read, so what follows sees their effect. When all slots are busy
+the connection stops reading, which pushes back on the client.
+"""
+import asyncio
+import os
+import time
+import traceback
+from collections import namedtuple
+from fanout import ws_send
+import loop_watchdog
+import metrics
+
+WS_MAX_INFLIGHT = max(1, int(os.getenv("WS_MAX_INFLIGHT", "8")))  # 1 = one message at a time
+
+WsHandler = namedtuple("WsHandler", "func order inline")
+handlers = {}  # type -> WsHandler
+
+SERIAL = object()
+
+
+def by_conversation(data):
+    # str(): keys must be hashable whatever the client sent
+    return ("conversation", str(data.get("conversation_id")))
+
+
+def by_user(field):
+    def key(data):
+        return ("user", str(data.get(field)))
+    return key
+
+
+def ws_handler(type_, order=None, inline=False):
+    def register(func):
+        handlers[type_] = WsHandler(func, order, inline)
+        return func
+    return register
+
+
+class Dispatcher:
+    """Runs the handlers of one connection"""
+    def __init__(self, ws, max_inflight=WS_MAX_INFLIGHT):
+        self.ws = ws
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks = set()
+        self._tails = {}  # order key -> task of the last message with that key
+
+    async def dispatch(self, type_, handler, user_id, data, request_id):
+        """Start handling a message. Waits for a free slot; inline handlers are also waited for."""
+        await self._slots.acquire()
+        if handler.inline:
+            await self._run(type_, handler.func, None, user_id, data, request_id)
+            return
+
+        key = None
+        if handler.order is SERIAL:
+            key = ("type", type_)
+        elif handler.order is not None:
+            key = handler.order(data)
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._run(type_, handler.func, previous, user_id, data, request_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda t: self._tails.pop(key) if self._tails.get(key) is t else None)
+
+    async def _run(self, type_, func, previous, user_id, data, request_id):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            loop_watchdog.set_context(type=type_, request_id=request_id, user_id=user_id)
+            started = time.perf_counter()
+            try:
+                await func(self.ws, user_id, data, request_id)
+            except Exception as e:
+                # One failing message must not take the connection (or its other messages) down
+                print(f"[WS] {type_} handler error: {e}")
+                traceback.print_exc()
+                await ws_send(self.ws, "error", {"code": "INTERNAL_ERROR", "message": f"{type_} failed"}, request_id)
+            finally:
+                metrics.ws_handler_seconds.observe(time.perf_counter() - started, type_)
+                loop_watchdog.clear_context()
+        finally:
+            self._slots.release()
+
+    @property
+    def inflight(self):
+        return len(self._tasks)
+
+    async def drain(self):
+        """Wait for the messages being handled (connection closing)"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
@@ -306,7 +306,10 @@ export function updateChatHeader(conversation) {
   const pinnedText = pinned
     ? (pinned.text || pinned.file_name || (pinned.msg_type === 'image' ? '[Image]' : 'Pinned message'))
     : '';
-  const pinnedMeta = pinned ? `Pinned by ${pinned.pinned_by || ''}` : '';
+  const pinnedCount = (conversation.pinned_messages || []).length;
+  const pinnedMeta = pinned
+    ? `Pinned by ${pinned.pinned_by || ''}${pinnedCount > 1 ? ` (${pinnedCount} pinned)` : ''}`
+    : '';
   const pinnedTime = pinned?.created_at
     ? new Date(pinned.created_at).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })
     : '';
@@ -369,7 +372,7 @@ export function updateChatHeader(conversation) {
     const unpinBtn = pinnedBar.querySelector('#unpin-btn');
     if (unpinBtn) {
       unpinBtn.addEventListener('click', () => {
-        sendEvent('unpin_message', { conversation_id: conversation._id });
+        sendEvent('unpin_message', { conversation_id: conversation._id, message_id: pinned.message_id });
       });
     }
   }
@@ -411,6 +414,7 @@ export function loadConversationMessages(conversationId) {
       messageData.fileUrl = msg.file_url;
       messageData.fileName = msg.file_name;
       messageData.fileSize = msg.file_size;
+      messageData.image = msg.image;
     }
     
     appendMessageToUI(messageData);
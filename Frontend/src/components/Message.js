@@ -17,10 +17,13 @@ export function createMessage(data, options = {}) {
     let contentHtml = '';
     const isTextMessage = !data.type || data.type === 'text';
     if (data.type === 'image' && data.fileUrl) {
-        // Image message
+        // Image message: small preview variant first (if the server rendered one), original on click
+        const variants = data.image?.variants || {};
+        const preview = variants.small || variants.thumb;
+        const size = preview ? `width="${preview.width}" height="${preview.height}"` : '';
         contentHtml = `
       <div class="rounded-lg overflow-hidden max-w-sm">
-        <img src="${data.fileUrl}" alt="${data.fileName || 'Image'}" class="w-full h-auto cursor-pointer hover:opacity-90 transition-opacity" onclick="window.openImageModal('${data.fileUrl}')" />
+        <img src="${preview ? preview.url : data.fileUrl}" ${size} loading="lazy" alt="${data.fileName || 'Image'}" class="w-full h-auto cursor-pointer hover:opacity-90 transition-opacity" onclick="window.openImageModal('${data.fileUrl}')" />
       </div>
       ${data.text ? `<div class="mt-2 ${isMe ? 'text-white' : 'text-slate-800'} leading-relaxed">${data.text}</div>` : ''}
     `;
@@ -175,6 +175,64 @@ function isTokenExpired(token, skewSeconds = 30) {
     }
 }
 
+// Hex sha256 of a file (content-addressed attachments); null if WebCrypto is unavailable.
+// WebCrypto can't hash incrementally, so the whole file is read: only call it for small files
+async function sha256Hex(file) {
+    if (!window.crypto?.subtle) return null;
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Large files go through the chunked upload API: parallel chunks, retried, resumable after a reload
+const RESUMABLE_THRESHOLD = 16 * 1024 * 1024;
+const RESUMABLE_PARALLEL = 3;
+
+async function uploadResumable(file, conversationId, token) {
+    const api = 'http://localhost:8000/api/uploads';
+    const headers = { 'Authorization': `Bearer ${token}` };
+    const key = `upload:${conversationId}:${file.name}:${file.size}:${file.lastModified}`;
+
+    // Resume an upload of the same file if the server still has it
+    let upload = null;
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const res = await fetch(`${api}/${savedId}`, { headers });
+        if (res.ok) upload = await res.json();
+    }
+    if (!upload) {
+        const res = await fetch(api, {
+            method: 'POST',
+            headers: { ...headers, 'Content-Type': 'application/json' },
+            body: JSON.stringify({ conversation_id: conversationId, file_name: file.name, size: file.size, content_type: file.type || null })
+        });
+        if (!res.ok) throw new Error('Upload failed');
+        upload = await res.json();
+        localStorage.setItem(key, upload.upload_id);
+    }
+
+    const received = new Set(upload.received);
+    const pending = [];
+    for (let i = 0; i < upload.chunk_count; i++) {
+        if (!received.has(i)) pending.push(i);
+    }
+    const sendChunk = async (index) => {
+        const body = file.slice(index * upload.chunk_size, (index + 1) * upload.chunk_size);
+        for (let attempt = 0; attempt < 3; attempt++) {
+            const res = await fetch(`${api}/${upload.upload_id}/chunks/${index}`, { method: 'PUT', headers, body }).catch(() => null);
+            if (res?.ok) return;
+        }
+        throw new Error(`Chunk ${index} failed`);
+    };
+    await Promise.all(Array.from({ length: RESUMABLE_PARALLEL }, async () => {
+        while (pending.length) await sendChunk(pending.shift());
+    }));
+
+    const res = await fetch(`${api}/${upload.upload_id}/complete`, { method: 'POST', headers });
+    if (!res.ok) throw new Error('Upload failed');
+    localStorage.removeItem(key);
+    return res.json();
+}
+
 // Auto Login Check
 (async function init() {
     let token = localStorage.getItem('access_token');
@@ -286,6 +344,7 @@ function setupWebSocketHandlersGlobal() {
                 if (msg.file_url) {
                     messageData.fileUrl = msg.file_url;
                     messageData.fileName = msg.file_name;
+                    messageData.image = msg.image;
                 // file size/text already set; status not shown in UI
                 }
                 
@@ -299,19 +358,27 @@ function setupWebSocketHandlersGlobal() {
         document.dispatchEvent(new CustomEvent('presenceUpdate', { detail: data }));
     });
 
+    // Coalesced presence updates (friends + conversation members only)
+    onWSEvent('presence_batch', (data) => {
+        (data.updates || []).forEach((update) => {
+            document.dispatchEvent(new CustomEvent('presenceUpdate', { detail: update }));
+        });
+    });
+
     // Pinned message updates
     onWSEvent('pinned_message_updated', (data) => {
         console.log("[App]  Pinned message updated:", data);
         const state = getState();
         const { conversation_id, pinned_message } = data;
+        const pinned_messages = data.pinned_messages || (pinned_message ? [pinned_message] : []);
 
         const updatedConvs = (state.conversations || []).map(c =>
-            c._id === conversation_id ? { ...c, pinned_message } : c
+            c._id === conversation_id ? { ...c, pinned_message, pinned_messages } : c
         );
         setConversations(updatedConvs);
 
         if (state.currentConversation?._id === conversation_id) {
-            const updatedCurrent = { ...state.currentConversation, pinned_message };
+            const updatedCurrent = { ...state.currentConversation, pinned_message, pinned_messages };
             setCurrentConversation(updatedCurrent);
             updateChatHeader(updatedCurrent);
         }
@@ -768,21 +835,44 @@ function setupChatLogic(sidebar, rightPanel) {
                     addMessage(currentConv._id, optimisticMessage);
                     
                     try {
-                        // Upload file to backend
                         const token = localStorage.getItem('access_token');
-                        const response = await fetch('http://localhost:8000/api/upload', {
-                            method: 'POST',
-                            headers: {
-                                'Authorization': `Bearer ${token}`
-                            },
-                            body: formData
-                        });
-                        
-                        if (!response.ok) {
-                            throw new Error('Upload failed');
+
+                        // Server already has this content? Reference it instead of uploading again.
+                        // Not for resumable uploads: hashing would load the whole (up to 2 GB) file in memory
+                        let result = null;
+                        const hash = file.size <= RESUMABLE_THRESHOLD ? await sha256Hex(file).catch(() => null) : null;
+                        if (hash) {
+                            const lookup = await fetch('http://localhost:8000/api/attachments/lookup', {
+                                method: 'POST',
+                                headers: {
+                                    'Authorization': `Bearer ${token}`,
+                                    'Content-Type': 'application/json'
+                                },
+                                body: JSON.stringify({ sha256: hash, conversation_id: currentConv._id, file_name: file.name })
+                            });
+                            if (lookup.ok) result = await lookup.json();
+                        }
+
+                        if (!result && file.size > RESUMABLE_THRESHOLD) {
+                            result = await uploadResumable(file, currentConv._id, token);
+                        }
+
+                        if (!result) {
+                            // Upload file to backend
+                            const response = await fetch(`http://localhost:8000/api/upload?conversation_id=${encodeURIComponent(currentConv._id)}`, {
+                                method: 'POST',
+                                headers: {
+                                    'Authorization': `Bearer ${token}`
+                                },
+                                body: formData
+                            });
+
+                            if (!response.ok) {
+                                throw new Error('Upload failed');
+                            }
+
+                            result = await response.json();
                         }
-                        
-                        const result = await response.json();
                         console.log('[App] File uploaded:', result);
 
                         // Update cached message with real file URL
@@ -794,7 +884,8 @@ function setupChatLogic(sidebar, rightPanel) {
                                     ...m,
                                     file_url: result.file_url,
                                     file_name: file.name,
-                                    file_size: fileSize
+                                    file_size: fileSize,
+                                    image: result.image
                                 };
                             }
                             return m;